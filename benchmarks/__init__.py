@@ -0,0 +1,4 @@
+"""
+Benchmarks for Fictive's hot paths, run against synthetic games of several
+sizes. Run `python -m benchmarks --help` from the repository root.
+"""
@@ -0,0 +1,115 @@
+"""
+Time Fictive's hot paths against synthetic games at several scales, and
+write the results as JSON:
+
+    python -m benchmarks --output bench.json
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict
+from fictive.game_server import GameServer
+from fictive.loader import load_game_yaml, clear_parse_cache
+from fictive.parser import parse
+from fictive.print_helper import statify, template_cache
+from .generator import GameSpec, generate_game
+
+SCALES: Dict[str, GameSpec] = {
+    "small": GameSpec(states=20, transitions=3, depth=1, sub_states=3),
+    "medium": GameSpec(states=200, transitions=6, depth=2, sub_states=4),
+    "large": GameSpec(states=1000, transitions=10, depth=2, sub_states=6, files=10),
+}
+
+
+def measure(fn: Callable[[], object], ops: int = 1, repeat: int = 5) -> dict:
+    """Time `fn`, which does `ops` operations, `repeat` times"""
+    runs = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - begin)
+    return {
+        "ops": ops,
+        "repeat": repeat,
+        "best_seconds": min(runs),
+        "median_seconds": statistics.median(runs),
+        "best_per_op_seconds": min(runs) / ops
+    }
+
+
+def bench_scale(name: str, spec: GameSpec, steps: int, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp) / name
+        vocabulary = generate_game(root, spec)
+        results = {"spec": spec.__dict__}
+        results["load_game_yaml"] = measure(lambda: (clear_parse_cache(), load_game_yaml(root)),
+                                            repeat=repeat)
+        loaded = load_game_yaml(root)
+        results["load_game_yaml_cached"] = measure(lambda: load_game_yaml(root), repeat=repeat)
+    results["parse"] = measure(lambda: parse(loaded), repeat=repeat)
+    machine, state_bag, _ = parse(loaded)
+    rand = random.Random(spec.seed)
+    inputs = [rand.choice(vocabulary) for _ in range(steps)]
+
+    def step():
+        bag = dict(state_bag)
+        cursor = machine.start(bag)
+        for inp in inputs:
+            machine.step(cursor, inp, bag)
+    results["Machine.step"] = measure(step, steps, repeat)
+
+    def tick():
+        server = GameServer(f"bench-{name}")
+        server.start(machine, state_bag)
+        for inp in inputs:
+            server.tick(inp)
+    results["GameServer.tick"] = measure(tick, steps, repeat)
+
+    server = GameServer(f"bench-{name}-render")
+    server.start(machine, state_bag)
+    def substates():
+        for _ in range(steps):
+            server.substates()
+    results["GameServer.substates"] = measure(substates, steps, repeat)
+
+    bag = dict(state_bag)
+    machine.start(bag)
+    descriptions = [s["state"]["description"] for part in loaded["execute"]["states"]
+                    for s in part]
+    def render():
+        for d in descriptions:
+            statify(d, bag)
+    results["statify"] = measure(render, len(descriptions), repeat)
+    template_cache.clear()
+    results["statify_cold"] = measure(lambda: (template_cache.clear(), render()),
+                                      len(descriptions), 1)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Benchmark Fictive on synthetic games")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=list(SCALES))
+    parser.add_argument("--steps", type=int, default=2000,
+                        help="How many inputs to step through at each scale")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", "-o", type=str, default=None,
+                        help="Write the JSON results here, instead of to stdout")
+    args = parser.parse_args()
+    report = {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "scales": {name: bench_scale(name, SCALES[name], args.steps, args.repeat)
+                   for name in args.scales}
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
@@ -0,0 +1,125 @@
+"""
+Generate synthetic Fictive games, of any size, for benchmarking.
+
+A generated game has `states` top-level states, each with `transitions`
+outgoing transitions. Every `nest_every`th state has a sub-machine,
+nested `depth` levels deep. Conditions mix regex matches (some of them
+deliberately expensive alternations) and statebag key checks, combined
+with `all`/`any`, and every description is templated from the statebag.
+The game is spread across several files, joined up with YAML anchors, like
+a hand-written one.
+"""
+import io
+import random
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+from ruamel.yaml import YAML
+
+VERBS = ["go", "take", "use", "open", "look"]
+NOUNS = ["north", "door", "lamp", "key"]
+
+
+@dataclass
+class GameSpec:
+    """The shape of a synthetic game"""
+    states: int = 50
+    transitions: int = 4
+    depth: int = 1
+    sub_states: int = 4
+    nest_every: int = 10
+    keys: int = 8
+    files: int = 4
+    seed: int = 1
+
+
+def _command(rand: random.Random) -> str:
+    return f"{rand.choice(VERBS)} {rand.choice(NOUNS)}"
+
+
+def _condition(rand: random.Random, spec: GameSpec, command: str):
+    """A transition condition, triggered by `command` (and maybe the statebag)"""
+    verb, noun = command.split(" ")
+    kind = rand.randrange(4)
+    match = {"on_match": {"matcher": f"({verb}|{verb}s|{verb}ing) (the )?{noun}"}}
+    if kind == 0:
+        return match
+    key = f"k{rand.randrange(spec.keys)}"
+    if kind == 1:
+        # KeyCmp ignores a value of 0, so compare against 1: this passes once
+        # the key's state has been entered
+        return [match, {"on_gte": {"key": key, "value": 1}}]
+    if kind == 2:
+        # an expensive alternation, which never matches
+        words = "|".join(f"{v} {n} again" for v in VERBS for n in NOUNS)
+        return {"any": [{"on_match": {"matcher": f"^(xyzzy|plugh|{words})$"}}, match]}
+    return {"all": [{"on_lt": {"key": key, "value": 1_000_000}},
+                    {"any": [{"on_key": {"key": key, "value": -1}}, match]}]}
+
+
+def _state(rand: random.Random, spec: GameSpec, tag: str, depth: int) -> dict:
+    keys = rand.sample(range(spec.keys), 2)
+    state: dict = {
+        "tag": tag,
+        "description": (f"You are in {tag}. You have {{k{keys[0]}}} of one thing, "
+                        f"and {{k{keys[1]}}} of another. \\{{braces}} are escaped."),
+        "on_enter": [{"banner": f"Room {tag}"}, {"inc": {"key": f"k{keys[0]}"}}]
+    }
+    if depth > 0:
+        state["sub_machine"] = _machine(rand, spec, f"{tag}_", spec.sub_states, depth - 1)
+    return {"state": state}
+
+
+def _machine(rand: random.Random, spec: GameSpec, prefix: str, count: int, depth: int) -> dict:
+    tags = [f"{prefix}s{i}" for i in range(count)]
+    return {
+        "startTag": tags[0],
+        "states": [_state(rand, spec, tag, depth if i % spec.nest_every == 0 else 0)
+                   for i, tag in enumerate(tags)],
+        "transitions": [{"transition": {"from": tag, "to": rand.choice(tags),
+                                        "condition": _condition(rand, spec, _command(rand))}}
+                        for tag in tags for _ in range(spec.transitions)]
+    }
+
+
+def _dump(yaml: YAML, name: str, entries: list) -> str:
+    out = io.StringIO()
+    yaml.dump({"__part__": entries}, out)
+    return out.getvalue().replace("__part__:", f"{name}: &{name}", 1)
+
+
+def generate_game(root: Path | str, spec: GameSpec) -> List[str]:
+    """
+    Write a game to `root`, returning a vocabulary of commands which exercise
+    its transitions.
+    """
+    rand = random.Random(spec.seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    machine = _machine(rand, spec, "", spec.states, spec.depth)
+    yaml = YAML(typ="safe")
+    yaml.default_flow_style = False
+
+    files = []
+    per_file = -(-len(machine["states"]) // spec.files)
+    for i in range(spec.files):
+        states = machine["states"][i * per_file:(i + 1) * per_file]
+        tags = {s["state"]["tag"] for s in states}
+        trans = [t for t in machine["transitions"] if t["transition"]["from"] in tags]
+        (root / f"part{i}.yaml").write_text(
+            _dump(yaml, f"states{i}", states) + _dump(yaml, f"trans{i}", trans))
+        files.append(f"part{i}.yaml")
+    aliases = "\n".join(f"        - *states{i}" for i in range(spec.files))
+    trans_aliases = "\n".join(f"        - *trans{i}" for i in range(spec.files))
+    bag = "\n".join(f"    k{i}: 0" for i in range(spec.keys))
+    (root / "game.yaml").write_text(
+        f"execute:\n    startTag: {machine['startTag']}\n    states:\n{aliases}\n"
+        f"    transitions:\n{trans_aliases}\nstate_bag:\n{bag}\n")
+    files.append("game.yaml")
+    (root / "manifest.yaml").write_text(
+        "title: Synthetic\nslug: A generated benchmark game\nauthor: benchmarks\nfiles:\n"
+        + "".join(f"  - {f}\n" for f in files))
+
+    vocabulary = [f"{v} {n}" for v in VERBS for n in NOUNS]
+    rand.shuffle(vocabulary)
+    return vocabulary
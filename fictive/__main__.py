@@ -3,10 +3,17 @@ import asyncio
 
 import argparse
 from pathlib import Path
-from .loader import load_game_yaml, load_test
-from .parser import parse
+from .loader import load_game_yaml, load_test, GameYAMLError
+from .game_cache import load_game, DEFAULT_CACHE_DIR
+from .parser import check_game
 from .test_parser import parse_test
-from .test_runner import test_main
+from .test_runner import print_test_results
+from .test_selection import run_incremental
+from .explorer import explore, test_vocabulary
+from .host import GameHost, GameLibrary, serve
+from .game_server import GameServer, SessionRegistry
+from .profiler import Profiler
+from .scheduler import TickScheduler
 
 
 parser = argparse.ArgumentParser(
@@ -19,21 +26,115 @@ parser.add_argument("--debug", "-d", action="store_true",
                     help="Enable debugging features")
 parser.add_argument("--test_game", "-t", type=str, default=None,
                     help="Load a game and run its test suite, without loading the UI")
+parser.add_argument("--no_cache", action="store_true",
+                    help="Always load games from their YAML, ignoring the compiled game cache")
+parser.add_argument("--optimize", "-O", action="store_true",
+                    help="Reorder transition conditions so cheap checks run first")
+parser.add_argument("--serve", action="store_true",
+                    help="Host the games over the network, instead of loading the UI")
+parser.add_argument("--port", type=int, default=7777,
+                    help="The port for the line protocol, when serving")
+parser.add_argument("--http_port", type=int, default=None,
+                    help="Also serve HTTP/JSON on this port, when serving")
+parser.add_argument("--max_sessions", type=int, default=None,
+                    help="Spill sessions to disk once this many are in memory, when serving")
+parser.add_argument("--session_ttl", type=float, default=None,
+                    help="Spill sessions to disk after this many idle seconds, when serving")
+parser.add_argument("--spilled_ttl", type=float, default=24 * 60 * 60,
+                    help="Forget spilled sessions after this many idle seconds, when serving")
+parser.add_argument("--max_spilled", type=int, default=None,
+                    help="Forget the oldest spilled sessions once there are this many, when serving")
+parser.add_argument("--tick_budget", type=int, default=None,
+                    help="Fail any tick which evaluates more than this many conditions, when serving")
+parser.add_argument("--jobs", "-j", type=int, default=1,
+                    help="Run game tests across this many processes (0 for one per core)")
+parser.add_argument("--all_tests", action="store_true",
+                    help="Run every game test, not just those affected by changes since the last run")
+parser.add_argument("--explore", "-e", type=str, default=None,
+                    help="Search every configuration a game can reach, without loading the UI")
+parser.add_argument("--vocabulary", type=str, nargs="+", default=None,
+                    help="The inputs to explore with (by default, the inputs used in the game's tests)")
+parser.add_argument("--depth", type=int, default=None,
+                    help="How many inputs deep to explore")
+parser.add_argument("--max_configurations", type=int, default=1_000_000,
+                    help="Stop exploring after seeing this many configurations")
+parser.add_argument("--check", "-c", type=str, default=None,
+                    help="Check a game for mistakes (bad tags and triggers), without loading the UI")
+parser.add_argument("--watch", "-w", action="store_true",
+                    help="Reload a game whenever its files change, without losing your place")
+parser.add_argument("--profile", type=str, default=None,
+                    help="Profile transitions and triggers, and write the report as JSON to this path")
 args = parser.parse_args()
+cache_dir = None if args.no_cache else DEFAULT_CACHE_DIR
+if args.profile:
+    GameServer.profiler = Profiler()
+
+def report_profile():
+    if GameServer.profiler is not None:
+        print(GameServer.profiler.table())
+        GameServer.profiler.write_json(args.profile)
+
+def load(game: str) -> dict:
+    try:
+        return load_game(Path(args.game_dir) / Path(game), cache_dir)
+    except GameYAMLError as ex:
+        print(f"Failed to load game, YAML error: {ex}")
+        exit(1)
+
+def print_problems(loaded: dict) -> bool:
+    problems = check_game(loaded)
+    for problem in problems:
+        print(f"---- {problem}")
+    return bool(problems)
+
+if args.check:
+    loaded = load(args.check)
+    if print_problems(loaded):
+        exit(1)
+    print("No problems found")
+    exit(0)
 
 if args.test_game:
     gut = Path(args.game_dir) / Path(args.test_game)
-    loaded = load_game_yaml(gut)
-    machine,statebag,title = parse(loaded)
-    test_defs = []
-    test_main(loaded, gut)
-                
+    loaded = load(args.test_game)
+    # sub-machines are only built when they're entered, so look for mistakes up front
+    print_problems(loaded)
+    # profiling only sees tests run in this process, so run them all, here
+    profiling = GameServer.profiler is not None
+    for loaded_test, res in run_incremental(loaded, gut, args.optimize,
+                                            1 if profiling else args.jobs,
+                                            args.all_tests or profiling):
+        print_test_results(loaded_test, res)
+    report_profile()
+    exit(0)
+
+if args.explore:
+    gut = Path(args.game_dir) / Path(args.explore)
+    loaded = load(args.explore)
+    vocabulary = args.vocabulary or test_vocabulary(loaded, gut)
+    if not vocabulary:
+        print("No vocabulary: pass some inputs with --vocabulary")
+        exit(1)
+    print(explore(loaded, vocabulary, args.depth, args.max_configurations,
+                  args.jobs, args.optimize).report())
     exit(0)
 
+if args.serve:
+    host = GameHost(GameLibrary(args.game_dir, cache_dir, args.optimize),
+                    SessionRegistry(args.max_sessions, args.session_ttl,
+                                    spilled_ttl=args.spilled_ttl, max_spilled=args.max_spilled),
+                    scheduler=TickScheduler(args.tick_budget))
+    try:
+        asyncio.run(serve(host, port=args.port, http_port=args.http_port))
+    except KeyboardInterrupt:
+        pass
+    exit(0)
 
 
 async def game_loop():
-    ui = FictiveUI(args.game_dir, debug=args.debug)
+    ui = FictiveUI(args.game_dir, debug=args.debug, cache_dir=cache_dir,
+                   optimize=args.optimize, watch_files=args.watch)
     loop = ui.run_async()
     await loop
 asyncio.run(game_loop())
+report_profile()
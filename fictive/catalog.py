@@ -0,0 +1,155 @@
+"""
+A persistent index of the games in a games directory, so we don't have to
+open and parse every game's manifest each time we list them.
+
+For each game, the index remembers what its manifest says, and the
+modification time, size and hash of the manifest and every file it lists.
+A rescan only checks those with `stat`: a game is only re-read if one of its
+files has changed, and only the changed files are re-hashed.
+"""
+import hashlib
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from sys import stderr
+from typing import Dict, Iterator, List, Tuple
+from .loader import GameListEntry, game_list_entry, load_manifest
+from .game_cache import DEFAULT_CACHE_DIR
+
+CATALOG_VERSION = 1
+
+# a file's modification time (in ns), size, and sha256
+FileStamp = Tuple[int, int, str]
+
+
+@dataclass
+class CatalogEntry(GameListEntry):
+    """A game in the catalog, and the stamps of the files it was read from"""
+    files: Dict[str, FileStamp] = field(default_factory=dict)
+
+    def to_json(self) -> dict:
+        return {"title": self.title, "slug": self.slug, "author": self.author,
+                "path": str(self.path), "files": self.files}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "CatalogEntry":
+        return cls(data["title"], data["slug"], data["author"], Path(data["path"]),
+                   {f: tuple(stamp) for f, stamp in data["files"].items()}) # type: ignore
+
+
+def _stamp(path: Path, previous: FileStamp | None) -> FileStamp:
+    """Stamp a file, only reading it if it's changed since `previous`"""
+    stat = path.stat()
+    if previous is not None and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+        return previous
+    return (stat.st_mtime_ns, stat.st_size, hashlib.sha256(path.read_bytes()).hexdigest())
+
+
+def _unchanged(root: Path, entry: CatalogEntry) -> bool:
+    try:
+        for name, stamp in entry.files.items():
+            stat = (root / name).stat()
+            if (stat.st_mtime_ns, stat.st_size) != stamp[:2]:
+                return False
+    except OSError:
+        return False
+    return True
+
+
+class GameCatalog:
+    """
+    The games in `path`. `entries` lists what we knew about them last time,
+    instantly; `rescan` brings that up to date. The index is kept in
+    `cache_dir`, or only in memory if that's `None`.
+    """
+    def __init__(self, path: Path | str, cache_dir: Path | str | None = DEFAULT_CACHE_DIR):
+        self.path = Path(path).resolve()
+        self.index: Path | None = None
+        if cache_dir is not None:
+            key = hashlib.sha256(str(self.path).encode()).hexdigest()[:16]
+            self.index = Path(cache_dir) / f"catalog-{key}.json"
+        self._lock = threading.Lock()
+        self._entries: Dict[str, CatalogEntry] = self._load()
+
+    def _load(self) -> Dict[str, CatalogEntry]:
+        if self.index is None:
+            return {}
+        try:
+            data = json.loads(self.index.read_text())
+            if data.get("version") != CATALOG_VERSION:
+                return {}
+            return {name: CatalogEntry.from_json(e) for name, e in data["games"].items()}
+        except FileNotFoundError:
+            return {}
+        except Exception as ex:
+            print(f"Ignoring unreadable game catalog {self.index}: {ex}", file=stderr)
+            return {}
+
+    def _save(self):
+        if self.index is None:
+            return
+        with self._lock:
+            games = {name: e.to_json() for name, e in self._entries.items()}
+        try:
+            self.index.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.index.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps({"version": CATALOG_VERSION, "games": games}))
+            os.replace(tmp, self.index)
+        except Exception as ex:
+            print(f"Could not write game catalog {self.index}: {ex}", file=stderr)
+
+    def entries(self) -> List[CatalogEntry]:
+        """Every game we know about, by folder name"""
+        with self._lock:
+            return [self._entries[name] for name in sorted(self._entries)]
+
+    def _read(self, root: Path, previous: CatalogEntry | None) -> CatalogEntry:
+        mfest = load_manifest(root / "manifest.yaml")
+        listing = game_list_entry(mfest, root)
+        old = previous.files if previous else {}
+        files = {name: _stamp(root / name, old.get(name))
+                 for name in ["manifest.yaml"] + list(mfest.get("files", []))}
+        return CatalogEntry(listing.title, listing.slug, listing.author, root, files)
+
+    def rescan(self) -> Iterator[Tuple[str, CatalogEntry | None]]:
+        """
+        Check every game for changes, yielding `(folder name, entry)` for each
+        game that's new or has changed, and `(folder name, None)` for each
+        one that's gone, as we find them.
+        """
+        changed = False
+        seen = set()
+        for p in sorted(self.path.iterdir()):
+            if not (p.is_dir() and (p / "manifest.yaml").exists()):
+                continue
+            seen.add(p.name)
+            with self._lock:
+                previous = self._entries.get(p.name)
+            if previous is not None and previous.path == p and _unchanged(p, previous):
+                continue
+            try:
+                entry = self._read(p, previous)
+            except Exception as ex:
+                print(f"Skipping game {p.name}: {ex}", file=stderr)
+                continue
+            with self._lock:
+                self._entries[p.name] = entry
+            changed = True
+            yield p.name, entry
+        with self._lock:
+            gone = [name for name in self._entries if name not in seen]
+            for name in gone:
+                del self._entries[name]
+        for name in gone:
+            changed = True
+            yield name, None
+        if changed:
+            self._save()
+
+    def refresh(self) -> List[CatalogEntry]:
+        """Rescan, and list every game"""
+        for _ in self.rescan():
+            pass
+        return self.entries()
@@ -0,0 +1,211 @@
+"""
+Explore every configuration a game can reach from a vocabulary of inputs,
+breadth first, to find states which can't be reached, places the player gets
+stuck, and the shortest way to get anywhere.
+
+A configuration is the active states (and the remembered positions of
+sub-machines) plus the statebag. We identify each one by a hash of its
+snapshot, with the statebag sorted, so we only keep 16 bytes for each
+configuration we've seen, and the snapshots of the current frontier.
+"""
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+from .loader import load_test
+from .parser import parse
+from .snapshot import encode_snapshot, decode_snapshot
+from .states import Machine, State, Cursor, Statebag
+
+Address = Tuple[str, ...]
+# a frontier entry: the configuration's snapshot, and the inputs (as indexes
+# into the vocabulary) which got us there
+Frontier = List[Tuple[bytes, Tuple[int, ...]]]
+
+
+def state_addresses(machine: Machine, prefix: Address = ()) -> Iterator[Tuple[Address, State]]:
+    """Every state in a machine and its sub-machines, with its address"""
+    for tag, state in machine._states.items():
+        if tag == "":
+            continue
+        yield prefix + (tag,), state
+        sub = state.sub()
+        if sub:
+            yield from state_addresses(sub, prefix + (tag,))
+
+
+@dataclass
+class Exploration:
+    """
+    What we found. States are named by their address: the tags from the top
+    level machine down, joined with `/`.
+    """
+    vocabulary: List[str]
+    configurations: int = 0
+    depth: int = 0
+    # we ran out of configurations to explore, rather than hitting a limit
+    complete: bool = False
+    transcripts: Dict[str, List[str]] = field(default_factory=dict)
+    unreachable: List[str] = field(default_factory=list)
+    dead_ends: Dict[str, List[str]] = field(default_factory=dict)
+    errors: Dict[str, List[str]] = field(default_factory=dict)
+    end: List[str] | None = None
+
+    def report(self) -> str:
+        lines = [f"Explored {self.configurations} configurations to depth {self.depth}"
+                 + ("" if self.complete else " (stopped at a limit; results are partial)")]
+        lines.append("End reached by: " + (" / ".join(self.end) if self.end is not None
+                                           else "never reached"))
+        lines.append(f"Unreachable states ({len(self.unreachable)}):")
+        lines += [f"---- {s}" for s in self.unreachable]
+        lines.append(f"Dead ends ({len(self.dead_ends)}):")
+        lines += [f"---- {s}: {' / '.join(t)}" for s, t in self.dead_ends.items()]
+        lines.append(f"Errors ({len(self.errors)}):")
+        lines += [f"---- {e}: {' / '.join(t)}" for e, t in self.errors.items()]
+        lines.append("Shortest transcripts:")
+        lines += [f"---- {s}: {' / '.join(t)}" for s, t in self.transcripts.items()]
+        return "\n".join(lines)
+
+
+class _Expander:
+    """Steps configurations through every input in the vocabulary"""
+    def __init__(self, machine: Machine, vocabulary: List[str]):
+        self.machine = machine
+        self.vocabulary = vocabulary
+        self.fingerprint = machine.fingerprint()
+        self.addresses = {id(s): "/".join(a) for a, s in state_addresses(machine)}
+
+    def canonical(self, cursor: Cursor, bag: Statebag) -> bytes:
+        """The same configuration always gets the same key, however it was reached"""
+        parked = dict(sorted(cursor.parked.items())) if cursor.parked else None
+        return encode_snapshot(self.fingerprint, Cursor(cursor.path, parked),
+                               dict(sorted(bag.items())))
+
+    def expand(self, snapshot: bytes):
+        """
+        The outcome of each input from a configuration: the result, the new
+        configuration, its active path, and the address of any transient state
+        or error message.
+        """
+        cursor, bag = decode_snapshot(snapshot, self.fingerprint)
+        outcomes = []
+        for inp in self.vocabulary:
+            c = cursor.copy()
+            b = dict(bag)
+            res = self.machine.step(c, inp, b)
+            extra = None
+            if res.action == Machine.Result.Transient and res.transient is not None:
+                extra = self.addresses.get(id(res.transient))
+            elif res.action == Machine.Result.Error:
+                extra = res.additionalMessages or "Error"
+            outcomes.append((res.action, self.canonical(c, b), c.path, extra))
+        return outcomes
+
+
+_worker: dict = {}
+
+def _init_worker(loaded: dict, vocabulary: List[str], optimize: bool):
+    machine, _, _ = parse(loaded, optimize)
+    _worker["expander"] = _Expander(machine, vocabulary)
+
+def _expand_batch(snapshots: List[bytes]):
+    return [_worker["expander"].expand(s) for s in snapshots]
+
+
+def test_vocabulary(loaded: dict, root: Path) -> List[str]:
+    """Every distinct input used by a game's tests, a handy default vocabulary"""
+    vocabulary: Dict[str, None] = {}
+    for t in loaded.get("tests", []):
+        for test in load_test(Path(root) / t).values():
+            for step in test.get("steps", []):
+                if "input" in step:
+                    vocabulary[step["input"]] = None
+    return list(vocabulary)
+
+
+def _digest(snapshot: bytes) -> bytes:
+    return hashlib.blake2b(snapshot, digest_size=16).digest()
+
+
+def explore(loaded: dict, vocabulary: List[str], max_depth: int | None = None,
+            max_configurations: int = 1_000_000, jobs: int = 1,
+            optimize: bool = False) -> Exploration:
+    """
+    Breadth-first search of a compiled game, trying every input in
+    `vocabulary` in every configuration. Stops after `max_depth` inputs, or
+    once we've seen `max_configurations`. Each level of the search is spread
+    across `jobs` processes (0 for one per core); the results don't depend on
+    how many.
+    """
+    machine, state_bag, _ = parse(loaded, optimize)
+    expander = _Expander(machine, vocabulary)
+    found = Exploration(list(vocabulary))
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    bag = dict(state_bag)
+    cursor = machine.start(bag)
+    start = expander.canonical(cursor, bag)
+    seen = {_digest(start)}
+    frontier: Frontier = [(start, ())]
+
+    def visit(path: Address, transcript: Tuple[int, ...]):
+        for depth in range(len(path)):
+            address = "/".join(path[:depth+1])
+            if address not in found.transcripts:
+                found.transcripts[address] = [vocabulary[i] for i in transcript]
+    visit(cursor.path, ())
+
+    pool = ProcessPoolExecutor(jobs, initializer=_init_worker,
+                               initargs=(loaded, vocabulary, optimize)) if jobs > 1 else None
+    limited = False
+    try:
+        while frontier and (max_depth is None or found.depth < max_depth):
+            snapshots = [s for s, _ in frontier]
+            if pool is None:
+                expanded = [expander.expand(s) for s in snapshots]
+            else:
+                size = max(1, -(-len(snapshots) // (jobs * 4)))
+                expanded = [o for batch in pool.map(_expand_batch, [snapshots[i:i+size]
+                            for i in range(0, len(snapshots), size)]) for o in batch]
+            following: Frontier = []
+            for (snapshot, transcript), outcomes in zip(frontier, expanded):
+                stuck = True
+                for i, (action, after, path, extra) in enumerate(outcomes):
+                    steps = transcript + (i,)
+                    if after != snapshot or action in (Machine.Result.End, Machine.Result.Transient):
+                        stuck = False
+                    if action == Machine.Result.Transient and extra is not None:
+                        found.transcripts.setdefault(extra, [vocabulary[j] for j in steps])
+                    elif action == Machine.Result.Error and extra not in found.errors:
+                        found.errors[extra] = [vocabulary[j] for j in steps]
+                    if action == Machine.Result.End:
+                        if found.end is None:
+                            found.end = [vocabulary[j] for j in steps]
+                        visit(path, steps)
+                        continue
+                    digest = _digest(after)
+                    if digest in seen:
+                        continue
+                    if len(seen) >= max_configurations:
+                        limited = True
+                        continue
+                    seen.add(digest)
+                    visit(path, steps)
+                    following.append((after, steps))
+                if stuck:
+                    where = "/".join(decode_snapshot(snapshot, expander.fingerprint)[0].path)
+                    found.dead_ends.setdefault(where, [vocabulary[j] for j in transcript])
+            frontier = following
+            found.depth += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    found.configurations = len(seen)
+    found.complete = not frontier and not limited
+    found.unreachable = ["/".join(a) for a, _ in state_addresses(machine)
+                         if "/".join(a) not in found.transcripts]
+    return found
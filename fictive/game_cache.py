@@ -0,0 +1,85 @@
+"""
+A content-addressed cache of compiled games, so we don't have to re-read and
+re-parse all of a game's YAML every time we launch it.
+
+Entries are keyed by a hash of the manifest and every file it lists, so any
+edit to the game produces a new key and the stale entry is simply never read.
+Only games that pass `check_game` are ever stored, so anything read back from
+the cache has already been checked.
+"""
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from sys import stderr
+from .loader import load_game_yaml, load_manifest
+from .parser import compile_game, check_game, IR_VERSION
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME",
+                                        Path.home() / ".cache")) / "fictive"
+
+
+def game_digest(gameInstance: Path | str) -> str:
+    """
+    Hash the manifest and the contents of every file it lists.
+    """
+    root = Path(gameInstance).resolve()
+    manifest = root / "manifest.yaml"
+    mfest = load_manifest(manifest)
+    # "checked": entries from before we only cached checked games aren't trusted
+    h = hashlib.sha256(f"fictive-ir-{IR_VERSION}-checked".encode())
+    h.update(manifest.read_bytes())
+    for entry in mfest["files"]:
+        data = (root / entry).read_bytes()
+        h.update(entry.encode())
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _read_entry(path: Path) -> dict | None:
+    try:
+        with path.open("rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        print(f"Ignoring unreadable game cache entry {path}: {ex}", file=stderr)
+        return None
+
+
+def _write_entry(path: Path, compiled: dict):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception as ex:
+        print(f"Could not write game cache entry {path}: {ex}", file=stderr)
+
+
+def load_game(gameInstance: Path | str, cache_dir: Path | str | None = DEFAULT_CACHE_DIR,
+              check: bool = False) -> dict:
+    """
+    Load a game in its compiled form, ready for `parse`. If we've compiled
+    this exact game before, we use the cached copy; otherwise we load the YAML
+    and store the result for next time. Pass `cache_dir=None` to skip the cache.
+
+    With `check`, a game that fails `check_game` raises a ValueError listing
+    its problems, rather than failing later when a session reaches them.
+    """
+    entry = None
+    if cache_dir is not None:
+        entry = Path(cache_dir) / f"{game_digest(gameInstance)}.pickle"
+        compiled = _read_entry(entry)
+        if compiled is not None:
+            return compiled
+    loaded = load_game_yaml(gameInstance)
+    problems = check_game(loaded)
+    if problems and check:
+        raise ValueError("\n".join(problems))
+    compiled = compile_game(loaded)
+    if entry is not None and not problems:
+        _write_entry(entry, compiled)
+    return compiled
@@ -4,47 +4,426 @@ frees our game UI from worrying about the object life cycle.
 
 It encapsulates both the game state and the state_bag within
 itself, revealing only the bits that outside elements need.
+
+The `Machine` is a shared, read-only definition of the game. All a
+`GameServer` owns is its session: a `Cursor` and a statebag.
 """
-from .states import Machine, Statebag
-from typing import Tuple, Dict
+from .states import Machine, Statebag, Cursor, State, VersionedStatebag, BagDelta
+from .profiler import Profiler
+from .snapshot import encode_snapshot, decode_snapshot, SnapshotError
+from typing import Callable, Iterable, Tuple, Dict, List, Mapping
+from dataclasses import dataclass
+from types import MappingProxyType
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import tempfile
+import time
 
 class GameServer:
     """
     Container for a game.
+
+    A server which belongs to a `SessionRegistry` may be spilled to disk when
+    it's been idle; any call which needs its session transparently loads it
+    back in.
+
+    Each tick hands back a read-only view of the statebag, and records which
+    keys changed in the step's `changes`. Clients which want to follow the
+    statebag can `subscribe` to those changes instead of copying it.
+
+    Set `profiler` on a server, or on the class for every server, to profile
+    its steps.
     """
     class NotStarted(Exception):
         pass
 
+    @dataclass
+    class BatchResult:
+        """
+        The outcome of `tick_many`: the last step's action, where we ended up,
+        and how many inputs we consumed. `results` and `trace` are only
+        filled in if asked for.
+        """
+        action: Machine.Result
+        state: State
+        path: Tuple[str, ...]
+        consumed: int
+        changes: BagDelta
+        results: List[Machine.Result] | None = None
+        trace: List[Tuple[Machine.Result, str]] | None = None
+
     _machine: Machine
-    _bag: Statebag
+    _cursor: Cursor
+    _bag: VersionedStatebag
+    _view: Mapping
     _started:bool = False
+    _spilled: Path | None = None
+    _spilled_version: int = 0
+    profiler: Profiler | None = None
+
+    def __init__(self, key: str = "default", registry: "SessionRegistry | None" = None):
+        self.key = key
+        self._registry = registry
+        self._subscribers: List[Callable[[BagDelta, Mapping], None]] = []
+
+    def _use(self):
+        """Make sure our session is in memory, and let our registry know we're active"""
+        if self._spilled is not None:
+            self._rehydrate()
+        if self._registry is not None:
+            self._registry.touch(self.key)
 
     def start(self, machine:Machine, bag:Statebag):
+        self._discard_spill()
         self._machine = machine
-        self._bag = bag
-        self._machine.start(bag)
+        self._set_bag(bag)
+        self._cursor = machine.start(self._bag, self.profiler)
         self._started = True
+        if self._registry is not None:
+            self._registry.touch(self.key)
 
-    def tick(self, inp:str) -> Tuple[Machine.StepResult, Statebag]:
+    def _set_bag(self, bag: Statebag):
+        self._bag = VersionedStatebag(bag)
+        self._view = MappingProxyType(self._bag)
+
+    def tick(self, inp:str, budget: int | None = None) -> Tuple[Machine.StepResult, Mapping]:
+        """
+        Advance the game by one input. Returns the step's result, with the
+        statebag's `changes`, and a read-only view of the statebag. A `budget`
+        limits how many conditions the step may evaluate; see `Machine.step`.
+        """
+        if not self._started:
+            raise GameServer.NotStarted()
+        self._use()
+        bag = self._bag
+        bag.begin()
+        try:
+            ticked = self._machine.step(self._cursor, inp, bag, budget, self.profiler)
+        finally:
+            ticked_changes = bag.end()
+        ticked.changes = ticked_changes
+        if ticked_changes and self._subscribers:
+            for subscriber in self._subscribers:
+                subscriber(ticked_changes, self._view)
+        return ticked, self._view
+
+    def tick_many(self, inputs: Iterable[str], results: bool = False, trace: bool = False,
+                  budget: int | None = None) -> "GameServer.BatchResult":
+        """
+        Run a whole sequence of inputs, as fast as we can, for replaying
+        transcripts. Stops early if the game ends. Returns only what's asked
+        for: by default, just where we ended up. `results` adds each step's
+        result, and `trace` adds each step's result and the tag of its state.
+        All the statebag changes are reported together, once, at the end.
+        """
         if not self._started:
             raise GameServer.NotStarted()
-        ticked = self._machine.step(inp, self._bag)
-        return ticked, self.bag() # give clients copies of our statebag
+        self._use()
+        step = self._machine.step
+        profiler = self.profiler
+        cursor = self._cursor
+        bag = self._bag
+        codes: List[Machine.Result] | None = [] if results else None
+        steps: List[Tuple[Machine.Result, str]] | None = [] if trace else None
+        action = Machine.Result.NoChange
+        consumed = 0
+        bag.begin()
+        try:
+            for inp in inputs:
+                ticked = step(cursor, inp, bag, budget, profiler)
+                action = ticked.action
+                consumed += 1
+                if codes is not None:
+                    codes.append(action)
+                if steps is not None:
+                    steps.append((action, ticked.state.tag))
+                if action == Machine.Result.End:
+                    break
+        finally:
+            changes = bag.end()
+        if changes and self._subscribers:
+            for subscriber in self._subscribers:
+                subscriber(changes, self._view)
+        return GameServer.BatchResult(action, self._machine.current(cursor), cursor.path,
+                                      consumed, changes, codes, steps)
+
+    def subscribe(self, subscriber: Callable[[BagDelta, Mapping], None]) -> Callable[[], None]:
+        """
+        Call `subscriber` with the changes and the statebag view, after any tick
+        which changes the statebag. Returns a function which unsubscribes.
+        """
+        self._subscribers.append(subscriber)
+        return lambda: self._subscribers.remove(subscriber)
 
     def bag(self):
+        """A copy of the statebag"""
+        self._use()
         return self._bag.copy()
 
-    def current(self):
-        return self._machine.current()
+    def view(self) -> Mapping:
+        """A read-only, live view of the statebag"""
+        self._use()
+        return self._view
+
+    def version(self) -> int:
+        """The statebag's version, which goes up each time a tick changes it"""
+        self._use()
+        return self._bag.version
+
+    def machine(self) -> Machine:
+        return self._machine
+
+    def cursor(self) -> Cursor:
+        self._use()
+        return self._cursor
+
+    def current(self) -> State:
+        self._use()
+        return self._machine.current(self._cursor)
+
+    def substates(self) -> List[str]:
+        """The descriptions of the active substates, outermost first"""
+        self._use()
+        return self._machine.substates(self._cursor)
+
+    def snapshot(self) -> bytes:
+        """
+        Save our session, the active states and the statebag, as a small
+        binary blob tied to our machine's definition.
+        """
+        if not self._started:
+            raise GameServer.NotStarted()
+        self._use()
+        return encode_snapshot(self._machine.fingerprint(), self._cursor, self._bag)
+
+    def restore(self, machine: Machine, snapshot: bytes):
+        """
+        Resume a session from a snapshot. This puts us back exactly where the
+        snapshot was taken, without running any `on_enter` triggers. Raises
+        a `SnapshotError` if the snapshot wasn't taken against `machine`.
+        """
+        cursor, bag = decode_snapshot(snapshot, machine.fingerprint())
+        self._discard_spill()
+        self._machine = machine
+        self._cursor = cursor
+        self._set_bag(bag)
+        self._started = True
+        if self._registry is not None:
+            self._registry.touch(self.key)
+
+    def reload(self, machine: Machine) -> List[str]:
+        """
+        Swap in a new version of our game, keeping our place and our statebag,
+        without running any triggers (see `Machine.remap`). Returns the
+        addresses of any states we were in, or had parked, which have gone.
+        A spilled session is updated on disk, without loading it back in.
+        """
+        if not self._started:
+            raise GameServer.NotStarted()
+        if self._spilled is not None:
+            cursor, bag = decode_snapshot(self._spilled.read_bytes(), self._machine.fingerprint())
+            cursor, missing = machine.remap(cursor)
+            self._spilled.write_bytes(encode_snapshot(machine.fingerprint(), cursor, bag))
+        else:
+            self._cursor, missing = machine.remap(self._cursor)
+        self._machine = machine
+        return missing
+
+    def is_resident(self) -> bool:
+        return self._spilled is None
+
+    def spill(self, path: Path):
+        """
+        Write our session out to `path` and drop it from memory. We keep our
+        (shared) machine, so we can pick up again later.
+        """
+        if not self._started or self._spilled is not None:
+            return
+        path.write_bytes(encode_snapshot(self._machine.fingerprint(), self._cursor, self._bag))
+        self._spilled_version = self._bag.version
+        del self._cursor
+        del self._bag
+        del self._view
+        self._spilled = path
+
+    def _rehydrate(self):
+        path: Path = self._spilled # type: ignore
+        begin = time.perf_counter()
+        cursor, bag = decode_snapshot(path.read_bytes(), self._machine.fingerprint())
+        path.unlink()
+        self._cursor = cursor
+        self._set_bag(bag)
+        self._bag.version = self._spilled_version
+        self._spilled = None
+        if self._registry is not None:
+            self._registry.rehydrated(self.key, time.perf_counter() - begin)
+
+    def _discard_spill(self):
+        if self._spilled is not None:
+            self._spilled.unlink(missing_ok=True)
+            self._spilled = None
+
+
+class SessionRegistry:
+    """
+    A lookup table to allow us to manage multiple running games at the same time.
+
+    At most `cap` sessions are kept in memory, and sessions idle for more than
+    `ttl` seconds are spilled to disk. Spilled sessions cost a few bytes each,
+    and are loaded back in the next time they're used.
+
+    Spilled sessions which sit idle for more than `spilled_ttl` seconds, or
+    the oldest ones once there are more than `max_spilled`, are expired:
+    removed entirely, spill file and all. Functions in `on_expire` are
+    called with the key of each expired session. By default, none of these
+    limits apply.
+    """
+    def __init__(self, cap: int | None = None, ttl: float | None = None,
+                 spill_dir: Path | str | None = None, spilled_ttl: float | None = None,
+                 max_spilled: int | None = None):
+        self.cap = cap
+        self.ttl = ttl
+        self.spilled_ttl = spilled_ttl
+        self.max_spilled = max_spilled
+        self._spill_dir = Path(spill_dir) if spill_dir else None
+        self._servers: Dict[str, GameServer] = {}
+        # resident sessions, least recently used first, with when we last used them
+        self._resident: OrderedDict[str, float] = OrderedDict()
+        # spilled sessions, least recently used first, with when we last used them
+        self._spilled: OrderedDict[str, float] = OrderedDict()
+        self.on_expire: List[Callable[[str], None]] = []
+        self.evictions = 0
+        self.expirations = 0
+        self.unspillable = 0
+        self.rehydrations = 0
+        self.rehydrate_seconds = 0.0
+        self.rehydrate_max_seconds = 0.0
+
+    def configure(self, cap: int | None = None, ttl: float | None = None,
+                  spill_dir: Path | str | None = None, spilled_ttl: float | None = None,
+                  max_spilled: int | None = None):
+        self.cap = cap
+        self.ttl = ttl
+        self.spilled_ttl = spilled_ttl
+        self.max_spilled = max_spilled
+        if spill_dir:
+            self._spill_dir = Path(spill_dir)
+        self.sweep()
 
-# a lookup table to allow us to manage multiple running games at the same time
-_server: Dict[str, GameServer] = {"default": GameServer()}
+    def spill_dir(self) -> Path:
+        if self._spill_dir is None:
+            self._spill_dir = Path(tempfile.mkdtemp(prefix="fictive-sessions-"))
+        self._spill_dir.mkdir(parents=True, exist_ok=True)
+        return self._spill_dir
+
+    def get(self, key: str) -> GameServer:
+        if key not in self._servers:
+            self._servers[key] = GameServer(key, self)
+        return self._servers[key]
+
+    def __contains__(self, key: str):
+        return key in self._servers
+
+    def touch(self, key: str):
+        """Mark a session as just used, and evict anything that's gone cold"""
+        self._spilled.pop(key, None)
+        self._resident[key] = time.monotonic()
+        self._resident.move_to_end(key)
+        self.sweep()
+
+    def sweep(self):
+        """
+        Spill sessions over our cap, or past their idle ttl, and expire
+        spilled sessions over our spilled cap, or past their spilled ttl
+        """
+        now = time.monotonic()
+        while self._resident:
+            key, last = next(iter(self._resident.items()))
+            over_cap = self.cap is not None and len(self._resident) > max(self.cap, 1)
+            expired = self.ttl is not None and now - last > self.ttl
+            if not (over_cap or expired):
+                break
+            self.evict(key)
+        while self._spilled:
+            key, last = next(iter(self._spilled.items()))
+            over_cap = self.max_spilled is not None and len(self._spilled) > self.max_spilled
+            expired = self.spilled_ttl is not None and now - last > self.spilled_ttl
+            if not (over_cap or expired):
+                break
+            self.expire(key)
+
+    def evict(self, key: str):
+        """
+        Spill a session to disk. A session whose statebag can't be saved
+        (see `encode_snapshot`) stays in memory.
+        """
+        last = self._resident.pop(key, time.monotonic())
+        server = self._servers[key]
+        if server._started and server.is_resident():
+            name = hashlib.sha1(key.encode()).hexdigest()
+            try:
+                server.spill(self.spill_dir() / f"{name}.session")
+            except SnapshotError:
+                self.unspillable += 1
+                return
+            self._spilled[key] = last
+            self.evictions += 1
+
+    def expire(self, key: str):
+        """Remove a spilled session, and tell anyone listening"""
+        self.remove(key)
+        self.expirations += 1
+        for listener in self.on_expire:
+            listener(key)
+
+    def rehydrated(self, key: str, seconds: float):
+        self.rehydrations += 1
+        self.rehydrate_seconds += seconds
+        self.rehydrate_max_seconds = max(self.rehydrate_max_seconds, seconds)
+
+    def reload(self, old: Machine, new: Machine) -> Dict[str, List[str]]:
+        """
+        Move every session playing `old` over to `new`, a new version of the
+        same game. Returns, for each session, the addresses of the states it
+        was in (or had parked) which have gone.
+        """
+        return {key: server.reload(new) for key, server in self._servers.items()
+                if server._started and server._machine is old}
+
+    def remove(self, key: str):
+        """Forget a session entirely"""
+        self._resident.pop(key, None)
+        self._spilled.pop(key, None)
+        server = self._servers.pop(key, None)
+        if server is not None:
+            server._discard_spill()
+
+    def metrics(self) -> dict:
+        return {
+            "sessions": len(self._servers),
+            "resident": len(self._resident),
+            "spilled": len(self._spilled),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "unspillable": self.unspillable,
+            "rehydrations": self.rehydrations,
+            "rehydrate_seconds_total": self.rehydrate_seconds,
+            "rehydrate_seconds_max": self.rehydrate_max_seconds,
+            "rehydrate_seconds_mean": (self.rehydrate_seconds / self.rehydrations
+                                       if self.rehydrations else 0.0)
+        }
+
+_registry = SessionRegistry()
+_registry.get("default")
 
 def get_game_server(key:str="default"):
     """
     Return an instance of a game server, which lets clients
     then run the game.
     """
-    if key not in _server:
-        _server[key] = GameServer()
-    return _server[key]
+    return _registry.get(key)
+
+def get_registry() -> SessionRegistry:
+    """The registry behind `get_game_server`"""
+    return _registry
@@ -0,0 +1,347 @@
+"""
+A headless, asyncio game host, so many players can play many games from one
+process without a Textual app apiece.
+
+Every game is parsed once and its `Machine` is shared by all of its sessions;
+each session is just a `GameServer` in our `SessionRegistry`. Network input
+is ticked by a `TickScheduler`, so sessions take turns.
+
+Two protocols are offered:
+
+Line-oriented TCP. Each line is an input for the current session, and each
+response is one line of JSON. Sessions started over a connection end when it
+closes. Lines starting with `/` are commands:
+    /games              list the games we can host
+    /play <game>        start a new session of a game
+    /resume <session>   pick up an existing session
+    /quit               close the connection
+
+HTTP/JSON, for clients which would rather not hold a connection open:
+    GET    /games
+    GET    /metrics
+    POST   /sessions              {"game": "example"}
+    POST   /sessions/<session>    {"input": "go north"}
+    DELETE /sessions/<session>
+"""
+import asyncio
+import json
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Mapping, Set, Tuple
+from .game_cache import load_game, DEFAULT_CACHE_DIR
+from .game_server import GameServer, SessionRegistry
+from .catalog import GameCatalog
+from .loader import GameYAMLError
+from .parser import parse
+from .print_helper import statify, compile_template
+from .scheduler import TickScheduler
+from .states import Machine, Statebag
+
+# the longest line (or HTTP body) we'll accept from a client
+MAX_LINE = 64 * 1024
+
+
+@dataclass
+class HostedGame:
+    """A parsed game, shared by every session playing it"""
+    name: str
+    title: str
+    machine: Machine
+    state_bag: Statebag
+
+
+class GameLibrary:
+    """
+    The games in a games directory, each loaded and parsed the first time
+    someone wants to play it. Games that fail `check_game` are refused.
+    """
+    def __init__(self, path: Path | str, cache_dir: Path | None = DEFAULT_CACHE_DIR,
+                 optimize: bool = False):
+        self.path = Path(path).resolve()
+        self.cache_dir = cache_dir
+        self.optimize = optimize
+        self._games: Dict[str, HostedGame] = {}
+        self._catalog = GameCatalog(self.path, cache_dir)
+
+    def names(self):
+        return [entry.path.name for entry in self._catalog.refresh()]
+
+    def get(self, name: str) -> HostedGame:
+        if name not in self._games:
+            root = (self.path / name).resolve()
+            if root.parent != self.path or not (root / "manifest.yaml").exists():
+                raise KeyError(name)
+            machine, state_bag, title = parse(load_game(root, self.cache_dir, check=True),
+                                              self.optimize)
+            self._games[name] = HostedGame(name, title, machine, state_bag)
+        return self._games[name]
+
+
+def render(session: str, server: GameServer, tick: Machine.StepResult | None,
+           bag: Mapping) -> dict:
+    """Describe the result of a tick the way a client needs to display it"""
+    if tick is None:
+        state = server.current()
+        action = None
+        transient = None
+        message = None
+    else:
+        state = tick.state
+        action = tick.action.name
+        transient = tick.transient
+        message = tick.additionalMessages
+    return {
+        "session": session,
+        "action": action,
+        "state": state.tag,
+        "banners": {level: statify(str(bag.get(f"{level}.banner", "")), bag) # type: ignore
+                    for level in ("state", "sub", "trans")},
+        "description": compile_template(state.description()).render(bag), # type: ignore
+        "substates": [statify(s, bag) for s in server.substates()], # type: ignore
+        "transient": (compile_template(transient.description()).render(bag) # type: ignore
+                      if transient else None),
+        "message": message,
+        "ended": tick is not None and tick.action == Machine.Result.End
+    }
+
+
+class GameHost:
+    """
+    Hosts many concurrent sessions of many games.
+    """
+    class UnknownSession(Exception):
+        pass
+
+    def __init__(self, library: GameLibrary, registry: SessionRegistry | None = None,
+                 idle_timeout: float = 300, max_connections: int = 10000,
+                 scheduler: TickScheduler | None = None):
+        self.library = library
+        self.registry = registry if registry is not None else SessionRegistry()
+        self.scheduler = scheduler if scheduler is not None else TickScheduler()
+        # which game each session is playing
+        self._games: Dict[str, str] = {}
+        self.registry.on_expire.append(self._forget)
+        self.idle_timeout = idle_timeout
+        self._connections = asyncio.Semaphore(max_connections)
+        self.connections = 0
+        self.rejected = 0
+        self.ticks = 0
+
+    def new_session(self, game: str) -> dict:
+        hosted = self.library.get(game)
+        session = uuid.uuid4().hex
+        server = self.registry.get(session)
+        server.start(hosted.machine, hosted.state_bag)
+        self._games[session] = game
+        return render(session, server, None, server.view())
+
+    def resume(self, session: str) -> dict:
+        server = self._server(session)
+        return render(session, server, None, server.view())
+
+    def play(self, session: str, inp: str) -> dict:
+        """Tick a session immediately"""
+        server = self._server(session)
+        tick, bag = server.tick(inp, self.scheduler.budget)
+        self.ticks += 1
+        return render(session, server, tick, bag)
+
+    async def submit(self, session: str, inp: str) -> dict:
+        """Tick a session when the scheduler gets to it"""
+        server = self._server(session)
+        # render as soon as we've ticked, before another tick can change the session
+        response = await self.scheduler.submit(
+            self._games[session], session, server, inp,
+            lambda tick, bag: render(session, server, tick, bag))
+        self.ticks += 1
+        return response
+
+    def end_session(self, session: str):
+        self._server(session)
+        self.registry.remove(session)
+        self._forget(session)
+
+    def _forget(self, session: str):
+        self._games.pop(session, None)
+
+    def _server(self, session: str) -> GameServer:
+        if session not in self.registry:
+            raise GameHost.UnknownSession(session)
+        return self.registry.get(session)
+
+    def metrics(self) -> dict:
+        return self.registry.metrics() | {
+            "connections": self.connections,
+            "rejected_connections": self.rejected,
+            "ticks": self.ticks,
+            "games": self.scheduler.report()
+        }
+
+    async def _admit(self, writer: asyncio.StreamWriter) -> bool:
+        """Apply backpressure: refuse connections once we're at capacity"""
+        if self._connections.locked():
+            self.rejected += 1
+            writer.close()
+            return False
+        await self._connections.acquire()
+        self.connections += 1
+        return True
+
+    def _release(self):
+        self.connections -= 1
+        self._connections.release()
+
+    async def _readline(self, reader: asyncio.StreamReader) -> bytes:
+        return await asyncio.wait_for(reader.readline(), self.idle_timeout)
+
+    async def _line_command(self, session: str | None, line: str,
+                            started: Set[str]) -> Tuple[str | None, dict | None]:
+        """
+        Handle one line of the TCP protocol, returning the session and the
+        response. Any session we start is added to `started`.
+        """
+        try:
+            if line.startswith("/"):
+                command, _, arg = line[1:].partition(" ")
+                command = command.lower()
+                if command == "games":
+                    return session, {"games": self.library.names()}
+                if command == "play":
+                    response = self.new_session(arg.strip())
+                    started.add(response["session"])
+                    return response["session"], response
+                if command == "resume":
+                    return arg.strip(), self.resume(arg.strip())
+                if command == "quit":
+                    return session, None
+                return session, {"error": f"Unknown command: {command}"}
+            if session is None:
+                return session, {"error": "No game in progress. Try /play <game>"}
+            return session, await self.submit(session, line)
+        except KeyError as ex:
+            return session, {"error": f"Unknown game: {ex.args[0]}"}
+        except GameHost.UnknownSession as ex:
+            return None, {"error": f"Unknown session: {ex.args[0]}"}
+        except (GameYAMLError, ValueError) as ex:
+            return session, {"error": f"Broken game: {ex}"}
+
+    async def handle_lines(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one TCP connection"""
+        if not await self._admit(writer):
+            return
+        session = None
+        started: Set[str] = set()
+        try:
+            while True:
+                raw = await self._readline(reader)
+                if not raw:
+                    break
+                session, response = await self._line_command(
+                    session, raw.decode().rstrip("\r\n"), started)
+                if response is None:
+                    break
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError,
+                ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            for s in started:
+                self.registry.remove(s)
+                self._forget(s)
+            self._release()
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: dict) -> Tuple[int, dict]:
+        """Handle one HTTP request"""
+        parts = [p for p in path.split("?")[0].split("/") if p]
+        try:
+            if method == "GET" and parts == ["games"]:
+                return 200, {"games": self.library.names()}
+            if method == "GET" and parts == ["metrics"]:
+                return 200, self.metrics()
+            if method == "POST" and parts == ["sessions"]:
+                return 201, self.new_session(str(body.get("game", "")))
+            if len(parts) == 2 and parts[0] == "sessions":
+                if method == "POST":
+                    return 200, await self.submit(parts[1], str(body.get("input", "")))
+                if method == "GET":
+                    return 200, self.resume(parts[1])
+                if method == "DELETE":
+                    self.end_session(parts[1])
+                    return 200, {"session": parts[1], "ended": True}
+            return 404, {"error": "Not found"}
+        except KeyError as ex:
+            return 404, {"error": f"Unknown game: {ex.args[0]}"}
+        except GameHost.UnknownSession as ex:
+            return 404, {"error": f"Unknown session: {ex.args[0]}"}
+        except (GameYAMLError, ValueError) as ex:
+            return 500, {"error": f"Broken game: {ex}"}
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one HTTP/1.1 connection, with keep-alive"""
+        if not await self._admit(writer):
+            return
+        try:
+            while True:
+                request = await self._readline(reader)
+                if not request:
+                    break
+                method, path, version = request.decode().split()
+                headers = {}
+                while True:
+                    line = (await self._readline(reader)).decode().strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_LINE:
+                    status, response = 413, {"error": "Request too large"}
+                    keep_alive = False
+                else:
+                    raw = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout)
+                    try:
+                        body = json.loads(raw) if raw else {}
+                        status, response = await self._route(method.upper(), path, body)
+                    except (json.JSONDecodeError, AttributeError):
+                        status, response = 400, {"error": "Bad request"}
+                    keep_alive = (headers.get("connection", "").lower() != "close"
+                                  and version == "HTTP/1.1")
+                payload = json.dumps(response).encode()
+                writer.write(
+                    f"{version} {status} {_REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                    + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError, ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            self._release()
+            writer.close()
+
+
+_REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found",
+            413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+async def serve(host: GameHost, address: str = "127.0.0.1", port: int | None = 7777,
+                http_port: int | None = None):
+    """Run the host's TCP and/or HTTP servers until cancelled"""
+    servers = []
+    if port is not None:
+        servers.append(await asyncio.start_server(host.handle_lines, address, port,
+                                                  limit=MAX_LINE))
+    if http_port is not None:
+        servers.append(await asyncio.start_server(host.handle_http, address, http_port,
+                                                  limit=MAX_LINE))
+    for s in servers:
+        for sock in s.sockets:
+            print(f"Serving on {sock.getsockname()}")
+    await asyncio.gather(*(s.serve_forever() for s in servers))
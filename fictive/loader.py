@@ -1,25 +1,258 @@
+"""
+Load games from their YAML.
+
+Each file in a game's manifest is parsed on its own (several at once, in
+worker processes, for big games), and the results are cached by path and
+modification time, so changing one file only re-parses that file. Anchors
+can still be used across files: an alias to an anchor from an earlier file
+is left as a placeholder, and filled in when we merge the files together,
+in manifest order. So is a merge key (`<<: *base`) naming such an anchor.
+"""
 from ruamel.yaml import YAML
+from ruamel.yaml.composer import Composer
+from ruamel.yaml.constructor import SafeConstructor
+from ruamel.yaml.error import MarkedYAMLError
+from ruamel.yaml.events import AliasEvent
+from ruamel.yaml.nodes import MappingNode, ScalarNode, SequenceNode
+from ruamel.yaml.tag import Tag
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from contextlib import ExitStack
-from typing import List, Iterator, Tuple
-from dataclasses import dataclass
-from sys import stderr
+from typing import Dict, List, Iterator, Tuple
+from dataclasses import dataclass, field
 
 yaml=YAML(typ='safe')   # default
 
-def merge_game_yaml(root: Path, mfest:dict) -> str:
+# the tag of a placeholder for an alias to another file's anchor
+ALIAS_TAG = "tag:fictive,2024:alias"
+# where a mapping keeps the sources of a merge key that refers to another file,
+# until the files are merged
+MERGE_KEY = "_merge"
+# parse files in worker processes when there's at least this much to parse
+PARALLEL_BYTES = 256 * 1024
+
+
+class GameYAMLError(Exception):
+    """A game's YAML couldn't be loaded. The message says which file, and where."""
+    pass
+
+
+@dataclass
+class Alias:
+    """A placeholder for an alias to an anchor defined in another file"""
+    name: str
+    line: int
+
+
+@dataclass
+class ParsedFile:
+    """One of a game's files, parsed, with its anchors (by name)"""
+    name: str
+    data: object
+    anchors: Dict[str, object] = field(default_factory=dict)
+
+
+class FileComposer(Composer):
+    """
+    Composes a file on its own, leaving aliases to anchors it doesn't define
+    as placeholders.
+    """
+    def compose_node(self, parent, index):
+        if self.parser.check_event(AliasEvent):
+            event = self.parser.peek_event()
+            if event.anchor not in self.anchors:
+                self.parser.get_event()
+                return ScalarNode(Tag(suffix=ALIAS_TAG), event.anchor,
+                                  event.start_mark, event.end_mark)
+        return super().compose_node(parent, index)
+
+
+class SourceConstructor(SafeConstructor):
+    """
+    Tags each state and transition entry with the file and line it came from,
+    as `_source: "file.yaml:12"`, and remembers what each anchor refers to.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name: str | None = None
+        self.anchored: Dict[str, object] = {}
+        # mapping nodes whose merge key has to wait for other files' anchors
+        self.merges: Dict[MappingNode, list] = {}
+
+    def _waits(self, node) -> bool:
+        return (isinstance(node, ScalarNode) and node.tag == ALIAS_TAG) or node in self.merges
+
+    def flatten_mapping(self, node):
+        for index, (key_node, value_node) in enumerate(node.value):
+            if key_node.tag != 'tag:yaml.org,2002:merge':
+                continue
+            if isinstance(value_node, SequenceNode):
+                sources = list(value_node.value)
+            else:
+                sources = [value_node]
+            for source in sources:
+                if isinstance(source, MappingNode):
+                    self.flatten_mapping(source)
+            if any(self._waits(source) for source in sources):
+                del node.value[index]
+                self.merges[node] = sources
+            break
+        super().flatten_mapping(node)
+
+    def construct_object(self, node, deep=False):
+        data = super().construct_object(node, deep)
+        if node.anchor is not None:
+            self.anchored[node.anchor] = data
+        return data
+
+    def construct_alias(self, node):
+        return Alias(node.value, node.start_mark.line + 1)
+
+    def construct_yaml_map(self, node):
+        data = {}
+        yield data
+        data.update(self.construct_mapping(node))
+        if node in self.merges:
+            data[MERGE_KEY] = [self.construct_object(source) for source in self.merges[node]]
+        if self.name and (("tag" in data and "description" in data)
+                          or ("to" in data and "condition" in data)):
+            data["_source"] = f"{self.name}:{node.start_mark.line + 1}"
+
+SourceConstructor.add_constructor('tag:yaml.org,2002:map', SourceConstructor.construct_yaml_map)
+SourceConstructor.add_constructor(ALIAS_TAG, SourceConstructor.construct_alias)
+
+
+def parse_game_file(name: str, text: str) -> ParsedFile:
+    """Parse one of a game's files, reporting errors against that file"""
+    game_yaml = YAML(typ='safe')
+    game_yaml.Composer = FileComposer
+    game_yaml.Constructor = SourceConstructor
+    game_yaml.constructor.name = name
+    try:
+        data = game_yaml.load(text)
+    except MarkedYAMLError as ex:
+        mark = ex.problem_mark or ex.context_mark
+        where = f"{name}:{mark.line + 1}" if mark is not None else name
+        bad_line = text.split("\n")[mark.line].strip() if mark is not None else ""
+        raise GameYAMLError(f"{where}: {ex.problem or ex.context}: {bad_line}") from None
+    except Exception as ex:
+        raise GameYAMLError(f"{name}: {ex}") from None
+    return ParsedFile(name, data, game_yaml.constructor.anchored)
+
+
+def _parse_path(name: str, path: Path) -> ParsedFile:
+    return parse_game_file(name, path.read_text())
+
+
+# parsed files, by path, with the modification time and size they were parsed at
+_parsed: Dict[Path, Tuple[int, int, ParsedFile]] = {}
+_parsed_lock = threading.Lock()
+
+
+def clear_parse_cache():
+    with _parsed_lock:
+        _parsed.clear()
+
+
+def parse_game_files(root: Path, mfest: dict, jobs: int | None = None) -> List[ParsedFile]:
+    """
+    Parse every file in a game's manifest, re-using earlier results for files
+    which haven't changed. If there's enough to parse, it's spread across
+    `jobs` processes (by default, one per core).
     """
-    By reading the manifest, load all the files in that manifest and
-    merge them into a single string so we can parse it in YAML.
+    paths = [(entry, root / entry) for entry in mfest["files"]]
+    stats = {}
+    for entry, path in paths:
+        try:
+            stat = path.stat()
+        except OSError as ex:
+            raise GameYAMLError(f"{entry}: {ex.strerror}") from None
+        stats[entry] = (stat.st_mtime_ns, stat.st_size)
+    with _parsed_lock:
+        found = {entry: cached[2] for entry, path in paths
+                 if (cached := _parsed.get(path)) and cached[:2] == stats[entry]
+                 and cached[2].name == entry}
+    stale = [(entry, path) for entry, path in paths if entry not in found]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if len(stale) > 1 and jobs > 1 and sum(stats[e][1] for e, _ in stale) >= PARALLEL_BYTES:
+        with ProcessPoolExecutor(min(jobs, len(stale))) as pool:
+            fresh = list(pool.map(_parse_path, *zip(*stale)))
+    else:
+        fresh = [_parse_path(entry, path) for entry, path in stale]
+    with _parsed_lock:
+        for (entry, path), parsed in zip(stale, fresh):
+            _parsed[path] = stats[entry] + (parsed,)
+            found[entry] = parsed
+    return [found[entry] for entry, _ in paths]
+
+
+def _resolve(obj, anchors: Dict[str, object], memo: Dict[int, object], name: str):
     """
+    A copy of `obj` with its placeholders replaced by the (already resolved)
+    anchors they refer to. Copying keeps the cached files untouched, and
+    `memo` keeps anything shared within a file shared in the copy.
+    """
+    if isinstance(obj, Alias):
+        if obj.name not in anchors:
+            raise GameYAMLError(f"{name}:{obj.line}: found undefined alias {obj.name!r}")
+        return anchors[obj.name]
+    if not isinstance(obj, (dict, list)):
+        return obj
+    if id(obj) in memo:
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        mapping: dict = {}
+        memo[id(obj)] = mapping
+        # keys from earlier merge sources win over later ones, and our own over all of them
+        for source in reversed(obj.get(MERGE_KEY, ())):
+            merged = _resolve(source, anchors, memo, name)
+            if not isinstance(merged, dict):
+                where = f"{name}:{source.line}" if isinstance(source, Alias) else name
+                raise GameYAMLError(f"{where}: expected a mapping for merging")
+            mapping.update(merged)
+        mapping.update((k, _resolve(v, anchors, memo, name)) for k, v in obj.items()
+                       if k != MERGE_KEY)
+        return mapping
+    sequence: list = []
+    memo[id(obj)] = sequence
+    sequence.extend(_resolve(v, anchors, memo, name) for v in obj)
+    return sequence
+
 
-    files = [root / entry for entry in mfest["files"]]
-    with ExitStack() as stack:
-        read_from = [stack.enter_context(
-            entry.open()).read() for entry in files]
-    merged = "\n".join(read_from)
+def merge_game_files(files: List[ParsedFile]) -> dict:
+    """
+    Merge a game's parsed files, in manifest order, into one document. An
+    alias to another file's anchor refers to the last file before it which
+    defined that anchor, just as if the files had been one big YAML file.
+    """
+    anchors: Dict[str, object] = {}
+    merged: dict = {}
+    defined_in: Dict[str, str] = {}
+    for parsed in files:
+        memo: Dict[int, object] = {}
+        data = _resolve(parsed.data, anchors, memo, parsed.name)
+        for anchor, target in parsed.anchors.items():
+            anchors[anchor] = _resolve(target, anchors, memo, parsed.name)
+        if data is None:
+            continue
+        if not isinstance(data, dict):
+            raise GameYAMLError(f"{parsed.name}: a game file must be a mapping")
+        for key, value in data.items():
+            if key in merged:
+                raise GameYAMLError(f"{parsed.name}: {key!r} is already defined "
+                                    f"in {defined_in[key]}")
+            merged[key] = value
+            defined_in[key] = parsed.name
     return merged
 
+
+def source_file(entry: dict) -> str | None:
+    """The manifest file a state or transition entry was loaded from"""
+    source = entry.get("_source")
+    return source.rpartition(":")[0] if source else None
+
 def load_manifest(manifest:Path)->dict:
     if not manifest.exists():
         raise Exception("Invalid Game Directory")
@@ -32,21 +265,15 @@ def load_test(test_path:Path|str)->dict:
     with p.open() as f:
         return yaml.load(f)
 
-def load_game_yaml(gameInstance: Path | str):
+def load_game_yaml(gameInstance: Path | str, jobs: int | None = None):
     """
     Load a game from a directory, by scanning the `files` 
-    entry in the manifest.
+    entry in the manifest. Raises a `GameYAMLError` if the YAML is broken.
     """
     root = Path(gameInstance).resolve()
     manifest = root / "manifest.yaml"
     mfest = load_manifest(manifest)
-    merged = merge_game_yaml(root, mfest)
-    try:
-        loaded = yaml.load(merged)
-    except Exception as ex:
-        print("Failed to load game, YAML error: ", file=stderr)
-        bad_line = merged.split('\n')[ex.problem_mark.line]
-        print(f"\t{ex.problem}: {bad_line}", file=stderr)
+    loaded = merge_game_files(parse_game_files(root, mfest, jobs))
     return loaded | mfest
 
 @dataclass
@@ -57,6 +284,14 @@ class GameListEntry:
     author:str
     path:Path
 
+def game_list_entry(mfest: dict, root: Path) -> GameListEntry:
+    """The picker's view of a game, from its manifest"""
+    return GameListEntry(
+        mfest.get("title", "A Game"), 
+        mfest.get("slug", "Slug for a game"), 
+        mfest.get("author", "Anonymous"),
+        root)
+
 def load_manifest_yaml(gameInstance: Path | str)->GameListEntry:
     """
     Read the manifest for a game, grabbing its 
@@ -67,11 +302,7 @@ def load_manifest_yaml(gameInstance: Path | str)->GameListEntry:
     if manifest.exists():
         with manifest.open() as f:
             loaded = yaml.load(f)
-        return GameListEntry(
-            loaded.get("title", "A Game"), 
-            loaded.get("slug", "Slug for a game"), 
-            loaded.get("author", "Anonymous"),
-            root)
+        return game_list_entry(loaded, root)
     else:
         raise Exception("Not a valid game directory")
 
@@ -0,0 +1,87 @@
+"""
+A load-test client for the line protocol in `host`.
+
+Opens many concurrent connections, starts a game on each, and plays a script
+of inputs round and round, reporting throughput and response latency:
+
+    python -m fictive.loadtest example --clients 1000 --rounds 20 \\
+        --inputs "go north" "go south"
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import List
+from .scheduler import percentile
+
+
+async def play(address: str, port: int, game: str, inputs: List[str], rounds: int,
+               latencies: List[float], errors: List[str]):
+    """One simulated player"""
+    try:
+        reader, writer = await asyncio.open_connection(address, port)
+    except OSError as ex:
+        errors.append(str(ex))
+        return
+    try:
+        for line in [f"/play {game}"] + inputs * rounds:
+            begin = time.perf_counter()
+            writer.write(line.encode() + b"\n")
+            await writer.drain()
+            raw = await reader.readline()
+            if not raw:
+                errors.append("Connection closed by host")
+                return
+            latencies.append(time.perf_counter() - begin)
+            response = json.loads(raw)
+            if "error" in response:
+                errors.append(response["error"])
+                return
+        writer.write(b"/quit\n")
+        await writer.drain()
+    except (OSError, ValueError) as ex:
+        errors.append(str(ex))
+    finally:
+        writer.close()
+
+
+async def run(address: str, port: int, game: str, inputs: List[str], clients: int,
+              rounds: int) -> dict:
+    latencies: List[float] = []
+    errors: List[str] = []
+    begin = time.perf_counter()
+    await asyncio.gather(*(play(address, port, game, inputs, rounds, latencies, errors)
+                           for _ in range(clients)))
+    elapsed = time.perf_counter() - begin
+    latencies.sort()
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_mean": statistics.fmean(latencies) if latencies else 0.0,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Fictive load test",
+        description="Play many concurrent sessions against a Fictive host"
+    )
+    parser.add_argument("game", type=str, help="The game to play")
+    parser.add_argument("--address", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--clients", type=int, default=100,
+                        help="How many players to connect at once")
+    parser.add_argument("--rounds", type=int, default=10,
+                        help="How many times each player repeats the inputs")
+    parser.add_argument("--inputs", type=str, nargs="+", default=["look"],
+                        help="The inputs each player sends")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.address, args.port, args.game, args.inputs,
+                                     args.clients, args.rounds)), indent=2))
@@ -6,9 +6,19 @@ import io
 from fictive.states import *
 from fictive.triggers import *
 from functools import partial
-from typing import Dict, Callable, Iterable
+from typing import Dict, Callable, Iterable, List
 from itertools import chain
 
+def _parse_all(*entries):
+    """`all` takes a list of nested function entries"""
+    return on_all(*[parse_function(e) for e in entries])
+
+
+def _parse_any(*entries):
+    """`any` takes a list of nested function entries"""
+    return on_any(*[parse_function(e) for e in entries])
+
+
 # convert commands in YAML to functions in Python
 # the more verbose ones are in here as legacy support
 # (for just me, but I've already built some code which uses them),
@@ -21,10 +31,10 @@ TRIGGER_MAP: Dict[str, Callable] = {
     "on_key": on_key,
     "tag": on_tag,
     "eq": on_key,
-    "on_all": on_all,
-    "all": on_all,
-    "on_any": on_any,
-    "any": on_any,
+    "on_all": _parse_all,
+    "all": _parse_all,
+    "on_any": _parse_any,
+    "any": _parse_any,
     "revert": do_enter_revert,
     "on_gt": on_key_gt,
     "gt": on_key_gt,
@@ -88,16 +98,18 @@ def parse_trigger(tag: str, state_desc: dict):
         section = state_desc[tag]
         if isinstance(section, list):
             fs = [parse_function(f) for f in section]
-            return on_all(*fs)
+            return do_all(*fs)
         return parse_function(section)
-    return lambda a, b, c: None
+    return None
 
 
-def parse_state(state_desc: dict):
+def parse_state(state_desc: dict, optimize: bool = False):
     """
     Read a state entry out of the file, and construct a state object.
 
-    Allows for sub-state machines embedded within this state.
+    Allows for sub-state machines embedded within this state. Those aren't
+    parsed until a player first enters the state; use `check_game` to find
+    mistakes in them up front.
     """
     tag = state_desc["tag"]
     descr = state_desc["description"]
@@ -105,9 +117,11 @@ def parse_state(state_desc: dict):
     on_exit = parse_trigger("on_exit", state_desc)
     sub_machine = None
     if "sub_machine" in state_desc:
-        sub_machine = parse_machine(state_desc["sub_machine"])
+        entry = state_desc["sub_machine"]
+        sub_machine = LazyMachine(partial(parse_machine, entry, optimize),
+                                  partial(machine_ir, entry))
     # todo, add support for linking submachines
-    return State(tag, descr, on_enter, on_exit, sub_machine)
+    return State(tag, descr, on_enter, on_exit, sub_machine, state_desc.get("_source"))
 
 def _flatten(l: Iterable) -> Iterable:
     """
@@ -129,7 +143,10 @@ def _peel(obj: dict, key: str):
 
 def parse_condition(entry: dict):
     on_handler = _peel(entry, "condition")
-    if isinstance(on_handler, list):
+    if isinstance(on_handler, list) and len(on_handler) == 1:
+        # a list of one condition is just that condition
+        on_cbk = parse_function(on_handler[0])
+    elif isinstance(on_handler, list):
         fs = [parse_function(f) for f in on_handler]
         on_cbk = on_all(*fs)
     else:
@@ -137,17 +154,55 @@ def parse_condition(entry: dict):
     return on_cbk
 
 
-def parse_transition(entry: dict, machine: MachineDesc, is_global=False):
+class ParseCache:
+    """
+    Remembers the states and conditions built by `parse`, so parsing a new
+    version of the same game only rebuilds the entries which changed. A state
+    is reused (sub-machine and all) only if its whole entry, including where
+    it came from, is the same. After each `parse`, anything it didn't use is
+    forgotten.
+    """
+    def __init__(self):
+        self.states: Dict[str, State] = {}
+        self.conditions: Dict[str, TransitionCallback] = {}
+        self._used_states: Dict[str, State] = {}
+        self._used_conditions: Dict[str, TransitionCallback] = {}
+        self.reused = 0
+
+    def state(self, state_desc: dict, optimize: bool) -> State:
+        key = repr((optimize, state_desc))
+        state = self.states.get(key)
+        if state is None:
+            state = parse_state(state_desc, optimize)
+        else:
+            self.reused += 1
+        self._used_states[key] = state
+        return state
+
+    def condition(self, entry: dict) -> TransitionCallback:
+        key = repr(entry)
+        condition = self.conditions.get(key)
+        if condition is None:
+            condition = parse_condition(entry)
+        self._used_conditions[key] = condition
+        return condition
+
+    def sweep(self):
+        self.states, self._used_states = self._used_states, {}
+        self.conditions, self._used_conditions = self._used_conditions, {}
+
+
+def parse_transition(entry: dict, machine: MachineDesc, is_global=False,
+                     cache: ParseCache | None = None):
     """
     Parse a transition and add it to a machine description. `is_global` creates a global
     transition which can apply anywhere.
     """
-    on_handler = entry["condition"]
-    on_cbk = parse_condition(entry)
+    on_cbk = parse_condition(entry) if cache is None else cache.condition(entry)
     if not is_global:
-        machine.link(entry["from"], entry["to"], on_cbk)
+        machine.link(entry["from"], entry["to"], on_cbk, entry.get("_source"))
     else:
-        machine.global_link(entry["to"], on_cbk)
+        machine.global_link(entry["to"], on_cbk, entry.get("_source"))
 
 
 def _handle_section(section: Iterable, handler: Callable) -> None:
@@ -156,32 +211,45 @@ def _handle_section(section: Iterable, handler: Callable) -> None:
         handler(s)
 
 
-def parse_machine(entry: dict):
+def _optimize_conditions(conditions):
+    return combine_matches([optimize(c) if isinstance(c, Node) else c
+                            for c in conditions])
+
+
+def parse_machine(entry: dict, optimize: bool = False, cache: ParseCache | None = None):
     """
     Parse a machine entry. This creates all the states and transitions required for the machine
     to execute.
+
+    With `optimize`, transition conditions are reordered so cheap checks run first. With a
+    `cache`, states and conditions which haven't changed since the last parse are reused.
     """
     desc = MachineDesc()
     state_entries = _flatten(entry["states"])
     transitions = _flatten(entry["transitions"])
     global_trans = _flatten(entry.get("global_transitions", []))
+    if cache is None:
+        make_state = lambda s: parse_state(_peel(s, "state"), optimize)
+    else:
+        make_state = lambda s: cache.state(_peel(s, "state"), optimize)
     _handle_section(state_entries,
-                    lambda s: desc.add_state(parse_state(_peel(s, "state"))))
+                    lambda s: desc.add_state(make_state(s)))
     _handle_section(transitions,
-                    lambda t: parse_transition(_peel(t, "transition"), desc))
+                    lambda t: parse_transition(_peel(t, "transition"), desc, cache=cache))
     _handle_section(global_trans,
-                    lambda g: parse_transition(_peel(g, "transition"), desc, True))
+                    lambda g: parse_transition(_peel(g, "transition"), desc, True, cache))
     start_tag = entry["startTag"]
     if "endTag" in entry:
         end_tag = entry["endTag"]
     else:
         end_tag = ""
+    desc.freeze(_optimize_conditions if optimize else combine_matches)
     return Machine(desc, start_tag, end_tag)
 
 
-def parse(entry: list):
+def parse(entry: dict, optimize: bool = False, cache: ParseCache | None = None):
     """
-    Parse a yaml file. We expect a YAML array of dicts. The two sub-dicts we care about are 
+    Parse a loaded (or compiled) game. The two sub-dicts we care about are
     "exectue"- the machine definition we want to run, and "state_bag", the initial dictionary for
     the game.
     """
@@ -189,10 +257,176 @@ def parse(entry: list):
     title = "A Fictive Game"
     if "execute" in entry:
         main_entry = entry["execute"]
-        machine = parse_machine(main_entry)
+        machine = parse_machine(main_entry, optimize, cache)
+        if cache is not None:
+            cache.sweep()
     if "state_bag" in entry:
         state_bag = entry["state_bag"]
     if "title" in entry:
         title = entry["title"]
 
     return machine, state_bag, title
+
+
+# bump this whenever the shape of the compiled representation changes
+IR_VERSION = 2
+
+
+def compile_function(entry):
+    """
+    Normalize a function entry into its canonical form: either a bare,
+    lower-cased name, or a single-key dict of the lower-cased name to its args.
+    """
+    if isinstance(entry, dict):
+        fname = list(entry.keys())[0]
+        return {fname.lower(): entry[fname]}
+    return entry.lower()
+
+
+def _compile_functions(section):
+    if isinstance(section, list):
+        return [compile_function(f) for f in section]
+    return compile_function(section)
+
+
+def compile_state(state_desc: dict) -> dict:
+    """The compiled form of a state entry"""
+    compiled = {"tag": state_desc["tag"],
+                "description": state_desc["description"]}
+    for trigger in ("on_enter", "on_exit"):
+        if trigger in state_desc:
+            compiled[trigger] = _compile_functions(state_desc[trigger])
+    if "sub_machine" in state_desc:
+        compiled["sub_machine"] = compile_machine(state_desc["sub_machine"])
+    if "_source" in state_desc:
+        compiled["_source"] = state_desc["_source"]
+    return compiled
+
+
+def compile_transition(entry: dict, is_global=False) -> dict:
+    """The compiled form of a transition entry"""
+    on_handler = _peel(entry, "condition")
+    if isinstance(on_handler, list) and len(on_handler) == 1:
+        on_handler = on_handler[0]
+    compiled = {"to": entry["to"], "condition": _compile_functions(on_handler)}
+    if not is_global:
+        compiled["from"] = entry["from"]
+    if "_source" in entry:
+        compiled["_source"] = entry["_source"]
+    return compiled
+
+
+def compile_machine(entry: dict) -> dict:
+    """
+    Flatten and normalize a machine entry into plain data: states, transitions, 
+    and the names and args of their triggers. `parse_machine` accepts this form
+    just like it accepts the YAML, but it's cheap to store and reload.
+    """
+    return {
+        "startTag": entry["startTag"],
+        "endTag": entry.get("endTag", ""),
+        "states": [compile_state(_peel(s, "state"))
+                   for s in _flatten(entry["states"])],
+        "transitions": [compile_transition(_peel(t, "transition"))
+                        for t in _flatten(entry["transitions"])],
+        "global_transitions": [compile_transition(_peel(g, "transition"), True)
+                               for g in _flatten(entry.get("global_transitions", []))]
+    }
+
+
+def strip_sources(ir):
+    """A copy of some IR without its `_source` entries, so it doesn't change when lines move"""
+    if isinstance(ir, dict):
+        return {k: strip_sources(v) for k, v in ir.items() if k != "_source"}
+    if isinstance(ir, list):
+        return [strip_sources(v) for v in ir]
+    return ir
+
+
+def machine_ir(entry: dict) -> dict:
+    """
+    The compiled form of a machine entry, without the source locations: how
+    an unbuilt sub-machine describes itself for the game's fingerprint.
+    """
+    return strip_sources(compile_machine(entry))
+
+
+def compile_game(entry: dict) -> dict:
+    """
+    Convert a loaded game into its compiled representation, dropping all the
+    YAML scaffolding (anchors and the like) that `parse` doesn't need.
+    """
+    compiled = {k: entry[k] for k in ("title", "slug", "author", "files", "tests", "state_bag")
+                if k in entry}
+    if "execute" in entry:
+        compiled["execute"] = compile_machine(entry["execute"])
+    return compiled
+
+
+
+def _check_functions(section, where: str, problems: List[str]):
+    for f in section if isinstance(section, list) else [section]:
+        try:
+            parse_function(f)
+        except KeyError as ex:
+            problems.append(f"{where}: unknown trigger {ex}")
+        except Exception as ex:
+            problems.append(f"{where}: bad trigger {f!r}: {ex}")
+
+
+def check_machine(entry: dict, path: str = "", problems: List[str] | None = None) -> List[str]:
+    """
+    Look for mistakes in a machine entry, and all its sub-machines, without
+    building anything: missing or duplicate tags, transitions to or from
+    nowhere, and triggers which don't exist or have the wrong arguments.
+    """
+    if problems is None:
+        problems = []
+    def where(e: dict, what: str) -> str:
+        return f"{what} ({e['_source']})" if "_source" in e else what
+
+    for section in ("startTag", "states", "transitions"):
+        if section not in entry:
+            problems.append(f"machine {path or '/'}: no {section}")
+    states = [_peel(s, "state") for s in _flatten(entry.get("states", []))]
+    tags = set()
+    for state in states:
+        tag = state.get("tag")
+        name = where(state, f"state {path}{tag}")
+        if tag is None or "description" not in state:
+            problems.append(f"{name}: states need a tag and a description")
+        if tag in tags:
+            problems.append(f"{name}: duplicate tag")
+        tags.add(tag)
+        for trigger in ("on_enter", "on_exit"):
+            if trigger in state:
+                _check_functions(state[trigger], f"{name} {trigger}", problems)
+        if "sub_machine" in state:
+            check_machine(state["sub_machine"], f"{path}{tag}/", problems)
+    for key, required in (("startTag", True), ("endTag", False)):
+        tag = entry.get(key, "")
+        if key in entry and (required or tag) and tag not in tags:
+            problems.append(f"machine {path or '/'}: {key} {tag!r} is not a state")
+    for section, is_global in (("transitions", False), ("global_transitions", True)):
+        for t in _flatten(entry.get(section, [])):
+            t = _peel(t, "transition")
+            name = where(t, f"transition {path}{t.get('from', '*')} -> {path}{t.get('to')}")
+            ends = ("to",) if is_global else ("from", "to")
+            for end in ends:
+                if t.get(end) not in tags:
+                    problems.append(f"{name}: {end} {t.get(end)!r} is not a state")
+            if "condition" not in t:
+                problems.append(f"{name}: no condition")
+            else:
+                condition = t["condition"]
+                if isinstance(condition, list) and len(condition) == 1:
+                    condition = condition[0]
+                _check_functions(condition, f"{name} condition", problems)
+    return problems
+
+
+def check_game(entry: dict) -> List[str]:
+    """Every mistake `check_machine` can find in a loaded game"""
+    if "execute" not in entry:
+        return ["the game has no execute section"]
+    return check_machine(entry["execute"])
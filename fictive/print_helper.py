@@ -1,6 +1,8 @@
 import re
 from .states import Statebag
 from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Tuple
 
 
 @dataclass
@@ -38,6 +40,119 @@ def scan_for_template(text: str) -> TemplateMatch | None:
     return None
 
 
+class Template:
+    """
+    A template string, compiled into alternating literal and key segments.
+
+    `literals` always has exactly one more entry than `keys`; rendering
+    interleaves them, starting and ending with a literal.
+    """
+    __slots__ = ("literals", "keys")
+
+    def __init__(self, literals: Tuple[str, ...], keys: Tuple[str, ...]):
+        self.literals = literals
+        self.keys = keys
+
+    def is_static(self) -> bool:
+        """A template with no keys always renders to the same text"""
+        return not self.keys
+
+    def render(self, statebag: Statebag) -> str:
+        """Fill in our keys from the statebag."""
+        if not self.keys:
+            return self.literals[0]
+        parts = [self.literals[0]]
+        for key, literal in zip(self.keys, self.literals[1:]):
+            if key in statebag:
+                parts.append(str(statebag[key]))
+            else:
+                parts.append(f"<<ERROR: {key} not in state bag>>")
+            parts.append(literal)
+        return "".join(parts)
+
+
+def _compile(text: str) -> Template:
+    """
+    Split a string into literal and key segments, in a single pass, using
+    the same escaping rules as `scan_for_template`.
+    """
+    literals = []
+    keys = []
+    last = 0
+    start = -1
+    escaped = False
+    for i, c in enumerate(text):
+        if escaped:
+            escaped = False
+            continue
+        if c == "\\":
+            escaped = True
+        if c == "{" and start < 0:
+            start = i
+        elif c == "}" and start >= 0:
+            literals.append(text[last:start])
+            keys.append(text[start+1:i])
+            last = i + 1
+            start = -1
+    literals.append(text[last:])
+    return Template(tuple(literals), tuple(keys))
+
+
+class TemplateCache:
+    """
+    A bounded LRU cache of compiled templates, keyed by their source string.
+
+    Tracks hits and misses, so we can tell if it's sized well for a game.
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Template] = OrderedDict()
+
+    def get(self, text: str) -> Template:
+        try:
+            tmpl = self._entries[text]
+        except KeyError:
+            self.misses += 1
+            tmpl = _compile(text)
+            self._entries[text] = tmpl
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return tmpl
+        self.hits += 1
+        self._entries.move_to_end(text)
+        return tmpl
+
+    def resize(self, maxsize: int):
+        """Change the bound on the cache, dropping the oldest entries if needed"""
+        self.maxsize = maxsize
+        while len(self._entries) > maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "maxsize": self.maxsize}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+template_cache = TemplateCache()
+
+
+def compile_template(text: str) -> Template:
+    """
+    Get the compiled form of a template string, from the cache if we've seen it.
+    """
+    return template_cache.get(text)
+
+
 def statify(text: str, statebag: Statebag):
     """
     Handles templating inside of state strings.
@@ -45,15 +160,4 @@ def statify(text: str, statebag: Statebag):
     Any `{someKey}` will be replaced by `someKey` from the statebag. If `somekey`
     does not exist, an error will be printed out instead.
     """
-    match = scan_for_template(text)
-    result = text  # our final output
-    working = text  # our working copy that we truncate as we work
-    while (match):
-        to_replace = working[match.start: match.end]
-        replace_with = statebag.get(
-            match.key, f"<<ERROR: {match.key} not in state bag>>")
-        # only replace one at a time, so our result and our working don't get out of sync
-        result = result.replace(to_replace, str(replace_with), 1)
-        working = working[match.end:]
-        match = scan_for_template(working)
-    return result
+    return template_cache.get(text).render(statebag)
@@ -0,0 +1,142 @@
+"""
+Opt-in profiling of game steps: which transitions and conditions a game
+spends its time on, and how long its `on_enter` and `on_exit` triggers take.
+
+Pass a `Profiler` to `Machine.step`, or set one on a `GameServer` (or on the
+`GameServer` class, for every server). Without one, stepping doesn't pay for
+any of this.
+"""
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Tuple
+from .states import Machine, State, Cursor, Statebag, TransitionCallback, callback_ir
+
+
+@dataclass
+class Counts:
+    calls: int = 0
+    fires: int = 0
+    # time spent evaluating the condition, or running the trigger
+    seconds: float = 0.0
+    # time spent taking the transition, once the condition fired
+    take_seconds: float = 0.0
+
+
+class Profiler:
+    """
+    Collects counts and timings for each entry in each state's dispatch table
+    (that is, each transition, as seen from each state it can fire in), and
+    for each state's `on_enter` and `on_exit`.
+    """
+    def __init__(self):
+        # keyed by the index in the state's dispatch table, since two entries
+        # can have equal (or even the same) conditions
+        self._conditions: Dict[Tuple[Machine, str, int], Counts] = {}
+        self._callbacks: Dict[Tuple[State, str], Counts] = {}
+
+    def clear(self):
+        self._conditions.clear()
+        self._callbacks.clear()
+
+    def condition(self, machine: Machine, tag: str, index: int, condition: TransitionCallback,
+                  current: State, inp: str, bag: Statebag) -> bool:
+        key = (machine, tag, index)
+        counts = self._conditions.get(key)
+        if counts is None:
+            counts = self._conditions[key] = Counts()
+        began = perf_counter()
+        try:
+            fired = condition(current, inp, bag)
+        finally:
+            counts.seconds += perf_counter() - began
+            counts.calls += 1
+        if fired:
+            counts.fires += 1
+        return fired
+
+    def take(self, machine: Machine, tag: str, index: int, cursor: Cursor,
+             depth: int, current: State, dest: State, dest_tag: str,
+             inp: str, bag: Statebag) -> Machine.StepResult:
+        began = perf_counter()
+        try:
+            return machine._take(cursor, depth, current, dest, dest_tag, inp, bag, self)
+        finally:
+            self._conditions[(machine, tag, index)].take_seconds += perf_counter() - began
+
+    def callback(self, state: State, kind: str, fn, s: State, inp: str, bag: Statebag):
+        key = (state, kind)
+        counts = self._callbacks.get(key)
+        if counts is None:
+            counts = self._callbacks[key] = Counts()
+        began = perf_counter()
+        try:
+            return fn(s, inp, bag)
+        finally:
+            counts.seconds += perf_counter() - began
+            counts.calls += 1
+
+    def conditions(self) -> List[dict]:
+        """Each condition which was evaluated, slowest first"""
+        rows = []
+        for (machine, tag, index), counts in self._conditions.items():
+            dispatch = machine._dispatch[tag] # type: ignore
+            transition = machine._internal.transitions(tag)[index]
+            rows.append({
+                "from": tag,
+                "to": dispatch[index][2],
+                "global": transition.orig is None,
+                "condition": callback_ir(transition.condition),
+                "source": transition.source,
+                "calls": counts.calls,
+                "fires": counts.fires,
+                "seconds": counts.seconds,
+                "take_seconds": counts.take_seconds
+            })
+        return sorted(rows, key=lambda r: -r["seconds"])
+
+    def transitions(self) -> List[dict]:
+        """Each transition (origin to destination), slowest first"""
+        totals: Dict[Tuple[str, str], dict] = {}
+        for row in self.conditions():
+            total = totals.setdefault((row["from"], row["to"]), {
+                "from": row["from"], "to": row["to"],
+                "calls": 0, "fires": 0, "seconds": 0.0})
+            total["calls"] += row["calls"]
+            total["fires"] += row["fires"]
+            total["seconds"] += row["seconds"] + row["take_seconds"]
+        return sorted(totals.values(), key=lambda r: -r["seconds"])
+
+    def callbacks(self) -> List[dict]:
+        """Each state's `on_enter` and `on_exit` which ran, slowest first"""
+        rows = [{"state": state.tag, "trigger": kind, "source": state.source,
+                 "calls": counts.calls, "seconds": counts.seconds}
+                for (state, kind), counts in self._callbacks.items()]
+        return sorted(rows, key=lambda r: -r["seconds"])
+
+    def to_json(self) -> dict:
+        return {"transitions": self.transitions(),
+                "conditions": self.conditions(),
+                "callbacks": self.callbacks()}
+
+    def write_json(self, path: Path | str):
+        Path(path).write_text(json.dumps(self.to_json(), indent=2, default=str))
+
+    def table(self, limit: int | None = 20) -> str:
+        """A plain text report, slowest first"""
+        def ms(seconds: float) -> str:
+            return f"{seconds * 1000:10.3f}"
+        lines = [f"{'ms':>10} {'calls':>8} {'fires':>8}  transition"]
+        lines += [f"{ms(r['seconds'])} {r['calls']:>8} {r['fires']:>8}  {r['from']} -> {r['to']}"
+                  for r in self.transitions()[:limit]]
+        lines += ["", f"{'ms':>10} {'calls':>8} {'fires':>8}  condition"]
+        lines += [f"{ms(r['seconds'])} {r['calls']:>8} {r['fires']:>8}  "
+                  f"{r['from']} -> {r['to']}: {json.dumps(r['condition'], default=str)}"
+                  + (f" ({r['source']})" if r["source"] else "")
+                  for r in self.conditions()[:limit]]
+        lines += ["", f"{'ms':>10} {'calls':>8}  trigger"]
+        lines += [f"{ms(r['seconds'])} {r['calls']:>8}  {r['state']}.{r['trigger']}"
+                  + (f" ({r['source']})" if r["source"] else "")
+                  for r in self.callbacks()[:limit]]
+        return "\n".join(lines)
@@ -0,0 +1,131 @@
+"""
+Schedules ticks for a shared host, so no session or game can starve the rest.
+
+Inputs queue up per session, and the scheduler takes one input from each
+waiting session in turn: a player who sends a flood of input only gets the
+same share of ticks as everyone else. Every tick runs under a budget of
+conditions evaluated, so a pathological game can't make any one tick slow.
+Queue depth and latency are tracked per game.
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Mapping
+from .game_server import GameServer
+from .states import Machine, OVER_BUDGET
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    """The `p`th percentile (0-1) of an already sorted list"""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+
+@dataclass
+class GameStats:
+    """How one game's ticks are getting on"""
+    queued: int = 0
+    ticks: int = 0
+    over_budget: int = 0
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=1024))
+
+    def report(self) -> dict:
+        ordered = sorted(self.latencies)
+        return {
+            "queue_depth": self.queued,
+            "ticks": self.ticks,
+            "over_budget": self.over_budget,
+            "latency_p50": percentile(ordered, 0.50),
+            "latency_p95": percentile(ordered, 0.95),
+            "latency_p99": percentile(ordered, 0.99)
+        }
+
+
+@dataclass
+class _Job:
+    game: str
+    server: GameServer
+    inp: str
+    done: asyncio.Future
+    queued_at: float
+    then: Callable[[Machine.StepResult, Mapping], Any] | None = None
+
+
+class TickScheduler:
+    """
+    Runs ticks round-robin across sessions. `budget` caps the conditions each
+    tick may evaluate (None for no cap), and `slice` is how many ticks we run
+    before yielding to the event loop.
+    """
+    def __init__(self, budget: int | None = None, slice: int = 32):
+        self.budget = budget
+        self.slice = slice
+        self._pending: Dict[str, Deque[_Job]] = {}
+        # sessions with pending input, in the order they'll next be served
+        self._ring: Deque[str] = deque()
+        self._stats: Dict[str, GameStats] = {}
+        self._runner: asyncio.Task | None = None
+
+    def stats(self, game: str) -> GameStats:
+        if game not in self._stats:
+            self._stats[game] = GameStats()
+        return self._stats[game]
+
+    async def submit(self, game: str, session: str, server: GameServer, inp: str,
+                     then: Callable[[Machine.StepResult, Mapping], Any] | None = None) -> Any:
+        """
+        Queue an input for a session, and wait for its tick. We get back the
+        step's result and the statebag view, or, if there's a `then`, what
+        `then` makes of those, called straight after the tick, before any
+        other tick can change the session.
+        """
+        done = asyncio.get_running_loop().create_future()
+        queue = self._pending.get(session)
+        if queue is None:
+            queue = self._pending[session] = deque()
+            self._ring.append(session)
+        queue.append(_Job(game, server, inp, done, time.perf_counter(), then))
+        self.stats(game).queued += 1
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+        return await done
+
+    def _run_one(self):
+        session = self._ring.popleft()
+        queue = self._pending[session]
+        job = queue.popleft()
+        if queue:
+            self._ring.append(session)
+        else:
+            del self._pending[session]
+        stats = self.stats(job.game)
+        stats.queued -= 1
+        try:
+            ticked, bag = job.server.tick(job.inp, self.budget)
+            result = job.then(ticked, bag) if job.then is not None else (ticked, bag)
+        except Exception as ex:
+            if not job.done.done():
+                job.done.set_exception(ex)
+        else:
+            if ticked.action == Machine.Result.Error and \
+                    (ticked.additionalMessages or "").startswith(OVER_BUDGET):
+                stats.over_budget += 1
+            if not job.done.done():
+                job.done.set_result(result)
+        stats.ticks += 1
+        stats.latencies.append(time.perf_counter() - job.queued_at)
+
+    async def _run(self):
+        try:
+            while self._ring:
+                for _ in range(self.slice):
+                    if not self._ring:
+                        break
+                    self._run_one()
+                await asyncio.sleep(0)
+        finally:
+            self._runner = None
+
+    def report(self) -> dict:
+        """Queue depth, tick counts and latency percentiles, per game"""
+        return {game: stats.report() for game, stats in sorted(self._stats.items())}
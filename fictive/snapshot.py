@@ -0,0 +1,182 @@
+"""
+A compact, versioned binary format for saving a session: its position in a
+machine, and its statebag.
+
+Layout:
+    magic (4 bytes) | version (1 byte) | machine fingerprint (8 bytes)
+    path | parked | statebag
+
+Strings are a varint length followed by UTF-8; counts are varints. Statebag
+values are a one byte type tag followed by the value. Only plain data (what
+YAML can hold: strings, numbers, booleans, None, and lists and string-keyed
+dicts of those) can be saved; anything else is a `SnapshotError`, so loading
+a snapshot never runs any code.
+"""
+from .states import Cursor, Statebag
+from typing import Tuple
+import struct
+
+MAGIC = b"FCTV"
+VERSION = 1
+
+_NONE, _FALSE, _TRUE, _INT, _STR, _FLOAT = range(6)
+_LIST, _DICT = 7, 8
+
+
+class SnapshotError(Exception):
+    """The snapshot is corrupt, from another version, or for another game"""
+    pass
+
+
+def _put_varint(out: bytearray, n: int):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _put_str(out: bytearray, s: str):
+    data = s.encode()
+    _put_varint(out, len(data))
+    out += data
+
+
+def _put_value(out: bytearray, v):
+    if v is None:
+        out.append(_NONE)
+    elif v is True:
+        out.append(_TRUE)
+    elif v is False:
+        out.append(_FALSE)
+    elif type(v) is int:
+        out.append(_INT)
+        _put_varint(out, (v << 1) if v >= 0 else ((-v << 1) - 1)) # zigzag
+    elif type(v) is str:
+        out.append(_STR)
+        _put_str(out, v)
+    elif type(v) is float:
+        out.append(_FLOAT)
+        out += struct.pack("<d", v)
+    elif type(v) is list:
+        out.append(_LIST)
+        _put_varint(out, len(v))
+        for item in v:
+            _put_value(out, item)
+    elif type(v) is dict:
+        out.append(_DICT)
+        _put_varint(out, len(v))
+        for key, item in v.items():
+            if type(key) is not str:
+                raise SnapshotError(f"Can't save a dict with a {type(key).__name__} key")
+            _put_str(out, key)
+            _put_value(out, item)
+    else:
+        raise SnapshotError(f"Can't save a statebag value of type {type(v).__name__}")
+
+
+class _Reader:
+    def __init__(self, data: bytes, pos: int):
+        self.data = data
+        self.pos = pos
+
+    def varint(self) -> int:
+        n = 0
+        shift = 0
+        while True:
+            b = self.data[self.pos]
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def raw(self, length: int) -> bytes:
+        if self.pos + length > len(self.data):
+            raise SnapshotError("Truncated snapshot")
+        chunk = self.data[self.pos:self.pos+length]
+        self.pos += length
+        return chunk
+
+    def str(self) -> str:
+        return self.raw(self.varint()).decode()
+
+    def value(self):
+        kind = self.data[self.pos]
+        self.pos += 1
+        if kind == _NONE:
+            return None
+        if kind == _TRUE:
+            return True
+        if kind == _FALSE:
+            return False
+        if kind == _INT:
+            z = self.varint()
+            return (z >> 1) if not z & 1 else -((z + 1) >> 1)
+        if kind == _STR:
+            return self.str()
+        if kind == _FLOAT:
+            return struct.unpack("<d", self.raw(8))[0]
+        if kind == _LIST:
+            return [self.value() for _ in range(self.varint())]
+        if kind == _DICT:
+            return {self.str(): self.value() for _ in range(self.varint())}
+        raise SnapshotError(f"Unknown value type {kind}")
+
+
+def encode_snapshot(fingerprint: bytes, cursor: Cursor, bag: Statebag) -> bytes:
+    """
+    Pack a session into a snapshot. Raises a `SnapshotError` if the statebag
+    holds anything but plain data.
+    """
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out += fingerprint
+    _put_varint(out, len(cursor.path))
+    for tag in cursor.path:
+        _put_str(out, tag)
+    parked = cursor.parked or {}
+    _put_varint(out, len(parked))
+    for address, tag in parked.items():
+        _put_varint(out, len(address))
+        for a in address:
+            _put_str(out, a)
+        _put_str(out, tag)
+    _put_varint(out, len(bag))
+    for k, v in bag.items():
+        if type(k) is not str:
+            raise SnapshotError(f"Can't save a statebag with a {type(k).__name__} key")
+        _put_str(out, k)
+        _put_value(out, v)
+    return bytes(out)
+
+
+def decode_snapshot(data: bytes, fingerprint: bytes) -> Tuple[Cursor, Statebag]:
+    """
+    Unpack a snapshot, checking that it was taken against a machine with the
+    same `fingerprint`. Anything wrong with it is a `SnapshotError`.
+    """
+    header = len(MAGIC) + 1 + len(fingerprint)
+    if len(data) < header or data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError("Not a Fictive snapshot")
+    if data[len(MAGIC)] != VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {data[len(MAGIC)]}")
+    if data[len(MAGIC)+1:header] != fingerprint:
+        raise SnapshotError("Snapshot was taken from a different game")
+    try:
+        r = _Reader(data, header)
+        path = tuple(r.str() for _ in range(r.varint()))
+        parked = {}
+        for _ in range(r.varint()):
+            address = tuple(r.str() for _ in range(r.varint()))
+            parked[address] = r.str()
+        bag = {}
+        for _ in range(r.varint()):
+            k = r.str()
+            bag[k] = r.value()
+    except IndexError:
+        raise SnapshotError("Truncated snapshot")
+    except (UnicodeDecodeError, ValueError, struct.error, RecursionError) as ex:
+        raise SnapshotError(f"Corrupt snapshot: {ex}") from ex
+    if r.pos != len(data):
+        raise SnapshotError("Corrupt snapshot: trailing data")
+    return Cursor(path, parked or None), bag
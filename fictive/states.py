@@ -1,6 +1,12 @@
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import Callable, Dict, List, Tuple, TypeAlias, Optional
+from typing import Callable, Dict, FrozenSet, List, Tuple, TypeAlias, Optional, TYPE_CHECKING
 from enum import Enum
+import hashlib
+import threading
+
+if TYPE_CHECKING:
+    from .profiler import Profiler
 
 Statebag = Dict[str, str|int]
 OptionalStateBag = Statebag|None
@@ -10,9 +16,114 @@ TransitionCallback = Callable[["State", str, Statebag], bool]
 OptionalTransitionCallback = TransitionCallback|None
 Mach=Optional["Machine"]
 
+_MISSING = object()
+
+# the start of the message in a step's result when it runs over its budget
+OVER_BUDGET = "Tick budget exceeded"
+
+@dataclass(frozen=True)
+class BagDelta:
+    """The keys which changed in a statebag over one step, and its version after"""
+    version: int
+    added: FrozenSet[str] = frozenset()
+    changed: FrozenSet[str] = frozenset()
+    removed: FrozenSet[str] = frozenset()
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+class VersionedStatebag(dict):
+    """
+    A statebag which can track the keys that change between `begin` and `end`.
+    Each time something changes, the version goes up by one.
+
+    Outside of a `begin`/`end` pair it behaves exactly like a dict.
+    """
+    __slots__ = ("version", "_before")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+        self._before: Dict[str, object] | None = None
+
+    def _record(self, key):
+        before = self._before
+        if before is not None and key not in before:
+            before[key] = dict.get(self, key, _MISSING)
+
+    def __setitem__(self, key, value):
+        if self._before is not None:
+            self._record(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._before is not None:
+            self._record(key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if self._before is not None:
+            self._record(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        if self._before is not None and key not in self._before:
+            self._before[key] = value
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        for k in list(self.keys()):
+            del self[k]
+
+    def begin(self):
+        """Start tracking changes"""
+        self._before = {}
+
+    def end(self) -> BagDelta:
+        """Stop tracking changes, and report what changed since `begin`"""
+        before = self._before or {}
+        self._before = None
+        added = []
+        changed = []
+        removed = []
+        for key, old in before.items():
+            new = dict.get(self, key, _MISSING)
+            if old is _MISSING:
+                if new is not _MISSING:
+                    added.append(key)
+            elif new is _MISSING:
+                removed.append(key)
+            elif old != new:
+                changed.append(key)
+        if not (added or changed or removed):
+            return BagDelta(self.version)
+        self.version += 1
+        return BagDelta(self.version, frozenset(added), frozenset(changed), frozenset(removed))
+
 def null_state_callback(_state:"State", _inp:str,_bag:Statebag)->None:
     pass
 
+def callback_ir(cbk):
+    """
+    Describe a callback as plain data. Trigger nodes describe themselves; for
+    anything else, the best we can do is its name.
+    """
+    if cbk is None or cbk is null_state_callback:
+        return None
+    if hasattr(cbk, "to_ir"):
+        return cbk.to_ir()
+    return f"{getattr(cbk, '__module__', '')}.{getattr(cbk, '__qualname__', repr(cbk))}"
+
 class State:
     """
     One state in our game's state machine. This is the key object we have in the system.
@@ -25,11 +136,20 @@ class State:
     A state may also have a `sub_machine`, a state machine of substates. You can
     theoretically nest substate machines as much as you like. Practically, that would be
     very difficult to write effectively.
+
+    States are part of a game's definition, and are shared by every session playing it.
+    Which substate is active is tracked by each session's `Cursor`, not by the state.
+
+    The sub-machine may be a `LazyMachine`, which builds it the first time it's used.
     """
     def __init__(self, tag: str, description: str, on_enter: OptionalStateCallback = None,
-                 on_exit: OptionalStateCallback = None, sub_machine: Mach = None):
+                 on_exit: OptionalStateCallback = None,
+                 sub_machine: "Machine | LazyMachine | None" = None,
+                 source: str | None = None):
         self._descr = description
         self.tag = tag
+        # where the state was defined, as "file:line", if we know
+        self.source = source
         if on_enter:
             self._on_enter:StateCallback = on_enter
         else:
@@ -38,39 +158,84 @@ class State:
             self._on_exit:StateCallback = on_exit
         else:
             self._on_exit = null_state_callback
-        self._sub = sub_machine
-
-    def sub(self):
-        return self._sub
+        self._sub: "Machine | LazyMachine | None" = sub_machine
+        self._lazy: LazyMachine | None = None
+        if isinstance(sub_machine, LazyMachine):
+            self._lazy = sub_machine
+            sub_machine._owner = self
+
+    def sub(self) -> "Machine | None":
+        """Our sub-machine, if we have one, built now if it's lazy"""
+        sub = self._sub
+        if isinstance(sub, LazyMachine):
+            return sub.machine()
+        return sub
 
     def description(self):
         return self._descr
 
     def __str__(self):
-        res = self._descr
-        if self._sub and self._sub.current():
-            res += "\n"
-            res += str(self._sub.current())
-        return res
-
-    def substates(self):
-        if not self._sub:
-            return []
-        res = [self._sub.current().description()]
-        res += self._sub.current().substates()
-        return res
+        return self._descr
+
+    def to_ir(self) -> dict:
+        """This state, in the same shape as the compiled YAML"""
+        ir: dict = {"tag": self.tag, "description": self._descr}
+        on_enter = callback_ir(self._on_enter)
+        if on_enter is not None:
+            ir["on_enter"] = on_enter
+        on_exit = callback_ir(self._on_exit)
+        if on_exit is not None:
+            ir["on_exit"] = on_exit
+        if self._lazy is not None:
+            ir["sub_machine"] = self._lazy.to_ir()
+        elif self._sub:
+            ir["sub_machine"] = self._sub.to_ir()
+        return ir
 
     def on_enter(self, s:"State", inp:str, bag:Statebag):
-        if self._sub:
-            self._sub.current().on_enter(s, inp, bag)
         return self._on_enter(s, inp, bag)
         
     def on_exit(self, s:"State", inp:str, bag:Statebag):
-        if self._sub:
-            self._sub.current().on_exit(s, inp, bag)
         return self._on_exit(s, inp, bag)
 
 
+class LazyMachine:
+    """
+    Stands in for a sub-machine which hasn't been built yet. The first time
+    anything asks it for more than its IR (usually because a session is
+    entering its state), it builds the machine and puts it in its state's
+    place, so every session shares the one machine from then on.
+
+    `build` makes the machine; `ir` describes it without building it, so the
+    fingerprint of a game doesn't depend on which parts of it have been built.
+    """
+    __slots__ = ("_build", "_ir", "_machine", "_owner", "_lock")
+
+    def __init__(self, build: Callable[[], "Machine"], ir: Callable[[], dict]):
+        self._build = build
+        self._ir = ir
+        self._machine: Machine | None = None
+        self._owner: State | None = None
+        self._lock = threading.Lock()
+
+    def built(self) -> bool:
+        return self._machine is not None
+
+    def machine(self) -> "Machine":
+        if self._machine is None:
+            with self._lock:
+                if self._machine is None:
+                    self._machine = self._build()
+                    if self._owner is not None:
+                        self._owner._sub = self._machine
+        return self._machine
+
+    def to_ir(self) -> dict:
+        return self._ir()
+
+    def __getattr__(self, name: str):
+        return getattr(self.machine(), name)
+
 
 @dataclass
 class Transition:
@@ -80,6 +245,10 @@ class Transition:
     orig: State|None
     dest: State
     condition: TransitionCallback
+    source: str|None = None
+
+# a precomputed transition: the condition, the destination, and its tag
+Dispatch = Tuple[TransitionCallback, State, str]
 
 class MachineDesc:
     """
@@ -90,49 +259,172 @@ class MachineDesc:
             * a reverse lookup to go from a state to its tag
         * a collection of transitions, organized by tag
         * a collection of global transitions, which are always active
+
+    Once it's built, `freeze` precomputes a dispatch table for each state, and
+    after that the description can't be changed.
     """
+    class Frozen(Exception):
+        pass
+
     def __init__(self):
         self._states: Dict[str, State] = {"": State("", "")}
         self._rstates: Dict[State, str] = {}
         self._transitions: Dict[str, List[Transition]] = {}
         self._global_transitions: List[Transition] = []
+        self._dispatch: Dict[str, Tuple[Dispatch, ...]] | None = None
+
+    def _check_frozen(self):
+        if self._dispatch is not None:
+            raise MachineDesc.Frozen("Cannot modify a frozen machine description")
 
     def add_state(self, s: State):
         """
         Add a state to this machine
         """
+        self._check_frozen()
         self._states[s.tag] = s
         self._rstates[s] = s.tag
         self._transitions[s.tag] = []
         return self
 
-    def link(self, tagOrigin: str, tagDest: str, cbk: TransitionCallback):
+    def link(self, tagOrigin: str, tagDest: str, cbk: TransitionCallback,
+             source: str | None = None):
         """
         Create a link between two states. Note we use the tags of the states,
         not the state objects themselves. This is more user friendly for our
         fiction developers.
         """
+        self._check_frozen()
         o = self._states[tagOrigin]
         d = self._states[tagDest]
-        self._transitions[tagOrigin].append(Transition(o, d, cbk))
+        self._transitions[tagOrigin].append(Transition(o, d, cbk, source))
         return self
 
-    def global_link(self, tagDest: str, cbk: TransitionCallback):
+    def global_link(self, tagDest: str, cbk: TransitionCallback, source: str | None = None):
         """
         Create a global state transition. 
         """
+        self._check_frozen()
         o = None
         d = self._states[tagDest]
-        self._global_transitions.append(Transition(o, d, cbk))
+        self._global_transitions.append(Transition(o, d, cbk, source))
+        return self
+
+    def transitions(self, tag: str) -> List[Transition]:
+        """
+        The transitions tried in the `tag` state, in the same order as its
+        `dispatch` table: its own, then the global transitions.
+        """
+        return self._transitions.get(tag, []) + self._global_transitions
+
+    def freeze(self, combine: Callable[[Tuple[TransitionCallback, ...]],
+                                       Tuple[TransitionCallback, ...]] | None = None):
+        """
+        Build the per-state dispatch tables: each state's transitions, followed
+        by the global transitions, with the destination tags already resolved.
+        Freezing twice is harmless.
+
+        `combine` may rewrite the conditions for a state's table, so long as it
+        keeps the same number of them, in the same order, with the same results.
+        """
+        if self._dispatch is not None:
+            return self
+        globs = [(t.condition, t.dest, self._rstates[t.dest])
+                 for t in self._global_transitions]
+        self._dispatch = {}
+        for tag, transitions in self._transitions.items():
+            entries = [(t.condition, t.dest, self._rstates[t.dest])
+                       for t in transitions] + globs
+            if combine:
+                conditions = combine(tuple(c for c, _, _ in entries))
+                entries = [(c, d, dt) for c, (_, d, dt) in zip(conditions, entries)]
+            self._dispatch[tag] = tuple(entries)
+        # the empty state has no transitions of its own, but globals still apply
+        self._dispatch.setdefault("", tuple(globs))
         return self
 
+    def dispatch(self, tag: str) -> Tuple["Dispatch", ...]:
+        """The ordered transitions to try when we're in the `tag` state"""
+        if self._dispatch is None:
+            self.freeze()
+        return self._dispatch[tag] # type: ignore
+
     def __getitem__(self, idx: str):
         return self._states[idx]
 
 
+class Cursor:
+    """
+    One session's position in a (shared, read-only) Machine.
+
+    `path` holds the tags of the active states, from the root machine down
+    through each sub-machine. When we leave a state with a sub-machine, that
+    sub-machine's position is remembered in `parked`, keyed by the tags of the
+    states above it, so re-entering the state picks up where the player left off.
+    Positions at a sub-machine's start state aren't stored at all.
+
+    The `State` objects along `path` are cached, by `Machine.active_states`,
+    until a transition replaces the path.
+    """
+    __slots__ = ("path", "parked", "_active")
+
+    def __init__(self, path: Tuple[str, ...] = (),
+                 parked: Dict[Tuple[str, ...], str] | None = None):
+        self.path = path
+        self.parked = parked
+        # the machine and path the active states were found for, and the states
+        self._active: "Tuple[Machine, Tuple[str, ...], Tuple[State, ...]] | None" = None
+
+    def copy(self) -> "Cursor":
+        copied = Cursor(self.path, dict(self.parked) if self.parked else None)
+        copied._active = self._active
+        return copied
+
+    def __eq__(self, other):
+        return (isinstance(other, Cursor) and self.path == other.path
+                and (self.parked or None) == (other.parked or None))
+
+    def __repr__(self):
+        return f"Cursor({self.path!r}, {self.parked!r})"
+
+
+class TickBudget:
+    """
+    Caps how many conditions and actions a single step may evaluate, so one
+    pathological game or input can't hog a shared host. Each transition's
+    condition costs one, as does each condition or action inside an `all`,
+    `any` or list of actions, and each `on_enter` and `on_exit` which runs.
+
+    The step's budget is `current_budget()`, so trigger nodes can charge it
+    without it being passed through every callback.
+    """
+    __slots__ = ("limit", "spent")
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.spent = 0
+
+    def spend(self):
+        self.spent += 1
+        if self.spent > self.limit:
+            raise Machine.BudgetExceeded(
+                f"{OVER_BUDGET}: evaluated more than {self.limit} conditions")
+
+
+_budget: ContextVar[TickBudget | None] = ContextVar("tick_budget", default=None)
+
+
+# the budget of the step being taken, if it has one
+current_budget = _budget.get
+
+
 class Machine:
     """
     The actual executing state machine. Manages the iteration across all our states.
+
+    A machine is only a definition: it never changes once it's built, and can be
+    shared by any number of sessions. Each session's position lives in a `Cursor`,
+    which `start` creates and `step` advances.
     """
     class Result(Enum):
         NoChange = 0
@@ -152,31 +444,209 @@ class Machine:
     class EnterAndRevert(Exception):
         pass
 
+    class BudgetExceeded(Exception):
+        pass
+
     @dataclass
     class StepResult:
         action: "Machine.Result"
         state: State
         transient: State|None
         additionalMessages: str|None = None
+        changes: BagDelta|None = None
 
 
     def __init__(self, mach: MachineDesc, startTag: str, endTag: str = ""):
-        self._internal = mach
+        self._internal = mach.freeze()
+        self._dispatch = mach._dispatch
+        self._states = mach._states
         self._start = mach[startTag]
         self._end = mach[endTag]
-        self._current = startTag
         self._startTag = startTag
+        self._endTag = endTag
+        self._fingerprint: bytes | None = None
+
+    def to_ir(self) -> dict:
+        """This machine's definition, in the same shape as the compiled YAML"""
+        desc = self._internal
+        return {
+            "startTag": self._startTag,
+            "endTag": self._endTag,
+            "states": [s.to_ir() for tag, s in desc._states.items() if tag != ""],
+            "transitions": [{"from": t.orig.tag, "to": t.dest.tag, # type: ignore
+                             "condition": callback_ir(t.condition)}
+                            for ts in desc._transitions.values() for t in ts],
+            "global_transitions": [{"to": t.dest.tag, "condition": callback_ir(t.condition)}
+                                   for t in desc._global_transitions]
+        }
+
+    def fingerprint(self) -> bytes:
+        """
+        A short, stable hash of this machine's definition, so we can tell if
+        saved sessions belong to it.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.blake2b(repr(self.to_ir()).encode(),
+                                                digest_size=8).digest()
+        return self._fingerprint
 
-    def current(self) -> State:
-        return self._internal[self._current]
-
-    def start(self, state_bag: Statebag):
-        self._current = self._startTag
-        if self.current().sub():
-            self.current().sub().start(state_bag)
-        self.current().on_enter(self.current(), "", state_bag)
+    def current(self, cursor: Cursor) -> State:
+        """The active state at the top level of this machine"""
+        return self._states[cursor.path[0]]
 
-    def step(self, inp: str, state_bag: Statebag) -> "Machine.StepResult":
+    def active_states(self, cursor: Cursor) -> Tuple[State, ...]:
+        """
+        The active states, from this machine down through its sub-machines.
+        Only looked up again after a transition has changed the cursor's path.
+        """
+        active = cursor._active
+        if active is not None and active[0] is self and active[1] is cursor.path:
+            return active[2]
+        states = []
+        mach: Mach = self
+        for tag in cursor.path:
+            state = mach._states[tag] # type: ignore
+            states.append(state)
+            mach = state.sub()
+        found = tuple(states)
+        cursor._active = (self, cursor.path, found)
+        return found
+
+    def substates(self, cursor: Cursor) -> List[str]:
+        """The descriptions of the active substates, outermost first"""
+        return [s.description() for s in self.active_states(cursor)[1:]]
+
+    def _resolve(self, cursor: Cursor, prefix: Tuple[str, ...], state: State) -> Tuple[str, ...]:
+        """
+        Find the active substates below `state`, whose address is `prefix`:
+        wherever they were parked, or their start states.
+        """
+        chain: Tuple[str, ...] = ()
+        address = prefix
+        sub = state._sub
+        while sub:
+            if cursor.parked:
+                tag = cursor.parked.get(address, sub._startTag)
+            else:
+                tag = sub._startTag
+            chain += (tag,)
+            address += (tag,)
+            sub = sub._states[tag]._sub
+        return chain
+
+    def _unpark(self, cursor: Cursor, prefix: Tuple[str, ...], chain: Tuple[str, ...]):
+        """The substates in `chain` are active again, so stop remembering them"""
+        if cursor.parked:
+            address = prefix
+            for tag in chain:
+                cursor.parked.pop(address, None)
+                address += (tag,)
+
+    def _park(self, cursor: Cursor, depth: int, state: State):
+        """
+        Remember the substates below the state at `depth`, which we're leaving.
+        """
+        path = cursor.path
+        sub = state._sub
+        for k in range(depth + 1, len(path)):
+            if path[k] != sub._startTag: # type: ignore
+                if cursor.parked is None:
+                    cursor.parked = {}
+                cursor.parked[path[:k]] = path[k]
+            sub = sub._states[path[k]]._sub # type: ignore
+
+    def _enter(self, chain: Tuple[State, ...], s: State, inp: str, state_bag: Statebag,
+               profiler: "Profiler | None" = None):
+        """Enter a state and its active substates, innermost first"""
+        budget = _budget.get()
+        for state in reversed(chain):
+            if budget is not None and state._on_enter is not null_state_callback:
+                budget.spend()
+            if profiler is None:
+                state.on_enter(s, inp, state_bag)
+            else:
+                profiler.callback(state, "on_enter", state.on_enter, s, inp, state_bag)
+
+    def _exit(self, chain: Tuple[State, ...], s: State, inp: str, state_bag: Statebag,
+              profiler: "Profiler | None" = None):
+        """Exit a state and its active substates, innermost first"""
+        budget = _budget.get()
+        for state in reversed(chain):
+            if budget is not None and state._on_exit is not null_state_callback:
+                budget.spend()
+            if profiler is None:
+                state.on_exit(s, inp, state_bag)
+            else:
+                profiler.callback(state, "on_exit", state.on_exit, s, inp, state_bag)
+
+    def _chain(self, state: State, tags: Tuple[str, ...]) -> Tuple[State, ...]:
+        """The state objects for `state` and the substate `tags` below it"""
+        states = [state]
+        for tag in tags:
+            state = state._sub._states[tag] # type: ignore
+            states.append(state)
+        return tuple(states)
+
+    def start(self, state_bag: Statebag, profiler: "Profiler | None" = None) -> Cursor:
+        """
+        Start a new session: enter the start state (and the start states of any
+        sub-machines), and return the cursor tracking that session's position.
+        """
+        cursor = Cursor()
+        below = self._resolve(cursor, (self._startTag,), self._start)
+        cursor.path = (self._startTag,) + below
+        self._enter(self._chain(self._start, below), self._start, "", state_bag, profiler)
+        return cursor
+
+    def _machine_at(self, address: Tuple[str, ...]) -> "Machine | None":
+        """The sub-machine below the state at `address`, if there is one"""
+        mach: Mach = self
+        for tag in address:
+            if mach is None or tag == "" or tag not in mach._states:
+                return None
+            mach = mach._states[tag].sub()
+        return mach
+
+    def remap(self, cursor: Cursor) -> Tuple[Cursor, List[str]]:
+        """
+        Carry a cursor from another version of this game over into this one.
+        Active and parked states whose tags still exist stay where they are.
+        An active state which has gone is replaced by its machine's start state,
+        and a parked one is forgotten. No triggers run. Returns the new cursor,
+        and the addresses of the states which have gone.
+        """
+        missing: List[str] = []
+        parked: Dict[Tuple[str, ...], str] = {}
+        for address, tag in (cursor.parked or {}).items():
+            owner = self._machine_at(address)
+            if owner is not None and tag != "" and tag in owner._states:
+                parked[address] = tag
+            else:
+                missing.append("/".join(address + (tag,)))
+        remapped = Cursor((), parked or None)
+        path: Tuple[str, ...] = ()
+        mach: Mach = self
+        for tag in cursor.path:
+            if mach is None:
+                # the state above lost its sub-machine
+                missing.append("/".join(path + (tag,)))
+                break
+            if tag == "" or tag not in mach._states:
+                missing.append("/".join(path + (tag,)))
+                path += (mach._startTag,)
+                break
+            path += (tag,)
+            mach = mach._states[tag].sub()
+        # anything we stopped short of (a state which has just gained a sub-machine,
+        # or which replaced a missing one) starts from its sub-machines' start states
+        state = self._chain(self._states[path[0]], path[1:])[-1]
+        below = self._resolve(remapped, path, state)
+        self._unpark(remapped, path, below)
+        remapped.path = path + below
+        return remapped, missing
+
+    def step(self, cursor: Cursor, inp: str, state_bag: Statebag,
+             budget: int | None = None, profiler: "Profiler | None" = None) -> "Machine.StepResult":
         """
         This function represents the main game loop, and this is the bit which needs the 
         most work.
@@ -197,42 +667,93 @@ class Machine:
         go back to a previous state. Especially useful for global transitions, which move us to
         states without respecting the state machine. On exiting a global transition, we may want to
         pop. Currently, the best way to do that is to revert.
+
+        If a `budget` is given, the step evaluates at most that many transition
+        conditions; past that, it stops without transitioning and returns an `Error`.
+        If a `profiler` is given, it records what the step spent its time on.
         """
-        curr = self.current()
+        if budget is None:
+            return self._step(cursor, 0, inp, state_bag, None, profiler)
+        tick_budget = TickBudget(budget)
+        token = _budget.set(tick_budget)
+        try:
+            return self._step(cursor, 0, inp, state_bag, tick_budget, profiler)
+        except Machine.BudgetExceeded as ex:
+            return Machine.StepResult(Machine.Result.Error, self.current(cursor), None, str(ex))
+        finally:
+            _budget.reset(token)
+
+    def _step(self, cursor: Cursor, depth: int, inp: str, state_bag: Statebag,
+              budget: TickBudget | None, profiler: "Profiler | None") -> "Machine.StepResult":
+        """Step the machine at `depth` in the cursor's path"""
+        tag = cursor.path[depth]
+        curr = self._states[tag]
         sub_trans = Machine.Result.NoChange
         # check substates
-        if curr.sub():
-            sub_step = curr.sub().step(inp, state_bag)
+        if curr._sub:
+            sub_step = curr._sub._step(cursor, depth + 1, inp, state_bag, budget, profiler)
             sub_trans = sub_step.action
             if sub_trans == Machine.Result.Transitioned:
                 return Machine.StepResult(sub_trans, curr, None)
-        for t in self._internal._transitions[self._current] + self._internal._global_transitions:
-            transed = t.condition(curr, inp, state_bag)
-            if transed:
-                # try to exit, and if we fail, abort transitions
-                try:
-                    curr.on_exit(curr, inp, state_bag)
-                except Exception as ex:
-                    return Machine.StepResult(Machine.Result.Rejected,
-                        curr,
-                        None,
-                        str(ex))
-                # try to enter, any failures fail to transition
-                try:
-                    t.dest.on_enter(curr, inp, state_bag)
-                except Machine.RejectWithMessage as ex:
-                    return Machine.StepResult(Machine.Result.Rejected, \
-                        curr, None, ex._msg)
-                except Machine.EnterAndRevert:
-                    return Machine.StepResult(Machine.Result.Transient,\
-                            curr, t.dest) 
-                except Exception as err:
-                    return Machine.StepResult(Machine.Result.Error, \
-                        curr, t.dest, str(err))
-                next_s = t.dest
-                next_t = self._internal._rstates[next_s]
-                self._current = next_t
-                if next_s == self._end:
-                    return Machine.StepResult(Machine.Result.End, self._end, None)
-                return Machine.StepResult(Machine.Result.Transitioned, next_s, None)
+        if profiler is not None:
+            for index, (condition, dest, dest_tag) in enumerate(self._dispatch[tag]): # type: ignore
+                if budget is not None:
+                    budget.spend()
+                if profiler.condition(self, tag, index, condition, curr, inp, state_bag):
+                    return profiler.take(self, tag, index, cursor, depth, curr, dest, dest_tag,
+                                         inp, state_bag)
+            return Machine.StepResult(sub_trans, curr, None)
+        for condition, dest, dest_tag in self._dispatch[tag]: # type: ignore
+            if budget is not None:
+                budget.spend()
+            if condition(curr, inp, state_bag):
+                return self._take(cursor, depth, curr, dest, dest_tag, inp, state_bag, None)
         return Machine.StepResult(sub_trans, curr, None)
+
+    def _take(self, cursor: Cursor, depth: int, curr: State, dest: State, dest_tag: str,
+              inp: str, state_bag: Statebag, profiler: "Profiler | None") -> "Machine.StepResult":
+        """Take the transition from `curr`, at `depth` in the cursor's path, to `dest`"""
+        # find where we're going first: this builds any lazy sub-machines on the
+        # way, and if one is broken nothing has been exited yet
+        prefix = cursor.path[:depth] + (dest_tag,)
+        try:
+            if dest is curr:
+                below = cursor.path[depth+1:]
+            else:
+                below = self._resolve(cursor, prefix, dest)
+            entering = self._chain(dest, below)
+        except Exception as err:
+            return Machine.StepResult(Machine.Result.Error, curr, dest, str(err))
+        # try to exit, and if we fail, abort transitions
+        try:
+            self._exit(self._chain(curr, cursor.path[depth+1:]), curr, inp, state_bag, profiler)
+        except Machine.BudgetExceeded:
+            raise
+        except Exception as ex:
+            return Machine.StepResult(Machine.Result.Rejected,
+                curr,
+                None,
+                str(ex))
+        # try to enter, any failures fail to transition
+        try:
+            self._enter(entering, curr, inp, state_bag, profiler)
+        except Machine.BudgetExceeded:
+            raise
+        except Machine.RejectWithMessage as ex:
+            return Machine.StepResult(Machine.Result.Rejected, \
+                curr, None, ex._msg)
+        except Machine.EnterAndRevert:
+            return Machine.StepResult(Machine.Result.Transient,\
+                    curr, dest) 
+        except Exception as err:
+            return Machine.StepResult(Machine.Result.Error, \
+                curr, dest, str(err))
+        if dest is not curr:
+            if curr._sub:
+                self._park(cursor, depth, curr)
+            if dest._sub:
+                self._unpark(cursor, prefix, below)
+        cursor.path = prefix + below
+        if dest is self._end:
+            return Machine.StepResult(Machine.Result.End, self._end, None)
+        return Machine.StepResult(Machine.Result.Transitioned, dest, None)
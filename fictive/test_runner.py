@@ -4,10 +4,15 @@ Helper functions to execute a test script against a game.
 
 from .states import Machine, Statebag
 from .parser import parse
-from .test_parser import parse_test
+from .test_parser import parse_test, parse_test_line, TestCallback
+from .game_server import get_game_server, get_registry
 from .loader import load_test
-from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List, Tuple
 from pathlib import Path
+import os
+import uuid
 
 def build_test_results(loaded_test, results):
     """Construct the output string for a test run"""
@@ -26,24 +31,140 @@ def print_test_results(loaded_test, results):
     """Print the output string"""
     print(build_test_results(loaded_test, results))
                 
-def run_tests(test:dict, machine:Machine, statebag:Statebag)->Dict[str, List[bool]]:
-    """Run a series of tests against a state machine"""
+class _Prefix:
+    """A node in a trie of test steps: one step, shared by every test which starts the same way"""
+    __slots__ = ("step", "children", "ends")
+
+    def __init__(self, step: TestCallback | None = None):
+        self.step = step
+        self.children: Dict[str, "_Prefix"] = {}
+        # the tests whose last step this is
+        self.ends: List[str] = []
+
+# the prefix of the sessions the prefix-sharing runner plays its tests in;
+# each run gets its own, so runs can't clobber each other
+_SHARED_TAG = "__shared_prefix__"
+
+def run_tests_naive(test:dict, machine:Machine, statebag:Statebag)->Dict[str, List[bool]]:
+    """Run a series of tests against a state machine, each from the start"""
     results:Dict[str, List[bool]] = {}
     for name in test.keys():
         parsed = parse_test(name, test[name])
         results[name] = parsed.run(machine, statebag)
     return results
 
-def test_main(loaded:dict, root: Path):
+def run_tests(test:dict, machine:Machine, statebag:Statebag,
+              paths:Dict[str, List[Tuple[str, ...]]] | None = None)->Dict[str, List[bool]]:
+    """
+    Run a series of tests against a state machine. If given `paths`, we fill
+    it in with the active states each test passed through, starting with the
+    start state and then after each step.
+
+    Tests which open with the same steps share those steps: we build a trie of
+    the tests' steps, and walk it, running each step once. Where the tests
+    diverge, we snapshot the session, and restore it for each branch. Since a
+    game is deterministic, the results are the same as `run_tests_naive`.
+    """
+    root = _Prefix()
+    for name in test.keys():
+        node = root
+        for entry in test[name].get("steps", []):
+            key = repr(entry)
+            if key not in node.children:
+                node.children[key] = _Prefix(parse_test_line(entry))
+            node = node.children[key]
+        node.ends.append(name)
+
+    tag = f"{_SHARED_TAG}-{uuid.uuid4().hex}"
+    try:
+        server = get_game_server(tag)
+        server.start(machine, statebag.copy())
+        results:Dict[str, List[bool]] = {}
+        trail:List[bool] = []
+        path_trail = [server.cursor().path]
+        # nodes to run, with their depth and the snapshot to resume from; the first
+        # child of a node runs straight on from its parent, so needs no snapshot
+        stack:List[Tuple[_Prefix, int, bytes | None]] = [(root, 0, None)]
+        while stack:
+            node, depth, snapshot = stack.pop()
+            if snapshot is not None:
+                server.restore(machine, snapshot)
+            del trail[max(depth - 1, 0):]
+            if node.step is not None:
+                trail.append(node.step(tag))
+                if paths is not None:
+                    del path_trail[depth:]
+                    path_trail.append(server.cursor().path)
+            for name in node.ends:
+                results[name] = list(trail)
+                if paths is not None:
+                    paths[name] = path_trail[:depth + 1]
+            children = list(node.children.values())
+            branch = server.snapshot() if len(children) > 1 else None
+            for i, child in reversed(list(enumerate(children))):
+                stack.append((child, depth + 1, branch if i > 0 else None))
+    finally:
+        get_registry().remove(tag)
+    return {name: results[name] for name in test.keys()}
+
+# each worker process parses the game once, and shares it between its tests
+_worker: dict = {}
+
+def _init_worker(loaded:dict, optimize:bool):
+    machine,statebag,_ = parse(loaded, optimize)
+    _worker["machine"] = machine
+    _worker["statebag"] = statebag
+
+def _run_chunk(chunk:dict, track:bool):
+    paths: Dict[str, List[Tuple[str, ...]]] | None = {} if track else None
+    return run_tests(chunk, _worker["machine"], _worker["statebag"], paths), paths
+
+def run_suites(suites:List[dict], loaded:dict, optimize: bool = False, jobs: int = 1,
+               paths:List[Dict[str, List[Tuple[str, ...]]]] | None = None
+               )->List[Dict[str, List[bool]]]:
+    """
+    Run every test in a list of test suites, across `jobs` processes (0 for
+    one per core). Each test starts its own session, so they can run in any
+    order; the results come back in the order of the suites and tests. If
+    given `paths`, one dict per suite, they're filled in as in `run_tests`.
+
+    To keep shared prefixes together, the tests are sorted by their steps,
+    and each process gets runs of neighbouring tests.
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs == 1:
+        machine,statebag,title = parse(loaded, optimize)
+        return [run_tests(suite, machine, statebag, paths[i] if paths is not None else None)
+                for i, suite in enumerate(suites)]
+    work = sorted(((i, name) for i, suite in enumerate(suites) for name in suite.keys()),
+                  key=lambda job: [repr(s) for s in suites[job[0]][job[1]].get("steps", [])])
+    size = max(1, -(-len(work) // (jobs * 4)))
+    # keys are (suite, test), so tests with the same name in different suites don't collide
+    chunks = [{job: suites[job[0]][job[1]] for job in work[i:i+size]}
+              for i in range(0, len(work), size)]
+    ran: Dict[Tuple[int, str], List[bool]] = {}
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(loaded, optimize)) as pool:
+        for results, walked in pool.map(_run_chunk, chunks, repeat(paths is not None)):
+            ran.update(results)
+            if paths is not None:
+                for (i, name), p in walked.items():
+                    paths[i][name] = p
+    return [{name: ran[(i, name)] for name in suite.keys()} for i, suite in enumerate(suites)]
+
+def run_test_files(loaded:dict, root: Path, optimize: bool = False,
+                   jobs: int = 1)->List[Tuple[dict, Dict[str, List[bool]]]]:
+    """Run every test in every test file of a game; see `run_suites`"""
+    test_files = [load_test(root / Path(t)) for t in loaded.get("tests", [])]
+    return list(zip(test_files, run_suites(test_files, loaded, optimize, jobs)))
+
+def test_main(loaded:dict, root: Path, optimize: bool = False, jobs: int = 1):
     """
     Handle the loading and executions of our test scripts, print
     the results.
     """
-    machine,statebag,title = parse(loaded)
-    if "tests" in loaded:
-        for t in loaded["tests"]:
-            loaded_test = load_test(root / Path(t))
-            res = run_tests(loaded_test,machine,statebag)
-            print_test_results(loaded_test, res)
+    for loaded_test, res in run_test_files(loaded, root, optimize, jobs):
+        print_test_results(loaded_test, res)
 
 
@@ -0,0 +1,223 @@
+"""
+Incremental test runs. We remember which states, transitions and files each
+test exercised, in a test map next to the game, and on the next run we only
+re-run the tests which touched a file that's changed since. Everything else
+reports its remembered results.
+
+A test depends on the files defining the states it passed through, and
+every transition out of those states (and where they lead), including
+global transitions. A file can add a transition out of a state without
+having defined any before, so we also remember a hash of each visited
+state's dispatch list (its transitions, and the global transitions of the
+machines it's in), and re-run the test if any of those change. Anything
+which affects every test, like the statebag, the list of files, or the
+engine itself (any of fictive's own source), forces a full run.
+"""
+import hashlib
+import json
+import os
+from functools import cache
+from pathlib import Path
+from sys import stderr
+from typing import Dict, List, Set, Tuple
+from .loader import load_test
+from .parser import IR_VERSION, strip_sources
+from .test_runner import run_suites
+
+TEST_MAP = ".fictive-tests.json"
+MAP_VERSION = 2
+
+Address = Tuple[str, ...]
+
+
+def _hash(data: bytes | str) -> str:
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def _source(entry: dict) -> str:
+    return entry.get("_source", "").rpartition(":")[0]
+
+
+def _skeleton(machine: dict) -> tuple:
+    """The parts of a machine which every test depends on"""
+    return (machine["startTag"], machine.get("endTag", ""),
+            tuple(_skeleton(s["sub_machine"]) for s in machine["states"] if "sub_machine" in s))
+
+
+@cache
+def engine_key() -> str:
+    """A hash of fictive's own source, so upgrading it re-runs every test"""
+    h = hashlib.sha256()
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        if path.name != "tests.py":
+            h.update(path.name.encode())
+            h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def game_key(loaded: dict, optimize: bool) -> str:
+    """Changes to anything in here invalidate every test"""
+    return _hash(repr((IR_VERSION, engine_key(), optimize, loaded.get("files"),
+                       loaded.get("state_bag"), _skeleton(loaded["execute"]))))
+
+
+def sources(machine: dict, prefix: Address = (),
+            found: Dict[Address, Set[str]] | None = None) -> Dict[Address, Set[str]]:
+    """
+    Map the address of each state, and of each machine (for its global
+    transitions), to the files a test which visits it depends on.
+    """
+    if found is None:
+        found = {}
+    states = {prefix + (s["tag"],): s for s in machine["states"]}
+
+    def files_for(trans: dict) -> Set[str]:
+        dest = states.get(prefix + (trans["to"],))
+        return {_source(trans), _source(dest) if dest else ""}
+
+    for address, s in states.items():
+        found[address] = {_source(s)}
+        if "sub_machine" in s:
+            sources(s["sub_machine"], address, found)
+    for t in machine["transitions"]:
+        found.setdefault(prefix + (t["from"],), set()).update(files_for(t))
+    found[prefix] = found.get(prefix, set()).union(
+        *(files_for(g) for g in machine.get("global_transitions", [])))
+    for files in found.values():
+        files.discard("")
+    return found
+
+
+def _globals_key(prefix: Address) -> str:
+    return "/".join(prefix) + "/*"
+
+
+def dispatch_hashes(machine: dict, prefix: Address = (),
+                    found: Dict[str, str] | None = None) -> Dict[str, str]:
+    """
+    Hash each state's transitions, keyed by its address, and each machine's
+    global transitions, keyed by its address and "/*". Only what the
+    transitions do counts, not which lines they're on.
+    """
+    if found is None:
+        found = {}
+    outgoing: Dict[str, List[dict]] = {}
+    for t in machine["transitions"]:
+        outgoing.setdefault(t["from"], []).append(t)
+    for s in machine["states"]:
+        address = prefix + (s["tag"],)
+        found["/".join(address)] = _hash(repr(strip_sources(outgoing.get(s["tag"], []))))
+        if "sub_machine" in s:
+            dispatch_hashes(s["sub_machine"], address, found)
+    found[_globals_key(prefix)] = _hash(repr(strip_sources(machine.get("global_transitions", []))))
+    return found
+
+
+def exercised(paths: List[Address], deps: Dict[Address, Set[str]],
+              hashes: Dict[str, str]) -> dict:
+    """
+    The states, transitions and files a test touched, from its active paths,
+    and the dispatch hashes of the states and machines it was in
+    """
+    states = set()
+    transitions = set()
+    files: Set[str] = set()
+    dispatch = {}
+    for path in paths:
+        for depth in range(len(path)):
+            state = "/".join(path[:depth+1])
+            states.add(state)
+            files |= deps.get(path[:depth+1], set())
+            files |= deps.get(path[:depth], set())
+            dispatch[state] = hashes.get(state, "")
+            dispatch[_globals_key(path[:depth])] = hashes.get(_globals_key(path[:depth]), "")
+    for before, after in zip(paths, paths[1:]):
+        if before != after:
+            transitions.add(f"{'/'.join(before)} -> {'/'.join(after)}")
+    return {"states": sorted(states), "transitions": sorted(transitions), "files": sorted(files),
+            "dispatch": dispatch}
+
+
+def _affected(record: dict, changed: Set[str], hashes: Dict[str, str]) -> bool:
+    return bool(changed.intersection(record["files"])) or \
+        any(hashes.get(address) != h for address, h in record["dispatch"].items())
+
+
+def load_test_map(root: Path) -> dict | None:
+    try:
+        test_map = json.loads((root / TEST_MAP).read_text())
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        print(f"Ignoring unreadable test map: {ex}", file=stderr)
+        return None
+    return test_map if test_map.get("version") == MAP_VERSION else None
+
+
+def save_test_map(root: Path, test_map: dict):
+    try:
+        tmp = root / f"{TEST_MAP}.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(test_map, indent=1, sort_keys=True))
+        os.replace(tmp, root / TEST_MAP)
+    except Exception as ex:
+        print(f"Could not write test map: {ex}", file=stderr)
+
+
+def run_incremental(loaded: dict, root: Path, optimize: bool = False, jobs: int = 1,
+                    force: bool = False) -> List[Tuple[dict, Dict[str, List[bool]]]]:
+    """
+    Run the tests of a game which could have been affected by changes since
+    the last run, and return the results of all of them, in file and test
+    order. With `force`, run everything.
+    """
+    root = Path(root)
+    key = game_key(loaded, optimize)
+    hashes = {f: _hash((root / f).read_bytes()) for f in loaded.get("files", [])}
+    previous = load_test_map(root)
+    if force or previous is None or previous.get("game") != key:
+        changed = None
+        previous = {"suites": {}}
+    else:
+        changed = {f for f, h in hashes.items() if previous["files"].get(f) != h}
+
+    deps = sources(loaded["execute"])
+    dispatch = dispatch_hashes(loaded["execute"])
+    test_paths = list(loaded.get("tests", []))
+    test_files = [load_test(root / Path(t)) for t in test_paths]
+    selected: List[dict] = []
+    for path, suite in zip(test_paths, test_files):
+        remembered = previous["suites"].get(path, {})
+        selected.append({name: entry for name, entry in suite.items()
+                         if changed is None
+                         or name not in remembered
+                         or remembered[name]["steps"] != _hash(repr(entry))
+                         or _affected(remembered[name], changed, dispatch)})
+
+    walked: List[Dict[str, List[Address]]] = [{} for _ in selected]
+    ran = run_suites(selected, loaded, optimize, jobs, walked)
+
+    suites: Dict[str, Dict[str, dict]] = {}
+    results = []
+    for path, suite, sel, res, paths in zip(test_paths, test_files, selected, ran, walked):
+        remembered = previous["suites"].get(path, {})
+        suites[path] = {}
+        suite_results: Dict[str, List[bool]] = {}
+        for name, entry in suite.items():
+            if name in sel:
+                record: dict = {"steps": _hash(repr(entry)), "results": res[name]}
+                record |= exercised(paths[name], deps, dispatch)
+            else:
+                record = remembered[name]
+            suites[path][name] = record
+            suite_results[name] = record["results"]
+        results.append((suite, suite_results))
+
+    save_test_map(root, {"version": MAP_VERSION, "game": key, "files": hashes, "suites": suites})
+    total = sum(len(s) for s in test_files)
+    rerun = sum(len(s) for s in selected)
+    if rerun < total:
+        print(f"Ran {rerun} of {total} tests; the rest are unaffected by changes since the last run",
+              file=stderr)
+    return results
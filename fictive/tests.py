@@ -1,11 +1,29 @@
 from .triggers import *
 from .parser import *
 from .states import Machine
-from .loader import load_game_yaml
-from .print_helper import statify, scan_for_template
-from .game_server import get_game_server, GameServer
+from .loader import load_game_yaml, parse_game_files, GameYAMLError
+from .print_helper import statify, scan_for_template, compile_template, TemplateCache
+from .game_server import get_game_server, get_registry, GameServer, SessionRegistry
+from .snapshot import SnapshotError
 from .test_parser import *
 from .test_runner import *
+from .game_cache import load_game, game_digest
+from .host import GameHost, GameLibrary
+from .scheduler import TickScheduler
+from .test_selection import run_incremental
+from .explorer import explore, _Expander
+from .catalog import GameCatalog
+from .reload import GameReloader
+from .profiler import Profiler
+from .ui import MarkdownCache
+from markdown_it import MarkdownIt
+from pathlib import Path
+import asyncio
+import random
+import json
+import tempfile
+from unittest import mock
+import time
 import unittest
 
 class TriggerTests(unittest.TestCase):
@@ -169,6 +187,145 @@ class ParserTests(unittest.TestCase):
         self.assertTrue(res(None, "", d))
 
 
+    def test_nested_all(self):
+        f = {"any": [{"tag": "nope"}, {"all": ["always", {"eq": {"key": "a", "value": 1}}]}]}
+        res = parse_function(f)
+        self.assertTrue(res(State("x", ""), "", {"a": 1}))
+        self.assertFalse(res(State("x", ""), "", {"a": 2}))
+
+
+class LazySubMachineTests(unittest.TestCase):
+    ENTRY = {
+        "startTag": "hall",
+        "states": [
+            {"tag": "hall", "description": "Hall"},
+            {"tag": "room", "description": "Room", "sub_machine": {
+                "startTag": "dark",
+                "states": [{"tag": "dark", "description": "Dark", "on_enter": {"inc": {"key": "n"}}},
+                           {"tag": "lit", "description": "Lit"}],
+                "transitions": [{"from": "dark", "to": "lit", "condition": {"match": "light"}}]}}
+        ],
+        "transitions": [{"from": "hall", "to": "room", "condition": {"match": "in"}}]
+    }
+
+    def test_built_on_entry(self):
+        machine = parse_machine(self.ENTRY)
+        room = machine._states["room"]
+        self.assertIsInstance(room._sub, LazyMachine)
+        fingerprint = machine.fingerprint()
+        bag: Statebag = {}
+        cursor = machine.start(bag)
+        self.assertIsInstance(room._sub, LazyMachine)
+        machine.step(cursor, "in", bag)
+        self.assertIsInstance(room._sub, Machine)
+        self.assertEqual((cursor.path, bag["n"]), (("room", "dark"), 1))
+        machine.step(cursor, "light", bag)
+        self.assertEqual(cursor.path, ("room", "lit"))
+        # every session shares it, and building it doesn't change the game's identity
+        other = parse_machine(self.ENTRY)
+        self.assertEqual(other.fingerprint(), fingerprint)
+        self.assertEqual(machine.fingerprint(), fingerprint)
+
+    def test_check(self):
+        self.assertEqual(check_machine(self.ENTRY), [])
+        entry = json.loads(json.dumps(self.ENTRY))
+        sub = entry["states"][1]["sub_machine"]
+        sub["transitions"][0]["to"] = "nowhere"
+        sub["states"][0]["on_enter"] = {"nope": 1}
+        sub["states"].append({"tag": "dark", "description": "Again"})
+        self.assertEqual(check_machine(entry), [
+            "state room/dark on_enter: unknown trigger 'nope'",
+            "state room/dark: duplicate tag",
+            "transition room/dark -> room/nowhere: to 'nowhere' is not a state"])
+        parse_machine(entry)
+
+    def test_broken(self):
+        # a sub-machine that can't be built fails the step before anything is exited
+        entry = json.loads(json.dumps(self.ENTRY))
+        entry["states"][0]["on_exit"] = {"inc": {"key": "left"}}
+        entry["states"][1]["sub_machine"]["states"][0]["on_enter"] = {"nope": 1}
+        machine = parse_machine(entry)
+        bag: Statebag = {}
+        cursor = machine.start(bag)
+        res = machine.step(cursor, "in", bag)
+        self.assertEqual(res.action, Machine.Result.Error)
+        self.assertEqual((cursor.path, bag.get("left")), (("hall",), None))
+
+
+class ConditionTreeTests(unittest.TestCase):
+    def test_nodes(self):
+        self.assertEqual(parse_function({"eq": {"key": "a", "value": 1}}), KeyCmp("eq", "a", 1))
+        self.assertEqual(parse_function({"banner": "hi"}), Set("state.banner", "hi"))
+        self.assertEqual(parse_function("revert"), Revert())
+
+    def test_hashable(self):
+        a = parse_function({"all": [{"match": "go"}, {"tag": "entry"}]})
+        b = parse_function({"all": [{"match": "go"}, {"tag": "entry"}]})
+        self.assertEqual(a, b)
+        self.assertEqual(len({a, b}), 1)
+
+    def test_round_trip(self):
+        entries = [
+            {"match": {"matcher": "get (.+)", "keys": ["item"]}},
+            {"gt": {"key": "a", "other": "b"}},
+            {"set": {"key": "a", "value": "{b}"}},
+            {"any": [{"tag": "entry"}, "always"]},
+            {"inc": {"key": "count"}},
+            "revert"
+        ]
+        for e in entries:
+            node = parse_function(e)
+            self.assertEqual(node.to_ir(), e)
+            self.assertEqual(parse_function(node.to_ir()), node)
+
+    def test_pickle(self):
+        import pickle
+        node = parse_function({"all": [{"match": {"matcher": "get (.+)", "keys": ["item"]}},
+                                       {"set": {"key": "a", "value": "{item}!"}}]})
+        loaded = pickle.loads(pickle.dumps(node))
+        self.assertEqual(loaded, node)
+        d: Statebag = {}
+        self.assertTrue(loaded(None, "get lamp", d))
+        self.assertEqual(d, {"item": "lamp", "a": "lamp!"})
+
+
+class ShortCircuitTests(unittest.TestCase):
+    def test_all_short_circuits(self):
+        d: Statebag = {}
+        cond = on_all(on_tag("nope"), on_match("(.+)", ["captured"]))
+        self.assertFalse(cond(State("x", ""), "input", d))
+        self.assertTrue("captured" not in d)
+
+    def test_any_short_circuits(self):
+        d: Statebag = {}
+        cond = on_any(always(), inc("count"))
+        self.assertTrue(cond(None, "", d))
+        self.assertTrue("count" not in d)
+
+    def test_actions_run_all(self):
+        d: Statebag = {}
+        res = parse_trigger("on_enter", {"on_enter": [{"eq": {"key": "missing", "value": 1}},
+                                                      {"inc": {"key": "count"}}]})
+        self.assertTrue(isinstance(res, Seq))
+        res(None, "", d)
+        self.assertEqual(d["count"], 1)
+
+    def test_optimize_reorders_pure(self):
+        cond = parse_function({"all": [{"match": "go"}, {"tag": "entry"}, {"eq": {"key": "a", "value": 1}}]})
+        optimized = optimize(cond)
+        self.assertEqual(optimized, All((Tag("entry"), KeyCmp("eq", "a", 1), Match("go"))))
+
+    def test_optimize_keeps_impure_order(self):
+        cond = parse_function({"all": [{"match": "go"},
+                                       {"match": {"matcher": "(.+)", "keys": ["k"]}},
+                                       {"tag": "entry"}]})
+        self.assertEqual(optimize(cond).conditions,
+                         (Match("go"), Match("(.+)", ("k",)), Tag("entry")))
+
+    def test_optimize_unwraps(self):
+        self.assertEqual(optimize(on_all(on_match("go"))), Match("go"))
+
+
 class TemplateStringTests(unittest.TestCase):
     def test_scan_no_template(self):
         text = "a simple, untemplated, test string"
@@ -239,6 +396,46 @@ class StatifyTests(unittest.TestCase):
         res = parse_function(f)(None, "", d)
         self.assertEqual(d["state.banner"], "Hello World!")
 
+    def test_template_escaped_duplicate(self):
+        templated = "\\{word} {word}"
+        d:Statebag = {"word": "ahoy"}
+        self.assertEqual(statify(templated, d), "\\{word} ahoy")
+
+class CompiledTemplateTests(unittest.TestCase):
+    def test_segments(self):
+        tmpl = compile_template("{greeting}, {target}!")
+        self.assertEqual(tmpl.literals, ("", ", ", "!"))
+        self.assertEqual(tmpl.keys, ("greeting", "target"))
+        self.assertFalse(tmpl.is_static())
+
+    def test_static(self):
+        tmpl = compile_template("no \\{templates} here")
+        self.assertTrue(tmpl.is_static())
+        self.assertEqual(tmpl.render({"templates": "x"}), "no \\{templates} here")
+
+    def test_cache_counters(self):
+        cache = TemplateCache(maxsize=2)
+        cache.get("{a}")
+        cache.get("{a}")
+        cache.get("{b}")
+        cache.get("{c}")
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(len(cache), 2)
+        cache.get("{a}") # evicted, so it's a miss again
+        self.assertEqual(cache.misses, 4)
+
+class MarkdownCacheTests(unittest.TestCase):
+    def test_reuses_parsed_tokens(self):
+        cache = MarkdownCache(maxsize=2)
+        parser = MarkdownIt("gfm-like")
+        first = cache.get("# Room\n\nIt's dark.", parser.parse)
+        self.assertIs(cache.get("# Room\n\nIt's dark.", parser.parse), first)
+        self.assertEqual(first[0].type, "heading_open")
+        cache.get("a", parser.parse)
+        cache.get("b", parser.parse)
+        self.assertEqual(cache.info(), {"hits": 1, "misses": 3, "size": 2, "maxsize": 2})
+
 class GameServerTests(unittest.TestCase):
     def test_instatiation(self):
         gs0 = get_game_server()
@@ -255,6 +452,394 @@ class GameServerTests(unittest.TestCase):
         g1 = get_game_server("g1")
         self.assertFalse(g0 is g1)
 
+    def test_tick_many(self):
+        inputs = ["flip", "nothing", "flip", "leave", "back", "flip"]
+        one, batch = GameServer(), GameServer()
+        one.start(_switch_machine(), {})
+        batch.start(_switch_machine(), {})
+        for inp in inputs:
+            last, _ = one.tick(inp)
+        res = batch.tick_many(inputs)
+        self.assertEqual((res.action, res.state.tag, res.path, res.consumed),
+                         (last.action, one.current().tag, one.cursor().path, len(inputs)))
+        self.assertEqual(batch.bag(), one.bag())
+        self.assertIsNone(res.results)
+        self.assertEqual(res.changes.version, 1)
+        traced = batch.tick_many(["flip", "nothing"], results=True, trace=True)
+        self.assertEqual(traced.results, [Machine.Result.Transitioned, Machine.Result.NoChange])
+        self.assertEqual(traced.trace, [(Machine.Result.Transitioned, "room"),
+                                        (Machine.Result.NoChange, "room")])
+
+class SessionRegistryTests(unittest.TestCase):
+    def setUp(self):
+        md = MachineDesc()
+        md.add_state(State("a", "A"))
+        md.add_state(State("b", "B"))
+        md.link("a", "b", on_match("go"))
+        self.mach = Machine(md, "a")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.registry = SessionRegistry(cap=2, spill_dir=self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_eviction(self):
+        for key in ["s0", "s1", "s2"]:
+            self.registry.get(key).start(self.mach, {"key": key})
+        s0 = self.registry.get("s0")
+        self.assertFalse(s0.is_resident())
+        self.assertEqual(self.registry.metrics()["resident"], 2)
+        self.assertEqual(self.registry.metrics()["evictions"], 1)
+        self.assertEqual(len(list(Path(self.tmp.name).iterdir())), 1)
+
+    def test_rehydrate(self):
+        s0 = self.registry.get("s0")
+        s0.start(self.mach, {"key": "s0"})
+        s0.tick("go")
+        self.registry.get("s1").start(self.mach, {})
+        self.registry.get("s2").start(self.mach, {})
+        self.assertFalse(s0.is_resident())
+        self.assertEqual(s0.current().tag, "b")
+        self.assertEqual(s0.bag(), {"key": "s0"})
+        self.assertTrue(s0.is_resident())
+        metrics = self.registry.metrics()
+        self.assertEqual(metrics["rehydrations"], 1)
+        # bringing s0 back in pushed out the next coldest
+        self.assertEqual(metrics["resident"], 2)
+        self.assertFalse(self.registry.get("s1").is_resident())
+
+    def test_ttl(self):
+        self.registry.configure(ttl=0.01)
+        s0 = self.registry.get("s0")
+        s0.start(self.mach, {})
+        time.sleep(0.02)
+        self.registry.get("s1").start(self.mach, {})
+        self.assertFalse(s0.is_resident())
+
+    def test_remove(self):
+        self.registry.get("s0").start(self.mach, {})
+        self.registry.remove("s0")
+        self.assertFalse("s0" in self.registry)
+
+    def test_expire_spilled(self):
+        expired = []
+        self.registry.configure(cap=1, spill_dir=self.tmp.name, max_spilled=1)
+        self.registry.on_expire.append(expired.append)
+        for key in ["s0", "s1", "s2"]:
+            self.registry.get(key).start(self.mach, {})
+        self.assertEqual(expired, ["s0"])
+        self.assertFalse("s0" in self.registry)
+        self.assertEqual(self.registry.metrics()["spilled"], 1)
+        self.assertEqual(len(list(Path(self.tmp.name).iterdir())), 1)
+        self.registry.configure(cap=1, spill_dir=self.tmp.name, spilled_ttl=0)
+        self.registry.get("s2").tick("go")
+        self.assertEqual(expired, ["s0", "s1"])
+        self.assertEqual(list(Path(self.tmp.name).iterdir()), [])
+
+class StatebagDeltaTests(unittest.TestCase):
+    def test_tracking(self):
+        bag = VersionedStatebag({"a": 1, "b": 2, "c": 3})
+        bag.begin()
+        bag["a"] = 5
+        bag["b"] = 2
+        del bag["c"]
+        bag["d"] = 4
+        delta = bag.end()
+        self.assertEqual(delta, BagDelta(1, frozenset({"d"}), frozenset({"a"}), frozenset({"c"})))
+        bag.begin()
+        bag["a"] = 6
+        bag["a"] = 5
+        delta = bag.end()
+        self.assertFalse(delta)
+        self.assertEqual(bag.version, 1)
+
+    def test_tick(self):
+        server = GameServer()
+        server.start(_switch_machine(), {})
+        seen = []
+        unsubscribe = server.subscribe(lambda delta, view: seen.append(delta))
+        res, view = server.tick("flip")
+        self.assertEqual(res.changes, BagDelta(0))
+        with self.assertRaises(TypeError):
+            view["offs"] = 10 # type: ignore
+        res, view = server.tick("flip")
+        self.assertEqual(res.changes.changed, frozenset({"offs"}))
+        self.assertEqual(view["offs"], 2)
+        self.assertEqual(seen, [res.changes])
+        unsubscribe()
+        server.tick("flip")
+        server.tick("flip")
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(server.version(), 2)
+
+class TickSchedulerTests(unittest.TestCase):
+    def test_budget(self):
+        mach = _switch_machine()
+        d: Statebag = {}
+        cursor = mach.start(d)
+        res = mach.step(cursor, "leave", d, budget=1)
+        self.assertEqual(res.action, Machine.Result.Error)
+        self.assertTrue(res.additionalMessages.startswith(OVER_BUDGET))
+        self.assertEqual(cursor.path, ("room", "off"))
+        self.assertEqual(mach.step(cursor, "leave", d, budget=10).action,
+                         Machine.Result.Transitioned)
+
+    def test_budget_counts_nested(self):
+        md = MachineDesc()
+        md.add_state(State("a", "A"))
+        md.add_state(State("b", "B", on_enter=do_all(inc("n"), inc("n"))))
+        md.link("a", "b", on_any(*(on_match(f"x{i}") for i in range(50)), on_match("go")))
+        mach = Machine(md, "a")
+        d: Statebag = {}
+        cursor = mach.start(d)
+        self.assertEqual(mach.step(cursor, "go", d, budget=50).action, Machine.Result.Error)
+        # the transition, the any's 51 matches, the on_enter, and its two actions
+        self.assertEqual(mach.step(cursor, "go", d, budget=55).action, Machine.Result.Transitioned)
+
+    def test_round_robin(self):
+        scheduler = TickScheduler(budget=1)
+        order = []
+        def session(name):
+            server = GameServer(name)
+            server.start(_switch_machine(), {})
+            tick = server.tick
+            server.tick = lambda inp, budget: (order.append(name), tick(inp, budget))[1]
+            return server
+        greedy, polite = session("greedy"), session("polite")
+        async def play():
+            return await asyncio.gather(
+                *(scheduler.submit("switch", "greedy", greedy, "flip") for _ in range(3)),
+                scheduler.submit("switch", "polite", polite, "leave"))
+        results = asyncio.run(play())
+        self.assertEqual(order, ["greedy", "polite", "greedy", "greedy"])
+        self.assertEqual(results[-1][0].action, Machine.Result.Error)
+        report = scheduler.report()["switch"]
+        # flipping back to off runs its on_enter, which is over budget too
+        self.assertEqual((report["ticks"], report["over_budget"], report["queue_depth"]), (4, 3, 0))
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.mach = _switch_machine()
+        self.server = GameServer()
+        self.server.start(self.mach, {"name": "Zoë", "n": -3, "f": 1.5, "b": True, "none": None})
+        self.server.tick("flip")
+        self.server.tick("leave")
+
+    def test_round_trip(self):
+        snap = self.server.snapshot()
+        self.assertLess(len(snap), 100)
+        restored = GameServer()
+        restored.restore(self.mach, snap)
+        self.assertEqual(restored.cursor(), self.server.cursor())
+        self.assertEqual(restored.bag(), self.server.bag())
+        restored.tick("back")
+        self.assertEqual(restored.cursor().path, ("room", "on"))
+
+    def test_no_on_enter(self):
+        restored = GameServer()
+        restored.restore(self.mach, self.server.snapshot())
+        self.assertEqual(restored.bag()["offs"], 1)
+
+    def test_wrong_game(self):
+        md = MachineDesc()
+        md.add_state(State("room", "A different room"))
+        other = Machine(md, "room")
+        with self.assertRaises(SnapshotError):
+            GameServer().restore(other, self.server.snapshot())
+
+    def test_corrupt(self):
+        with self.assertRaises(SnapshotError):
+            GameServer().restore(self.mach, b"not a snapshot")
+        with self.assertRaises(SnapshotError):
+            GameServer().restore(self.mach, self.server.snapshot()[:-3])
+        snap = self.server.snapshot()
+        for bad in [snap[:-1] + b"\xff", snap + b"\x00", snap.replace("Zoë".encode(), b"Zo\xff\xfe")]:
+            with self.assertRaises(SnapshotError):
+                GameServer().restore(self.mach, bad)
+
+    def test_plain_data_only(self):
+        self.server._bag["items"] = ["lamp", {"charge": 3}]
+        restored = GameServer()
+        restored.restore(self.mach, self.server.snapshot())
+        self.assertEqual(restored.bag()["items"], ["lamp", {"charge": 3}])
+        self.server._bag["when"] = object()
+        with self.assertRaises(SnapshotError):
+            self.server.snapshot()
+        del self.server._bag["when"]
+        self.server._bag[3] = "three"
+        with self.assertRaises(SnapshotError):
+            self.server.snapshot()
+
+class MachineDescTests(unittest.TestCase):
+    def setUp(self):
+        md = MachineDesc()
+        md.add_state(State("a", "A"))
+        md.add_state(State("b", "B"))
+        md.add_state(State("help", "Help"))
+        md.link("a", "b", on_match("go"))
+        md.global_link("help", on_match("help"))
+        self.md = md
+
+    def test_dispatch_includes_globals(self):
+        self.md.freeze()
+        dests = [tag for _, _, tag in self.md.dispatch("a")]
+        self.assertEqual(dests, ["b", "help"])
+        dests = [tag for _, _, tag in self.md.dispatch("b")]
+        self.assertEqual(dests, ["help"])
+
+    def test_frozen(self):
+        Machine(self.md, "a")
+        with self.assertRaises(MachineDesc.Frozen):
+            self.md.link("b", "a", on_match("back"))
+
+    def test_step(self):
+        mach = Machine(self.md, "a")
+        cursor = mach.start({})
+        res = mach.step(cursor, "go", {})
+        self.assertEqual(res.action, Machine.Result.Transitioned)
+        self.assertEqual(mach.current(cursor).tag, "b")
+        res = mach.step(cursor, "go", {})
+        self.assertEqual(res.action, Machine.Result.NoChange)
+
+def _switch_machine() -> Machine:
+    """A room with a light switch in it, and a hall outside"""
+    switch = MachineDesc()
+    switch.add_state(State("off", "Off", on_enter=inc("offs")))
+    switch.add_state(State("on", "On"))
+    switch.link("off", "on", on_match("flip"))
+    switch.link("on", "off", on_match("flip"))
+    md = MachineDesc()
+    md.add_state(State("room", "Room", sub_machine=Machine(switch, "off")))
+    md.add_state(State("hall", "Hall"))
+    md.link("room", "hall", on_match("leave"))
+    md.link("hall", "room", on_match("back"))
+    return Machine(md, "room")
+
+class ReloadTests(unittest.TestCase):
+    def test_remap(self):
+        old = _switch_machine()
+        cursor = old.start({})
+        old.step(cursor, "flip", {})
+        old.step(cursor, "leave", {})
+        self.assertEqual((cursor.path, cursor.parked), (("hall",), {("room",): "on"}))
+        switch = MachineDesc()
+        switch.add_state(State("off", "Off"))
+        md = MachineDesc()
+        md.add_state(State("room", "Room", sub_machine=Machine(switch, "off")))
+        md.add_state(State("hall", "Hall"))
+        new = Machine(md, "room")
+        self.assertEqual(new.remap(cursor), (Cursor(("hall",)), ["room/on"]))
+        self.assertEqual(new.remap(Cursor(("room", "on"))), (Cursor(("room", "off")), ["room/on"]))
+        self.assertEqual(new.remap(Cursor(("gone",))), (Cursor(("room", "off")), ["gone"]))
+        self.assertEqual(old.remap(Cursor(("hall",))), (Cursor(("hall",)), []))
+
+    def test_server_reload(self):
+        registry = SessionRegistry(cap=1)
+        old = _switch_machine()
+        for key in ("a", "b"):
+            registry.get(key).start(old, {})
+            registry.get(key).tick("flip")
+        self.assertFalse(registry.get("a").is_resident())
+        new = _switch_machine()
+        self.assertEqual(registry.reload(old, new), {"a": [], "b": []})
+        for key in ("a", "b"):
+            self.assertIs(registry.get(key).machine(), new)
+            self.assertEqual((registry.get(key).cursor().path, registry.get(key).bag()),
+                             (("room", "on"), {"offs": 1}))
+
+    def test_reloader(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            (root / "manifest.yaml").write_text("title: Reloaded\nfiles:\n  - game.yaml\n")
+            (root / "game.yaml").write_text(GameCacheTests.GAME.format(descr="Entry"))
+            reloader = GameReloader(root)
+            entry = reloader.machine._states["entry"]
+            self.assertIsNone(reloader.poll())
+            (root / "game.yaml").write_text(GameCacheTests.GAME.format(descr="Changed"))
+            reloaded = reloader.poll()
+            self.assertEqual((reloaded.files, reloaded.reused), (["game.yaml"], 1))
+            self.assertIs(reloaded.old._states["entry"], entry)
+            self.assertIs(reloader.machine._states["next"], reloaded.old._states["next"])
+            self.assertEqual(reloader.machine._states["entry"].description(), "Changed")
+            (root / "game.yaml").write_text("execute:\n    startTag: nowhere\n    states: []\n")
+            with self.assertRaisesRegex(ValueError, "startTag 'nowhere' is not a state"):
+                reloader.poll()
+
+
+class CursorTests(unittest.TestCase):
+    def setUp(self):
+        self.mach = _switch_machine()
+
+    def test_start(self):
+        d: Statebag = {}
+        cursor = self.mach.start(d)
+        self.assertEqual(cursor.path, ("room", "off"))
+        self.assertEqual(d["offs"], 1)
+        self.assertEqual(self.mach.substates(cursor), ["Off"])
+
+    def test_sessions_are_independent(self):
+        d0: Statebag = {}
+        d1: Statebag = {}
+        c0 = self.mach.start(d0)
+        c1 = self.mach.start(d1)
+        self.mach.step(c0, "flip", d0)
+        self.assertEqual(c0.path, ("room", "on"))
+        self.assertEqual(c1.path, ("room", "off"))
+
+    def test_sub_machine_remembered(self):
+        d: Statebag = {}
+        cursor = self.mach.start(d)
+        self.mach.step(cursor, "flip", d)
+        self.mach.step(cursor, "leave", d)
+        self.assertEqual(cursor.path, ("hall",))
+        self.assertEqual(cursor.parked, {("room",): "on"})
+        self.mach.step(cursor, "back", d)
+        self.assertEqual(cursor.path, ("room", "on"))
+        self.assertFalse(cursor.parked)
+        self.mach.step(cursor, "flip", d)
+        self.mach.step(cursor, "leave", d)
+        # the start position doesn't need to be remembered
+        self.assertFalse(cursor.parked)
+
+    def test_active_states_cached(self):
+        d: Statebag = {}
+        cursor = self.mach.start(d)
+        active = self.mach.active_states(cursor)
+        self.assertEqual([s.tag for s in active], ["room", "off"])
+        self.mach.step(cursor, "nothing", d)
+        self.assertIs(self.mach.active_states(cursor), active)
+        self.mach.step(cursor, "flip", d)
+        self.assertEqual([s.tag for s in self.mach.active_states(cursor)], ["room", "on"])
+        self.assertEqual(_switch_machine().active_states(cursor)[1].tag, "on")
+
+class MatchTableTests(unittest.TestCase):
+    def test_first_match_wins(self):
+        conds = combine_matches([on_match("go (.+)", ["where"]),
+                                 on_key("flag", "on"),
+                                 on_match("(go) north", ["a"]),
+                                 on_match("look")])
+        self.assertTrue(all(isinstance(c, MatchSlot) for c in (conds[0], conds[2], conds[3])))
+        self.assertFalse(isinstance(conds[1], MatchSlot))
+        d: Statebag = {}
+        self.assertTrue(conds[0](None, "go north", d))
+        self.assertEqual(d["where"], "north")
+        self.assertFalse(conds[2](None, "go north", d))
+        self.assertTrue(conds[3](None, "LOOK", d))
+        self.assertFalse(conds[0](None, "look", d))
+
+    def test_groups_offset(self):
+        conds = combine_matches([on_match("(a)(b)"), on_match("(c)(d)", ["x", "y"])])
+        d: Statebag = {}
+        self.assertTrue(conds[1](None, "cd", d))
+        self.assertEqual((d["x"], d["y"]), ("c", "d"))
+
+    def test_unmergeable(self):
+        conds = combine_matches([on_match("(a)\\1"), on_match("b"), on_match("c")])
+        self.assertFalse(isinstance(conds[0], MatchSlot))
+        self.assertTrue(conds[0](None, "aa", {}))
+        self.assertTrue(conds[2](None, "c", {}))
+
 class GameTestParserTests(unittest.TestCase):
     def setUp(self):
         md = MachineDesc()
@@ -307,6 +892,353 @@ class GameTestParserTests(unittest.TestCase):
         self.assertTrue("foo" not in self.bag)
 
 
+class LoaderTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        (self.root / "manifest.yaml").write_text(
+            "title: Split\nfiles:\n  - states.yaml\n  - game.yaml\n")
+        (self.root / "states.yaml").write_text(
+            "states: &states\n    - state: &entry\n        tag: entry\n        description: Entry\n")
+        (self.root / "game.yaml").write_text(
+            "execute:\n    startTag: entry\n    states:\n        - *states\n"
+            "    transitions: []\nagain: *entry\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cross_file_anchors(self):
+        loaded = load_game_yaml(self.root)
+        state = loaded["states"][0]["state"]
+        self.assertEqual(state, {"tag": "entry", "description": "Entry", "_source": "states.yaml:2"})
+        self.assertIs(loaded["execute"]["states"][0], loaded["states"])
+        self.assertIs(loaded["again"], state)
+
+    def test_cross_file_merge(self):
+        (self.root / "states.yaml").write_text(
+            "base: &base\n    description: Shared\n    visits: 0\nname: &name text\n")
+        (self.root / "game.yaml").write_text(
+            "local: &local {visits: 1, lit: true}\n"
+            "one: {<<: *base, tag: one, visits: 2}\n"
+            "two: {<<: [*local, *base], tag: two}\n")
+        loaded = load_game_yaml(self.root)
+        self.assertEqual(loaded["one"], {"description": "Shared", "visits": 2, "tag": "one"})
+        self.assertEqual(loaded["two"], {"description": "Shared", "visits": 1, "lit": True,
+                                         "tag": "two"})
+        (self.root / "game.yaml").write_text("local: {}\nbad: {<<: *name}\n")
+        with self.assertRaisesRegex(GameYAMLError, "game.yaml:2: expected a mapping for merging"):
+            load_game_yaml(self.root)
+
+    def test_cached_by_mtime(self):
+        mfest = {"files": ["states.yaml", "game.yaml"]}
+        first = parse_game_files(self.root, mfest)
+        (self.root / "game.yaml").write_text("execute:\n    startTag: entry\n")
+        second = parse_game_files(self.root, mfest)
+        self.assertIs(first[0], second[0])
+        self.assertIsNot(first[1], second[1])
+
+    def test_errors(self):
+        (self.root / "game.yaml").write_text("execute:\n    states: *nope\n")
+        with self.assertRaisesRegex(GameYAMLError, "game.yaml:2: found undefined alias 'nope'"):
+            load_game_yaml(self.root)
+        (self.root / "states.yaml").write_text("states:\n  - [broken\n")
+        with self.assertRaisesRegex(GameYAMLError, "^states.yaml:3: "):
+            load_game_yaml(self.root)
+
+
+class GameCatalogTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.games = Path(self.tmp.name) / "games"
+        self.cache = Path(self.tmp.name) / "cache"
+        for name in ("one", "two"):
+            (self.games / name).mkdir(parents=True)
+            (self.games / name / "manifest.yaml").write_text(
+                f"title: {name}\nfiles:\n  - game.yaml\n")
+            (self.games / name / "game.yaml").write_text("execute: {}\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_incremental(self):
+        catalog = GameCatalog(self.games, self.cache)
+        self.assertEqual([(n, e.title) for n, e in catalog.rescan()], [("one", "one"), ("two", "two")])
+        with mock.patch("fictive.catalog.load_manifest") as load:
+            self.assertEqual(list(GameCatalog(self.games, self.cache).rescan()), [])
+            load.assert_not_called()
+        (self.games / "two" / "manifest.yaml").write_text("title: Second\nfiles:\n  - game.yaml\n")
+        (self.games / "one" / "game.yaml").unlink()
+        (self.games / "one" / "manifest.yaml").unlink()
+        catalog = GameCatalog(self.games, self.cache)
+        self.assertEqual([e.title for e in catalog.entries()], ["one", "two"])
+        self.assertEqual([(n, e and e.title) for n, e in catalog.rescan()],
+                         [("two", "Second"), ("one", None)])
+        self.assertEqual([e.title for e in GameCatalog(self.games, self.cache).entries()], ["Second"])
+
+
+class GameCacheTests(unittest.TestCase):
+    GAME = """
+states: &states
+    - state:
+        tag: entry
+        description: {descr}
+    - state:
+        tag: next
+        description: Next
+execute:
+    startTag: entry
+    states:
+        - *states
+    transitions:
+        - transition:
+            from: entry
+            to: next
+            condition:
+                - Match: go
+"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name) / "game"
+        self.root.mkdir()
+        self.cache = Path(self.tmp.name) / "cache"
+        (self.root / "manifest.yaml").write_text("title: Cached\nfiles:\n  - game.yaml\n")
+        (self.root / "game.yaml").write_text(GameCacheTests.GAME.format(descr="Entry"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_compiled_form(self):
+        compiled = load_game(self.root, None)
+        self.assertEqual(compiled["title"], "Cached")
+        trans = compiled["execute"]["transitions"][0]
+        self.assertEqual(trans, {"from": "entry", "to": "next", "condition": {"match": "go"},
+                                 "_source": "game.yaml:15"})
+        self.assertEqual(compiled["execute"]["states"][1]["_source"], "game.yaml:7")
+        machine, _, _ = parse(compiled)
+        cursor = machine.start({})
+        self.assertEqual(machine.step(cursor, "go", {}).action, Machine.Result.Transitioned)
+
+    def test_cache_hit(self):
+        first = load_game(self.root, self.cache)
+        self.assertEqual(len(list(self.cache.iterdir())), 1)
+        second = load_game(self.root, self.cache)
+        self.assertEqual(first, second)
+        self.assertEqual(len(list(self.cache.iterdir())), 1)
+
+    def test_invalidation(self):
+        digest = game_digest(self.root)
+        load_game(self.root, self.cache)
+        (self.root / "game.yaml").write_text(GameCacheTests.GAME.format(descr="Changed"))
+        self.assertNotEqual(digest, game_digest(self.root))
+        compiled = load_game(self.root, self.cache)
+        self.assertEqual(compiled["execute"]["states"][0]["description"], "Changed")
+
+
+class ExplorerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name)
+        (root / "manifest.yaml").write_text("title: Explored\nfiles:\n  - game.yaml\n")
+        (root / "game.yaml").write_text(GameCacheTests.GAME.format(descr="Entry"))
+        self.loaded = load_game(root, None)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_explore(self):
+        found = explore(self.loaded, ["stay", "go"])
+        self.assertTrue(found.complete)
+        self.assertEqual(found.configurations, 2)
+        self.assertEqual(found.transcripts, {"entry": [], "next": ["go"]})
+        self.assertEqual(found.dead_ends, {"next": ["go"]})
+        self.assertEqual(found.unreachable, [])
+        self.assertIsNone(found.end)
+
+    def test_limits(self):
+        found = explore(self.loaded, ["stay"])
+        self.assertEqual(found.unreachable, ["next"])
+        self.assertEqual(found.dead_ends, {"entry": []})
+        self.assertFalse(explore(self.loaded, ["go"], max_depth=0).complete)
+        self.assertFalse(explore(self.loaded, ["go"], max_configurations=1).complete)
+
+    def test_canonical_parked(self):
+        expander = _Expander(parse(self.loaded)[0], ["go"])
+        first = Cursor(("entry",), {("a",): "x", ("b",): "y"})
+        second = Cursor(("entry",), {("b",): "y", ("a",): "x"})
+        self.assertEqual(expander.canonical(first, {"n": 1, "m": 2}),
+                         expander.canonical(second, {"m": 2, "n": 1}))
+
+
+class ProfilerTests(unittest.TestCase):
+    def test_profile(self):
+        profiler = Profiler()
+        server = GameServer()
+        server.profiler = profiler
+        server.start(_switch_machine(), {})
+        server.tick_many(["flip", "leave", "nothing", "back"])
+        report = profiler.to_json()
+        transitions = {(r["from"], r["to"]): (r["calls"], r["fires"])
+                       for r in report["transitions"]}
+        self.assertEqual(transitions, {("off", "on"): (1, 1), ("room", "hall"): (1, 1),
+                                       ("hall", "room"): (2, 1), ("on", "off"): (1, 0)})
+        callbacks = {(r["state"], r["trigger"]): r["calls"] for r in report["callbacks"]}
+        self.assertEqual(callbacks[("off", "on_enter")], 1)
+        self.assertEqual(callbacks[("on", "on_enter")], 2)
+        self.assertEqual(callbacks[("room", "on_exit")], 1)
+        self.assertIn("room -> hall", profiler.table())
+        json.dumps(report)
+
+    def test_sources(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            (root / "manifest.yaml").write_text("title: Profiled\nfiles:\n  - game.yaml\n")
+            (root / "game.yaml").write_text(GameCacheTests.GAME.format(descr="Entry"))
+            machine, bag, _ = parse(load_game(root, None))
+        profiler = Profiler()
+        cursor = machine.start(bag, profiler)
+        machine.step(cursor, "go", bag, profiler=profiler)
+        [condition] = profiler.conditions()
+        self.assertEqual((condition["from"], condition["to"], condition["source"]),
+                         ("entry", "next", "game.yaml:15"))
+        self.assertEqual(profiler.callbacks()[0]["source"].rpartition(":")[0], "game.yaml")
+
+    def test_equal_conditions(self):
+        # the same condition on a local and a global link gets a row each
+        never = on_match("never")
+        md = MachineDesc()
+        md.add_state(State("a", "A"))
+        md.add_state(State("b", "B"))
+        md.add_state(State("help", "Help"))
+        md.link("a", "b", never)
+        md.global_link("help", never)
+        machine = Machine(md, "a")
+        profiler = Profiler()
+        cursor = machine.start({}, profiler)
+        machine.step(cursor, "go", {}, profiler=profiler)
+        rows = {(r["from"], r["to"]): r["calls"] for r in profiler.conditions()}
+        self.assertEqual(rows, {("a", "b"): 1, ("a", "help"): 1})
+
+
+class HostTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name) / "cached"
+        root.mkdir()
+        (root / "manifest.yaml").write_text("title: Cached\nfiles:\n  - game.yaml\n")
+        (root / "game.yaml").write_text(GameCacheTests.GAME.format(descr="Entry {visits}"))
+        self.host = GameHost(GameLibrary(self.tmp.name, None),
+                             SessionRegistry(spill_dir=Path(self.tmp.name) / "spill"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def converse(self, handler, *requests):
+        async def talk():
+            server = await asyncio.start_server(handler, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            replies = []
+            for r in requests:
+                writer.write(r)
+                await writer.drain()
+                replies.append(await reader.readline())
+            # wait for the host to hang up
+            writer.write(b"/quit\n")
+            rest = await reader.read()
+            writer.close()
+            server.close()
+            return replies + rest.splitlines(keepends=True)
+        return asyncio.run(talk())
+
+    def test_sessions_share_machine(self):
+        first = self.host.new_session("cached")
+        second = self.host.new_session("cached")
+        self.assertNotEqual(first["session"], second["session"])
+        self.assertEqual(self.host.play(first["session"], "go")["state"], "next")
+        self.assertEqual(self.host.resume(second["session"])["state"], "entry")
+        self.assertIs(self.host.registry.get(first["session"]).machine(),
+                      self.host.registry.get(second["session"]).machine())
+
+    def test_refuses_broken_game(self):
+        root = Path(self.tmp.name) / "broken"
+        root.mkdir()
+        (root / "manifest.yaml").write_text("title: Broken\nfiles:\n  - game.yaml\n")
+        (root / "game.yaml").write_text(
+            GameCacheTests.GAME.format(descr="Entry").replace("to: next", "to: nowhere"))
+        with self.assertRaisesRegex(ValueError, "'nowhere' is not a state"):
+            self.host.new_session("broken")
+
+    def test_line_protocol(self):
+        replies = [json.loads(r) for r in self.converse(self.host.handle_lines,
+            b"hello\n", b"/games\n", b"/play nowhere\n", b"/play cached\n", b"go\n")]
+        self.assertIn("error", replies[0])
+        self.assertEqual(replies[1], {"games": ["cached"]})
+        self.assertIn("error", replies[2])
+        self.assertEqual(replies[3]["state"], "entry")
+        self.assertEqual(replies[3]["description"], "Entry <<ERROR: visits not in state bag>>")
+        self.assertEqual(replies[4]["action"], "Transitioned")
+        self.assertEqual(replies[4]["session"], replies[3]["session"])
+        self.assertEqual(self.host.connections, 0)
+        # hanging up ends the session
+        self.assertFalse(replies[3]["session"] in self.host.registry)
+        self.assertEqual(self.host._games, {})
+
+    def test_http(self):
+        body = b'{"game": "cached"}'
+        reply = b"".join(self.converse(self.host.handle_http,
+            b"POST /sessions HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s"
+            % (len(body), body)))
+        head, _, payload = reply.partition(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.1 201"))
+        session = json.loads(payload)["session"]
+        self.assertEqual(asyncio.run(self.host._route("POST", f"/sessions/{session}",
+                                                      {"input": "go"}))[1]["state"], "next")
+        self.assertEqual(asyncio.run(self.host._route("GET", "/sessions/missing", {}))[0], 404)
+
+    def test_broken_game(self):
+        root = Path(self.tmp.name) / "broken"
+        root.mkdir()
+        (root / "manifest.yaml").write_text("title: Broken\nfiles:\n  - game.yaml\n")
+        (root / "game.yaml").write_text("states: [unclosed\n")
+        status, reply = asyncio.run(self.host._route("POST", "/sessions", {"game": "broken"}))
+        self.assertEqual(status, 500)
+        self.assertIn("game.yaml", reply["error"])
+        replies = self.converse(self.host.handle_lines, b"/play broken\n")
+        self.assertIn("error", json.loads(replies[0]))
+
+    def test_reply_is_from_its_own_tick(self):
+        root = Path(self.tmp.name) / "counter"
+        root.mkdir()
+        (root / "manifest.yaml").write_text("title: Counter\nfiles:\n  - game.yaml\n")
+        (root / "game.yaml").write_text("""
+states: &states
+    - state:
+        tag: a
+        description: "Visits {visits}"
+        on_enter:
+            - inc:
+                key: visits
+    - state:
+        tag: b
+        description: "Visits {visits}"
+        on_enter:
+            - inc:
+                key: visits
+execute:
+    startTag: a
+    states:
+        - *states
+    transitions:
+        - transition: {from: a, to: b, condition: [{Match: go}]}
+        - transition: {from: b, to: a, condition: [{Match: go}]}
+""")
+        session = self.host.new_session("counter")["session"]
+        async def play():
+            return await asyncio.gather(*(self.host.submit(session, "go") for _ in range(3)))
+        self.assertEqual([r["description"] for r in asyncio.run(play())],
+                         ["Visits 2", "Visits 3", "Visits 4"])
+
+
 class TestTests(unittest.TestCase):
     def test_printing(self):
         t = {"test": {"steps": [0, 1, 2, 3]}}
@@ -319,3 +1251,75 @@ class TestTests(unittest.TestCase):
         res = build_test_results(t, r)
         self.assertEqual(res,
         "Test: test\n---- All Tests Pass")
+
+    def test_parallel(self):
+        root = Path(__file__).parent.parent / "games" / "example"
+        loaded = load_game(root, None)
+        serial = run_test_files(loaded, root)
+        self.assertEqual(run_test_files(loaded, root, jobs=2), serial)
+        self.assertEqual(list(serial[0][1].keys()), ["good_path", "failed_test"])
+
+    def test_shared_prefixes(self):
+        steps = [{"input": "flip"}, {"input": "leave"}, {"input": "back"},
+                 {"assert": {"tag": "room"}}, {"assert": {"tag": "hall"}},
+                 {"assert": {"eq": {"key": "offs", "value": 2}}}]
+        rand = random.Random(7)
+        suite = {}
+        for i in range(40):
+            opening = [steps[0], steps[3]] if i % 2 else []
+            suite[f"test_{i}"] = {"steps": opening + rand.choices(steps, k=rand.randrange(6))}
+        mach = _switch_machine()
+        self.assertEqual(run_tests(suite, mach, {}), run_tests_naive(suite, mach, {}))
+
+    def test_shared_session_cleanup(self):
+        tests = {"flips": {"steps": [{"input": "flip"}]}, "leaves": {"steps": [{"input": "leave"}]}}
+        before = set(get_registry()._servers)
+        self.assertEqual(run_tests(tests, _switch_machine(), {}), {"flips": [True], "leaves": [True]})
+        with mock.patch.object(GameServer, "tick", side_effect=RuntimeError("broken")):
+            with self.assertRaises(RuntimeError):
+                run_tests(tests, _switch_machine(), {})
+        self.assertEqual(set(get_registry()._servers), before)
+
+    def test_incremental(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            (root / "manifest.yaml").write_text(
+                "title: Incremental\nfiles:\n  - game.yaml\n  - extra.yaml\ntests:\n  - test.yaml\n")
+            (root / "game.yaml").write_text(GameCacheTests.GAME.format(descr="Entry"))
+            (root / "extra.yaml").write_text("extra: 1\n")
+            (root / "test.yaml").write_text(
+                "moves:\n  steps:\n    - input: go\n    - assert:\n        tag: next\n"
+                "stays:\n  steps:\n    - assert:\n        tag: entry\n")
+            def run():
+                with mock.patch("fictive.test_selection.run_suites", wraps=run_suites) as ran:
+                    results = run_incremental(load_game(root, None), root)
+                return [list(s) for s in ran.call_args.args[0]], results
+            selected, first = run()
+            self.assertEqual(selected, [["moves", "stays"]])
+            self.assertEqual(first[0][1], {"moves": [True, True], "stays": [True]})
+            (root / "extra.yaml").write_text("extra: 2\n")
+            selected, second = run()
+            self.assertEqual(selected, [[]])
+            self.assertEqual(second, first)
+            self.assertEqual(run_incremental(load_game(root, None), root, force=True), first)
+            with mock.patch("fictive.test_selection.engine_key", return_value="upgraded"):
+                selected, _ = run()
+            self.assertEqual(selected, [["moves", "stays"]])
+
+    def test_incremental_new_transition(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            (root / "manifest.yaml").write_text(
+                "title: Aliased\nfiles:\n  - extra.yaml\n  - core.yaml\ntests:\n  - test.yaml\n")
+            (root / "core.yaml").write_text(
+                "states: &states\n  - state: {tag: a, description: A}\n"
+                "  - state: {tag: b, description: B}\n"
+                "execute:\n  startTag: a\n  states:\n    - *states\n  transitions:\n    - *extra\n")
+            (root / "extra.yaml").write_text(
+                "extra: &extra\n  - transition: {from: b, to: a, condition: [{Match: back}]}\n")
+            (root / "test.yaml").write_text(
+                "stays:\n  steps:\n    - input: go\n    - assert:\n        tag: a\n")
+            self.assertEqual(run_incremental(load_game(root, None), root)[0][1], {"stays": [True, True]})
+            with open(root / "extra.yaml", "a") as f:
+                f.write("  - transition: {from: a, to: b, condition: [{Match: go}]}\n")
+            self.assertEqual(run_incremental(load_game(root, None), root)[0][1], {"stays": [True, False]})
@@ -1,26 +1,21 @@
 """
 These functions all represent helper functions to manage our state machine
 transitions.
+
+Each trigger builds a node in a small, declarative tree of conditions and
+actions. Nodes are plain, frozen data: they can be evaluated by calling them
+like any other callback, but they can also be compared, hashed, pickled,
+and converted back into the compiled form of their YAML with `to_ir`.
 """
-from .states import State, Machine, Statebag
-from re import Pattern, compile, IGNORECASE
-from typing import Dict, List, Callable
-from .print_helper import statify
+from .states import State, Machine, Statebag, current_budget
+from re import Pattern, Match as ReMatch, compile, error, IGNORECASE
+from typing import Dict, List, Callable, ClassVar, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
+from .print_helper import compile_template, Template
+import operator
 
 Matcher = Callable[[State, str, Statebag], bool]
 
-def set_key(key: str, value: str | int):
-    """
-    Set a key in our statebag. Mostly used in on_enter or on_exit events.
-    """
-    def _m(current: State, inp: str, statebag: Statebag) -> bool:
-        if isinstance(value, str):
-            statebag[key] = statify(value, statebag)
-        else:
-            statebag[key] = value
-        return True
-    return _m
-
 
 def key_as_int(key: str, statebag: Statebag):
     try:
@@ -29,52 +24,6 @@ def key_as_int(key: str, statebag: Statebag):
         return 0
 
 
-def inc(key: str):
-    """
-    Increment a key. If the current value is not an integer, it will be treated
-    as zero.
-    """
-    def _m(current: State, inp: str, statebag: Statebag) -> bool:
-        statebag[key] = key_as_int(key, statebag) + 1
-        return True
-    return _m
-
-
-def dec(key: str):
-    """
-    Decrement a key. If the current value is not an integer, it will be treated
-    as zero.
-    """
-    def _m(current: State, inp: str, statebag: Statebag) -> bool:
-        statebag[key] = key_as_int(key, statebag) - 1
-        return True
-    return _m
-
-
-def on_match(matcher: Pattern | str, keys: List[str] | None = None):
-    """
-    An on_match condition. Usually checked against input as part of a
-    transition. Supports regexes. Precompiles the regex and captures it.
-    """
-    if isinstance(matcher, str):
-        patt = compile(matcher, IGNORECASE)
-    else:
-        patt = matcher
-
-    def _m(current: State, inp: str, statebag: Statebag):
-        matched = patt.fullmatch(inp)
-        if not matched:
-            return False
-        if keys:
-            try:
-                for k, v in zip(keys, matched.groups()):
-                    statebag[k] = v
-            except:
-                pass
-        return True
-    return _m
-
-
 def _compare_keys(keyA: str, keyB: str, statebag: Statebag):
     """
     Safe comparison; ensures the keys exist, and tries reasonable
@@ -111,17 +60,373 @@ def _compare_keys(keyA: str, keyB: str, statebag: Statebag):
     return -1
 
 
+class Node:
+    """
+    Base class for condition and action nodes. `name` is the trigger name
+    this node is written as in YAML.
+    """
+    name: ClassVar[str]
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        raise NotImplementedError()
+
+    def pure(self) -> bool:
+        """A pure node never changes the statebag or the flow of the machine"""
+        return True
+
+    def cost(self) -> int:
+        """A rough estimate of how expensive this node is to evaluate"""
+        return 1
+
+    def to_ir(self) -> dict | str:
+        """The compiled (YAML-shaped) form of this node"""
+        raise NotImplementedError()
+
+
+@dataclass(frozen=True)
+class Set(Node):
+    """
+    Set a key in our statebag. String values are templates, filled in from
+    the statebag when we set them.
+    """
+    name = "set"
+    key: str
+    value: str | int
+    _template: Template | None = field(default=None, init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        if isinstance(self.value, str):
+            object.__setattr__(self, "_template", compile_template(self.value))
+
+    def __call__(self, current: State, inp: str, statebag: Statebag) -> bool:
+        if self._template is not None:
+            statebag[self.key] = self._template.render(statebag)
+        else:
+            statebag[self.key] = self.value
+        return True
+
+    def pure(self):
+        return False
+
+    def to_ir(self):
+        return {self.name: {"key": self.key, "value": self.value}}
+
+
+@dataclass(frozen=True)
+class Inc(Node):
+    """
+    Increment a key. If the current value is not an integer, it will be treated
+    as zero.
+    """
+    name = "inc"
+    key: str
+
+    def __call__(self, current: State, inp: str, statebag: Statebag) -> bool:
+        statebag[self.key] = key_as_int(self.key, statebag) + 1
+        return True
+
+    def pure(self):
+        return False
+
+    def to_ir(self):
+        return {self.name: {"key": self.key}}
+
+
+@dataclass(frozen=True)
+class Dec(Node):
+    """
+    Decrement a key. If the current value is not an integer, it will be treated
+    as zero.
+    """
+    name = "dec"
+    key: str
+
+    def __call__(self, current: State, inp: str, statebag: Statebag) -> bool:
+        statebag[self.key] = key_as_int(self.key, statebag) - 1
+        return True
+
+    def pure(self):
+        return False
+
+    def to_ir(self):
+        return {self.name: {"key": self.key}}
+
+
+@dataclass(frozen=True)
+class Match(Node):
+    """
+    An on_match condition. Usually checked against input as part of a
+    transition. Supports regexes, and captures groups into `keys`.
+    """
+    name = "match"
+    matcher: str
+    keys: Tuple[str, ...] | None = None
+    flags: int = IGNORECASE
+    pattern: Pattern = field(init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        if isinstance(self.matcher, Pattern):
+            object.__setattr__(self, "pattern", self.matcher)
+            object.__setattr__(self, "flags", self.matcher.flags)
+            object.__setattr__(self, "matcher", self.matcher.pattern)
+        else:
+            object.__setattr__(self, "pattern", compile(self.matcher, self.flags))
+        if self.keys is not None:
+            object.__setattr__(self, "keys", tuple(self.keys))
+
+    def capture(self, groups: Sequence[str | None], statebag: Statebag):
+        """Store matched groups in the statebag, by position in `keys`"""
+        if self.keys:
+            try:
+                for k, v in zip(self.keys, groups):
+                    statebag[k] = v # type: ignore
+            except:
+                pass
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        matched = self.pattern.fullmatch(inp)
+        if not matched:
+            return False
+        self.capture(matched.groups(), statebag)
+        return True
+
+    def pure(self):
+        # capturing keys writes to the statebag
+        return not self.keys
+
+    def cost(self):
+        return 10
+
+    def to_ir(self):
+        args: dict = {"matcher": self.matcher}
+        if self.keys is not None:
+            args["keys"] = list(self.keys)
+        return {self.name: args}
+
+
+_ORDERINGS = {"gt": operator.gt, "lt": operator.lt,
+              "gte": operator.ge, "lte": operator.le}
+
+
+@dataclass(frozen=True)
+class KeyCmp(Node):
+    """
+    Compare a key in our statebag against either a value *or* another key.
+    `op` is one of `eq`, `gt`, `lt`, `gte` or `lte`.
+
+    For the orderings, if the key converts to int it uses a numeric comparison.
+    Otherwise it's a textual comparison.
+    """
+    op: str
+    key: str
+    value: str | int | None = None
+    other: str | None = None
+
+    @property
+    def name(self): # type: ignore
+        return self.op
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        if self.value:
+            if self.op == "eq":
+                return self.key in statebag and statebag[self.key] == self.value
+            cmp = _ORDERINGS[self.op]
+            try:
+                return cmp(int(statebag.get(self.key, 0)), int(self.value))
+            except:
+                return cmp(str(statebag.get(self.key, "")), str(self.value))
+        if self.other:
+            compared = _compare_keys(self.key, self.other, statebag)
+            if self.op == "eq":
+                return compared == 0
+            return _ORDERINGS[self.op](compared, 0)
+        return None
+
+    def cost(self):
+        return 3 if self.other else 2
+
+    def to_ir(self):
+        args: dict = {"key": self.key}
+        if self.value is not None:
+            args["value"] = self.value
+        if self.other is not None:
+            args["other"] = self.other
+        return {self.op: args}
+
+
+@dataclass(frozen=True)
+class Tag(Node):
+    """True if the current state has the given tag"""
+    name = "tag"
+    tag: str
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        return current.tag == self.tag
+
+    def to_ir(self):
+        return {self.name: self.tag}
+
+
+@dataclass(frozen=True)
+class Always(Node):
+    """
+    Transition condition which always is true.
+    """
+    name = "always"
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        return True
+
+    def cost(self):
+        return 0
+
+    def to_ir(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class All(Node):
+    """
+    Composite condition; only transition if ALL the subfunctions are true.
+    """
+    name = "all"
+    conditions: Tuple[Node, ...]
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        budget = current_budget()
+        if budget is None:
+            for f in self.conditions:
+                if not f(current, inp, statebag):
+                    return False
+            return True
+        for f in self.conditions:
+            budget.spend()
+            if not f(current, inp, statebag):
+                return False
+        return True
+
+    def pure(self):
+        return all(c.pure() for c in self.conditions)
+
+    def cost(self):
+        return sum(c.cost() for c in self.conditions)
+
+    def to_ir(self):
+        return {self.name: [c.to_ir() for c in self.conditions]}
+
+
+@dataclass(frozen=True)
+class Any(Node):
+    """
+    Composite condition; only transition if ANY of the subfunctions are true.
+    """
+    name = "any"
+    conditions: Tuple[Node, ...]
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        budget = current_budget()
+        if budget is None:
+            for f in self.conditions:
+                if f(current, inp, statebag):
+                    return True
+            return False
+        for f in self.conditions:
+            budget.spend()
+            if f(current, inp, statebag):
+                return True
+        return False
+
+    def pure(self):
+        return all(c.pure() for c in self.conditions)
+
+    def cost(self):
+        return sum(c.cost() for c in self.conditions)
+
+    def to_ir(self):
+        return {self.name: [c.to_ir() for c in self.conditions]}
+
+
+@dataclass(frozen=True)
+class Seq(Node):
+    """
+    A list of actions, like the ones in `on_enter` and `on_exit`. Unlike `All`,
+    every action runs, in order, no matter what the others return.
+    """
+    name = "seq"
+    actions: Tuple[Node, ...]
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        budget = current_budget()
+        for f in self.actions:
+            if budget is not None:
+                budget.spend()
+            f(current, inp, statebag)
+        return True
+
+    def pure(self):
+        return all(a.pure() for a in self.actions)
+
+    def cost(self):
+        return sum(a.cost() for a in self.actions)
+
+    def to_ir(self):
+        return [a.to_ir() for a in self.actions] # type: ignore
+
+
+@dataclass(frozen=True)
+class Revert(Node):
+    """
+    An on-enter event handler which immediately reverts the current state.
+    """
+    name = "revert"
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        raise Machine.EnterAndRevert()
+
+    def pure(self):
+        return False
+
+    def to_ir(self):
+        return self.name
+
+
+def set_key(key: str, value: str | int):
+    """
+    Set a key in our statebag. Mostly used in on_enter or on_exit events.
+    """
+    return Set(key, value)
+
+
+def inc(key: str):
+    """
+    Increment a key. If the current value is not an integer, it will be treated
+    as zero.
+    """
+    return Inc(key)
+
+
+def dec(key: str):
+    """
+    Decrement a key. If the current value is not an integer, it will be treated
+    as zero.
+    """
+    return Dec(key)
+
+
+def on_match(matcher: Pattern | str, keys: List[str] | None = None):
+    """
+    An on_match condition. Usually checked against input as part of a
+    transition. Supports regexes. Precompiles the regex and captures it.
+    """
+    return Match(matcher, keys) # type: ignore
+
+
 def on_key(key: str, value: str | int | None = None, other: str | None = None):
     """
     Transition condition that checks a key in our statebag against either a
     value *or* another key.
     """
-    def _m(current: State, inp: str, statebag: Statebag):
-        if value:
-            return key in statebag and statebag[key] == value
-        if other:
-            return _compare_keys(key, other, statebag) == 0
-    return _m
+    return KeyCmp("eq", key, value, other)
 
 
 def on_key_gt(key: str, value: str | int | None = None, other: str | None = None):
@@ -129,16 +434,7 @@ def on_key_gt(key: str, value: str | int | None = None, other: str | None = None
     Transition condition that checks a key in our statebag. If it converts to int
     it uses a numeric comparison. Otherwise it's a textual comparison.
     """
-    def _m(current: State, inp: str, statebag: Statebag):
-        if value:
-            try:
-                v = int(statebag.get(key, 0))
-                return v > int(value)
-            except:
-                return str(statebag.get(key, "")) > str(value)
-        if other:
-            return _compare_keys(key, other, statebag) > 0
-    return _m
+    return KeyCmp("gt", key, value, other)
 
 
 def on_key_lt(key: str, value: str | int | None = None, other: str | None = None):
@@ -146,73 +442,47 @@ def on_key_lt(key: str, value: str | int | None = None, other: str | None = None
     Transition condition that checks a key in our statebag. If it converts to int
     it uses a numeric comparison. Otherwise it's a textual comparison.
     """
-    def _m(current: State, inp: str, statebag: Statebag):
-        if value:
-            try:
-                v = int(statebag.get(key, 0))
-                return v < int(value)
-            except:
-                return str(statebag.get(key, "")) < str(value)
-        if other:
-            return _compare_keys(key, other, statebag) < 0
-    return _m
+    return KeyCmp("lt", key, value, other)
 
 
 def on_key_gte(key: str, value: str | int | None = None, other: str | None = None):
-    def _m(current: State, inp: str, statebag: Statebag):
-        if value:
-            try:
-                v = int(statebag.get(key, 0))
-                return v >= int(value)
-            except:
-                return str(statebag.get(key, "")) >= str(value)
-        if other:
-            return _compare_keys(key, other, statebag) >= 0
-    return _m
+    return KeyCmp("gte", key, value, other)
 
 
 def on_key_lte(key: str, value: str | int | None = None, other: str | None = None):
-    def _m(current: State, inp: str, statebag: Statebag):
-        if value:
-            try:
-                v = int(statebag.get(key, 0))
-                return v <= int(value)
-            except:
-                return str(statebag.get(key, "")) <= str(value)
-        if other:
-            return _compare_keys(key, other, statebag) <= 0
-    return _m
+    return KeyCmp("lte", key, value, other)
+
 
 def on_tag(tag: str):
-    def _m(current: State, inp: str, statebag: Statebag):
-        return current.tag == tag
-    return _m
+    return Tag(tag)
+
 
 def always():
     """
     Transition condition which always is true.
     """
-    def _m(current: State, inp: str, statebag: Statebag):
-        return True
-    return _m
+    return Always()
 
 
 def on_all(*fs: Matcher):
     """
     Composite condition; only transition if ALL the subfunctions are true.
     """
-    def _m(current: State, inp: str, statebag: Statebag):
-        return all([f(current, inp, statebag) for f in fs])
-    return _m
+    return All(tuple(fs)) # type: ignore
 
 
 def on_any(*fs: Matcher):
     """
     Composite condition; only transition if ANY of the subfunctions are true.
     """
-    def _m(current: State, inp: str, statebag: Statebag):
-        return any([f(current, inp, statebag) for f in fs])
-    return _m
+    return Any(tuple(fs)) # type: ignore
+
+
+def do_all(*fs: Matcher):
+    """
+    Run a list of actions, in order. Used for triggers like `on_enter`.
+    """
+    return Seq(tuple(fs)) # type: ignore
 
 
 def do_enter_revert():
@@ -222,6 +492,130 @@ def do_enter_revert():
     This is mostly for global transitions; report a global state and transition
     right back to the state you left.
     """
-    def _m(current: State, inp: str, statebag: Statebag):
-        raise Machine.EnterAndRevert()
-    return _m
+    return Revert()
+
+
+def _reorder(nodes: Tuple[Node, ...]) -> Tuple[Node, ...]:
+    """
+    Sort each run of consecutive pure nodes by cost. Impure nodes stay put, so
+    whether (and when) their side effects happen doesn't change.
+    """
+    result: List[Node] = []
+    run: List[Node] = []
+    for n in nodes:
+        if n.pure():
+            run.append(n)
+        else:
+            result += sorted(run, key=lambda r: r.cost())
+            result.append(n)
+            run = []
+    result += sorted(run, key=lambda r: r.cost())
+    return tuple(result)
+
+
+def optimize(node: Node) -> Node:
+    """
+    Rewrite a condition so it's cheaper to evaluate: `all` and `any` are
+    short-circuiting, so cheap checks like `tag` and `eq` should run before
+    regex matches. Only pure conditions are reordered. Also unwraps `all` and
+    `any` with a single condition.
+    """
+    if isinstance(node, (All, Any)):
+        children = tuple(optimize(c) for c in node.conditions)
+        if len(children) == 1:
+            return children[0]
+        return type(node)(_reorder(children))
+    return node
+
+
+# patterns which can't safely be embedded in a larger regex: backreferences,
+# named groups, conditionals, and global flags
+_UNMERGEABLE = compile(r"\\[1-9]|\(\?P|\(\?\(|^\(\?[aiLmsux-]+\)")
+_MERGEABLE_FLAGS = compile("", IGNORECASE).flags
+
+
+def _mergeable(cond) -> bool:
+    return (isinstance(cond, Match)
+            and isinstance(cond.pattern.pattern, str)
+            and cond.pattern.flags == _MERGEABLE_FLAGS
+            and not _UNMERGEABLE.search(cond.pattern.pattern))
+
+
+class MatchTable:
+    """
+    Every mergeable on_match pattern for one state, combined into a single
+    alternation. One `fullmatch` tells us the first pattern, in transition
+    order, which matches the input.
+
+    The last result is memoized by input, so each slot in the table can ask
+    for it without re-running the regex.
+    """
+    def __init__(self, slots: List[Tuple[int, Match]]):
+        parts = []
+        self._groups: Dict[int, Tuple[int, int]] = {}
+        group = 1
+        for slot, m in slots:
+            parts.append(f"(?P<t{slot}>{m.pattern.pattern})")
+            self._groups[group] = (slot, group)
+            group += 1 + m.pattern.groups
+        self.pattern = compile("|".join(parts), IGNORECASE)
+        self._last: Tuple[str | None, int, int, Optional[ReMatch]] = (None, -1, 0, None)
+
+    def __getstate__(self):
+        # the memoized match can't be pickled, and isn't worth keeping
+        state = self.__dict__.copy()
+        state["_last"] = (None, -1, 0, None)
+        return state
+
+    def first(self, inp: str) -> Tuple[int, int, Optional[ReMatch]]:
+        """
+        The slot of the first matching pattern (or -1), the index of its
+        wrapping group, and the match itself.
+        """
+        last_inp, slot, group, matched = self._last
+        if last_inp == inp:
+            return slot, group, matched
+        matched = self.pattern.fullmatch(inp)
+        if matched:
+            slot, group = self._groups[matched.lastindex] # type: ignore
+        else:
+            slot, group = -1, 0
+        self._last = (inp, slot, group, matched)
+        return slot, group, matched
+
+
+class MatchSlot:
+    """
+    Stands in for a `Match` condition which has been merged into a `MatchTable`.
+    """
+    def __init__(self, table: MatchTable, slot: int, match: Match):
+        self.table = table
+        self.slot = slot
+        self.match = match
+
+    def __call__(self, current: State, inp: str, statebag: Statebag):
+        slot, group, matched = self.table.first(inp)
+        if slot != self.slot:
+            return False
+        if self.match.keys:
+            ngroups = self.match.pattern.groups
+            self.match.capture(matched.groups()[group:group+ngroups], statebag) # type: ignore
+        return True
+
+
+def combine_matches(conditions: Sequence[Matcher]) -> Tuple[Matcher, ...]:
+    """
+    Merge the on_match conditions from a state's transitions into a single
+    `MatchTable`. Everything else is left alone, and still evaluated in order.
+    """
+    slots = [(i, c) for i, c in enumerate(conditions) if _mergeable(c)]
+    if len(slots) < 2:
+        return tuple(conditions)
+    try:
+        table = MatchTable(slots) # type: ignore
+    except error:
+        return tuple(conditions)
+    merged = list(conditions)
+    for slot, m in slots:
+        merged[slot] = MatchSlot(table, slot, m) # type: ignore
+    return tuple(merged)
@@ -2,13 +2,18 @@
 Our UI classes, which lets people actually play the game.
 """
 from enum import StrEnum
-from .states import Machine, Statebag, State
-from .print_helper import statify
+from .states import Machine, Statebag, State, BagDelta
+from .print_helper import statify, compile_template
 from .parser import *
-from .loader import load_game_yaml, scan_game_list
+from .loader import GameYAMLError
+from .catalog import GameCatalog, CatalogEntry
+from .reload import GameReloader, Reloaded, POLL_INTERVAL
+from .game_cache import load_game, DEFAULT_CACHE_DIR
 from .game_server import get_game_server
 from textwrap import wrap
-from typing import Tuple, Iterable
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, List, Tuple, Iterable
 from pathlib import Path
 from textual.app import App, ComposeResult, SystemCommand
 from textual.binding import Binding
@@ -17,8 +22,10 @@ from textual.widget import Widget
 from textual.message import Message
 from textual.widgets import Footer, Header, Markdown, Input, Label, ListView, ListItem, DataTable, Static, Pretty
 from textual.containers import Vertical, Container, Horizontal, VerticalScroll
-from textual import on
+from textual import on, work
 from textual.command import Hit, Hits, Provider
+from markdown_it import MarkdownIt
+from markdown_it.token import Token
 
 
 class StatebagPeek(Widget):
@@ -27,29 +34,122 @@ class StatebagPeek(Widget):
     """
 
     def __init__(self, *args, **kwargs):
+        # our copy of the statebag, kept up to date from each tick's changes
+        self._bag: dict = {}
+        self._version = -1
         super().__init__(*args, **kwargs)
 
     def compose(self):
-        yield Pretty(get_game_server().bag())
+        yield Pretty({})
+
+    def update(self, changes: BagDelta | None = None):
+        """
+        Apply a tick's changes to our copy of the statebag, and refresh if
+        we're visible. Without changes, or if we've missed some, start over
+        from the game server's statebag.
+        """
+        if changes is not None and not changes:
+            return
+        view = get_game_server().view()
+        if changes is None or changes.version != self._version + 1:
+            self._bag = dict(view)
+            self._version = get_game_server().version()
+        else:
+            for key in changes.added | changes.changed:
+                self._bag[key] = view[key]
+            for key in changes.removed:
+                self._bag.pop(key, None)
+            self._version = changes.version
+        if self.has_class("active"):
+            self.query_exactly_one(Pretty).update(self._bag)
 
-    def update(self):
-        self.query_exactly_one("Pretty").update(get_game_server().bag())
+
+class MarkdownCache:
+    """
+    A bounded LRU cache of parsed Markdown, keyed by its source text. Only
+    text which never changes (descriptions without templates) belongs in
+    here; everything else gets parsed fresh.
+
+    Textual parses in a worker thread, so this is guarded by a lock.
+    """
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, List[Token]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, text: str, parse: Callable[[str], List[Token]]) -> List[Token]:
+        with self._lock:
+            tokens = self._entries.get(text)
+            if tokens is not None:
+                self.hits += 1
+                self._entries.move_to_end(text)
+                return tokens
+            self.misses += 1
+        tokens = parse(text)
+        with self._lock:
+            self._entries[text] = tokens
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return tokens
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "maxsize": self.maxsize}
+
+
+markdown_cache = MarkdownCache()
+
+
+class CachedParser(MarkdownIt):
+    """A Markdown parser which looks in the `markdown_cache` first"""
+    def __init__(self):
+        super().__init__("gfm-like")
+
+    def parse(self, src: str, env=None) -> List[Token]:
+        if env is not None:
+            return super().parse(src, env)
+        return markdown_cache.get(src, super().parse)
 
 
 class DisplayWrapper(Widget):
     """
     Simple container for our Markdown widget, which will actually
-    be what displays game state
+    be what displays game state. Textual re-parses and re-lays-out the
+    whole document on every update, so we only update it when what we're
+    showing has actually changed.
     """
 
+    def __init__(self, *args, **kwargs):
+        self._shown: Tuple[str, str | None] | None = None
+        self._static = False
+        super().__init__(*args, **kwargs)
+
     def compose(self) -> ComposeResult:
         with VerticalScroll():
-            yield Markdown()
+            yield Markdown(parser_factory=self._parser)
+
+    def _parser(self) -> MarkdownIt:
+        return CachedParser() if self._static else MarkdownIt("gfm-like")
 
-    def update(self, body: str, title: str | None):
+    def update(self, body: str, title: str | None, static: bool = False):
+        """
+        Show `body`, under `title`. If `body` is `static`, it'll never
+        change, so its parsed form can be cached and reused.
+        """
+        if self._shown == (body, title):
+            return
+        self._shown = (body, title)
         self.border_title = title
+        self._static = static
         self.query_exactly_one(Markdown).update(body)
-        pass
 
 
 class GameUI(Screen):
@@ -84,9 +184,11 @@ class GameUI(Screen):
         """
         self.post_message(GameUI.GameOver())
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, reloader: GameReloader | None = None, **kwargs):
         self.ended = False
         self._peek = False
+        self.reloader = reloader
+        self._reloading = False
         super().__init__(*args, **kwargs)
 
     def show_statebag(self):
@@ -96,12 +198,50 @@ class GameUI(Screen):
         else:
             peeker.classes = "active"
         self._peek = not self._peek
+        peeker.update()
 
     def on_mount(self) -> None:
+        self.refresh_view()
+        self.focus_next(Input)
+        if self.reloader is not None:
+            self.set_interval(POLL_INTERVAL, self.check_for_changes)
+
+    def refresh_view(self):
         # properly init our view without ticking the game forward
         self.update(Machine.StepResult(
-            None, get_game_server().current(), None), get_game_server().bag())
-        self.focus_next(Input)
+            None, get_game_server().current(), None), get_game_server().view())
+
+    def check_for_changes(self):
+        if not self._reloading:
+            self._reloading = True
+            self.reload_game()
+
+    @work(thread=True, group="reload")
+    def reload_game(self):
+        """Reload the game if its files have changed, off the UI thread"""
+        try:
+            reloaded = self.reloader.poll() # type: ignore
+        except Exception as ex:
+            self.app.call_from_thread(self.reload_failed, ex)
+        else:
+            self.app.call_from_thread(self.swap_game, reloaded)
+
+    def reload_failed(self, ex: Exception):
+        self._reloading = False
+        self.notify(f"Couldn't reload the game, so we're still playing the old version: {ex}",
+                    severity="error")
+
+    def swap_game(self, reloaded: Reloaded | None):
+        """Carry on playing the new version of the game, from where we were"""
+        self._reloading = False
+        if reloaded is None or self.ended:
+            return
+        gone = get_game_server().reload(reloaded.machine)
+        message = f"Reloaded {', '.join(reloaded.files)}"
+        if gone:
+            message += f". These states have gone, so we've moved: {', '.join(gone)}"
+        self.notify(message, severity="warning" if gone else "information")
+        self.refresh_view()
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -129,17 +269,19 @@ class GameUI(Screen):
     def update_state(self, tick: Machine.StepResult, state_bag: Statebag):
         state_banner = self.get_banner(GameUI.Banners.state, state_bag)
         # Update the main state box
+        template = compile_template(tick.state.description())
         self.query_exactly_one("#State").update(
-            statify(tick.state.description(), state_bag), state_banner
+            template.render(state_bag), state_banner, template.is_static()
         )
 
     def update_substate(self, tick: Machine.StepResult, state_bag: Statebag):
         subs_banner = self.get_banner(GameUI.Banners.sub, state_bag)
         # update the substate box
         subs = self.query_exactly_one("#Substate")
-        if len(tick.state.substates()) > 0:
-            subs.update(statify("\n\n".join(tick.state.substates()),
-                        state_bag), subs_banner)
+        substates = get_game_server().substates()
+        if len(substates) > 0:
+            template = compile_template("\n\n".join(substates))
+            subs.update(template.render(state_bag), subs_banner, template.is_static())
             subs.classes = "active"
         else:
             subs.classes = "inactive"
@@ -150,8 +292,8 @@ class GameUI(Screen):
         trans = self.query_exactly_one("#Transient")
         if tick.transient:
             trans.classes = "active"
-            trans.update(statify(tick.transient.description(),
-                         state_bag), trans_banner)
+            template = compile_template(tick.transient.description())
+            trans.update(template.render(state_bag), trans_banner, template.is_static())
         else:
             trans.classes = "inactive"
 
@@ -170,7 +312,7 @@ class GameUI(Screen):
         self.update_substate(tick, state_bag)
         self.update_transients(tick, state_bag)
         # update our debugging view
-        self.query_exactly_one("#Peek").update()
+        self.query_exactly_one("#Peek").update(tick.changes)
 
     @on(Input.Submitted)
     def input(self, event: Input.Changed) -> None:
@@ -190,6 +332,9 @@ class GameUI(Screen):
 class GameList(Widget):
     """
     A widget showing all of our games.
+
+    It shows what the catalog remembers straight away, then rescans in the
+    background, adding, updating and removing rows as it finds changes.
     """
     class GamePicked(Message):
         """
@@ -200,38 +345,56 @@ class GameList(Widget):
             self.path = path
             super().__init__()
 
-    games: Iterable[ListItem] = []
-
-    def __init__(self, path):
+    def __init__(self, path, cache_dir: Path | None = DEFAULT_CACHE_DIR):
         super().__init__()
         self.path = path
+        self.catalog = GameCatalog(path, cache_dir)
+        self.games: Dict[str, CatalogEntry] = {}
 
     def on_mount(self):
         dt = self.query_exactly_one(DataTable)
-        dt.add_column("Game")
-        dt.add_column("Description")
-        dt.add_column("Author")
+        self.columns = [dt.add_column("Game"), dt.add_column("Description"),
+                        dt.add_column("Author")]
         self.display()
 
     def display(self):
         dt = self.query_exactly_one(DataTable)
-        self.games = [g for g in scan_game_list(self.path)]
         dt.clear()
-        for g in self.games:
-            dt.add_row(g.title, g.slug, g.author)
+        self.games = {}
+        for g in self.catalog.entries():
+            self.show_game(g.path.name, g)
+        self.rescan()
+
+    def show_game(self, name: str, game: CatalogEntry | None):
+        """Add, update or (if `game` is None) remove a game's row"""
+        dt = self.query_exactly_one(DataTable)
+        if game is None:
+            if self.games.pop(name, None) is not None:
+                dt.remove_row(name)
+        elif name in self.games:
+            self.games[name] = game
+            for column, value in zip(self.columns, (game.title, game.slug, game.author)):
+                dt.update_cell(name, column, value)
+        else:
+            self.games[name] = game
+            dt.add_row(game.title, game.slug, game.author, key=name)
+
+    @work(thread=True, exclusive=True, group="catalog")
+    def rescan(self):
+        for name, game in self.catalog.rescan():
+            self.app.call_from_thread(self.show_game, name, game)
 
     def on_screen_resume(self):
-        self.display()
+        self.rescan()
 
     def compose(self):
         yield DataTable(zebra_stripes=True, cursor_type="row")
 
     @on(DataTable.RowSelected)
     def on_selected(self, item: DataTable.RowSelected):
-        idx = item.cursor_row
         self.post_message(
             GameList.GamePicked(
-                self.games[idx].path)
+                self.games[item.row_key.value].path) # type: ignore
         )
 
 
@@ -240,8 +403,9 @@ class GamePicker(Screen):
     The introduction screen for picking games
     """
 
-    def __init__(self, path, *args, **kwargs):
+    def __init__(self, path, *args, cache_dir: Path | None = DEFAULT_CACHE_DIR, **kwargs):
         self.path = Path(path)
+        self.cache_dir = cache_dir
         super().__init__(*args, **kwargs)
 
     def compose(self):
@@ -257,7 +421,7 @@ class GamePicker(Screen):
         yield Markdown("""
  Pick a game you'd like to play.        
         """)
-        yield GameList(self.path)
+        yield GameList(self.path, self.cache_dir)
         yield Footer()
 
 
@@ -266,9 +430,15 @@ class FictiveUI(App):
 
     CSS_PATH = "fictive.tcss"
 
-    def __init__(self, path, *args, debug: bool = False, **kwargs):
+    def __init__(self, path, *args, debug: bool = False,
+                 cache_dir: Path | None = DEFAULT_CACHE_DIR, optimize: bool = False,
+                 watch_files: bool = False, **kwargs):
         self.path = path
         self.debug_enabled = debug
+        self.cache_dir = cache_dir
+        self.optimize = optimize
+        # reload games when their files change, keeping the player's place
+        self.watch_files = watch_files
 
         super().__init__(*args, **kwargs)
 
@@ -281,26 +451,37 @@ class FictiveUI(App):
 
     def on_mount(self):
         self.title = FictiveUI.TITLE
-        self.install_screen(GamePicker(path=self.path), name="picker")
+        self.install_screen(GamePicker(path=self.path, cache_dir=self.cache_dir), name="picker")
         self.push_screen("picker")
 
     @on(GameList.GamePicked)
     def on_game_picked(self, picked: GameList.GamePicked):
+        reloader = None
         try:
-            loaded = load_game_yaml(Path(picked.path))
+            if self.watch_files:
+                reloader = GameReloader(Path(picked.path), self.optimize)
+            else:
+                loaded = load_game(Path(picked.path), self.cache_dir, check=True)
+        except (GameYAMLError, ValueError) as ex:
+            self.notify(f"There was an error loading this game: {ex}",
+                        severity="error")
+            return
         except:
             self.notify("There was an error loading this game.",
                         severity="error")
             return
         try:
-            game, state_bag, title = parse(loaded)
+            if reloader is not None:
+                game, state_bag, title = reloader.machine, reloader.state_bag, reloader.title
+            else:
+                game, state_bag, title = parse(loaded, self.optimize)
         except Exception as ex:
             self.notify("There was an error parsing this game.",
                         severity="error")
             raise ex
             return
         get_game_server().start(game, state_bag)
-        gameUI = GameUI()
+        gameUI = GameUI(reloader=reloader)
         self.install_screen(gameUI, name="running_game")
         self.push_screen("running_game")
         self.title = title